@@ -7,6 +7,8 @@ import subprocess
 import time
 import logging
 import json
+import storage as flock_storage
+import task_timing
 
 FLOCK_VERSION = "1.0"
 
@@ -76,10 +78,12 @@ def read_task_dirs(run_id):
     return (task_dirs, job_deps)
 
 
-def finished_successfully(run_id, task_dir):
+def finished_successfully(run_id, task_dir, storage=None):
+    if storage == None:
+        storage = flock_storage.LocalStorage()
     if run_id != None:
         task_dir = os.path.join(run_id, task_dir)
-    finished = os.path.exists(os.path.join(task_dir, "finished-time.txt"))
+    finished = storage.exists(os.path.join(task_dir, "finished-time.txt"))
     return finished
 
 
@@ -101,12 +105,12 @@ def find_tasks(run_id, external_ids, queued_job_states, task_dirs, job_deps, cac
 
     return tasks
 
-def get_external_id(run_id, task_dir):
+def get_external_id(run_id, task_dir, storage=None):
+    if storage == None:
+        storage = flock_storage.LocalStorage()
     job_id_file = "%s/%s/job_id.txt" % (run_id, task_dir)
-    if os.path.exists(job_id_file):
-        with open(job_id_file) as fd:
-            job_id = fd.read()
-            return job_id
+    if storage.exists(job_id_file):
+        return storage.read(job_id_file)
     return None
 
 @timeit
@@ -149,7 +153,7 @@ def dump_file(filename):
     else:
         sys.stdout.write("  [ File %s does not exist ]" % filename)
 
-def write_python_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body, python_path):
+def write_python_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body, python_path, blob_store_dir=None):
     run_dir = os.path.abspath(run_id)
     temp_run_script = "%s/tasks-init/scatter/scatter.py" % run_id
     with open(temp_run_script, "w") as fd:
@@ -165,6 +169,7 @@ def write_python_scatter_script(run_id, test_job_count, flock_home, notify_comma
         fd.write("  flock_version=%s,\n" % repr(FLOCK_VERSION.split(".")))
         fd.write("  flock_run_dir='%s',\n" % (run_dir))
         fd.write("  flock_home='%s',\n" % (flock_home))
+        fd.write("  flock_blob_store_dir=%s,\n" % repr(blob_store_dir))
         fd.write("  flock_notify_command=%s)\n" % repr(notify_command))
 
         fd.write("with open(flock_support.global_flock_settings['flock_starting_file'], 'w') as fd:\n"
@@ -178,7 +183,7 @@ def write_python_scatter_script(run_id, test_job_count, flock_home, notify_comma
     return temp_run_script
 
 
-def write_r_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body):
+def write_r_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body, blob_store_dir=None):
     run_dir = os.path.abspath(run_id)
     temp_run_script = "%s/tasks-init/scatter/scatter.R" % run_id
     with open(temp_run_script, "w") as fd:
@@ -192,6 +197,10 @@ def write_r_scatter_script(run_id, test_job_count, flock_home, notify_command, s
             fd.write("flock_notify_command <- '%s';\n" % notify_command)
         else:
             fd.write("flock_notify_command <- NULL;\n")
+        if blob_store_dir:
+            fd.write("flock_blob_store_dir <- '%s';\n" % blob_store_dir)
+        else:
+            fd.write("flock_blob_store_dir <- NULL;\n")
 
         fd.write("""fileConn<-file(flock_starting_file)
         writeLines(format(Sys.time(), "%a %b %d %X %Y"), fileConn)
@@ -207,7 +216,7 @@ def write_r_scatter_script(run_id, test_job_count, flock_home, notify_command, s
         """)
     return temp_run_script
 
-def write_files_for_running(flock_home, notify_command, run_id, script_body, test_job_count, environment_variables, language):
+def write_files_for_running(flock_home, notify_command, run_id, script_body, test_job_count, environment_variables, language, blob_store_dir=None):
     run_dir = os.path.abspath(run_id)
     if os.path.exists(run_id):
         raise Exception("\"%s\" already exists. Aborting.", run_id)
@@ -225,9 +234,9 @@ def write_files_for_running(flock_home, notify_command, run_id, script_body, tes
     python_path = "python"
 
     if language == "R":
-        temp_run_script = write_r_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body)
+        temp_run_script = write_r_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body, blob_store_dir)
     elif language == "python":
-        temp_run_script = write_python_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body, python_path)
+        temp_run_script = write_python_scatter_script(run_id, test_job_count, flock_home, notify_command, script_body, python_path, blob_store_dir)
     else:
         raise Exception("Unknown language: %s" % language)
 
@@ -289,8 +298,8 @@ class Flock(object):
             log.warn("Run failed (%d tasks failed). Exitting", len(failures))
             sys.exit(1)
 
-    def run(self, run_id, script_body, wait, maxsubmit, test_job_count, environment_variables, language, no_poll=False):
-        write_files_for_running(self.flock_home, self.notify_command, run_id, script_body, test_job_count, environment_variables, language)
+    def run(self, run_id, script_body, wait, maxsubmit, test_job_count, environment_variables, language, no_poll=False, blob_store_dir=None):
+        write_files_for_running(self.flock_home, self.notify_command, run_id, script_body, test_job_count, environment_variables, language, blob_store_dir)
 
         if not no_poll:
             self.poll_once(run_id, maxsubmit)
@@ -341,6 +350,15 @@ class Flock(object):
         self.print_task_table(rows, estimate)
         return tasks
 
+    def print_timings(self, run_id):
+        task_dirs, job_deps = read_task_dirs(run_id)
+        summary = task_timing.summarize_timings([os.path.join(run_id, task_dir) for task_dir in task_dirs])
+        rows = [["Phase", "Metric", "Tasks", "p50", "p90", "p99", "Max"]]
+        for phase, metric, count, values in summary:
+            rows.append([phase, metric, count] + ["%.3f" % v for v in values])
+        log.info("Timings of tasks in %s" % run_id)
+        self.print_task_table(rows, None, summarize=False)
+
     def list_failures(self, run_id):
         tasks = self.job_queue.find_tasks(run_id)
         for task in tasks:
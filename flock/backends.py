@@ -0,0 +1,141 @@
+import re
+import logging
+from queue.sge import SGEQueue
+from queue.lsf import LSFQueue
+from queue.local import LocalBgQueue
+
+log = logging.getLogger("monitor")
+
+# Wingman can submit to several batch systems (backends) at once, for instance an SGE cluster plus a few big memory
+# machines running tasks in the background.  Each is given on the command line as
+#
+#   NAME:TYPE[:key=value...]
+#
+# where TYPE is one of QUEUE_TYPES and the keys are
+#   max_submitted  the most tasks which may be waiting in its queue at once
+#   min_mem        tasks asking for at least this many MB are sent here rather than to a backend without a min_mem
+#   max_mem        tasks asking for more than this many MB are never sent here
+#   overflow       if 1, tasks whose backend is full may be sent here instead
+#   submit_options passed to qsub or bsub after the run's own options, e.g. "submit_options=-q bigmem.q".  Since the
+#                  spec is split on colons, these can't contain one
+#
+# A run can also be sent to a named backend with "backend" in its config.  The first backend is the default.  Its jobs
+# keep the external ids of its queue type ("SGE:1234") so tasks submitted before there were several backends are
+# still recognized, while the jobs of the others are prefixed with the backend's name ("bigmem@PID:1234").
+
+QUEUE_TYPES = ["sge", "lsf", "local"]
+QUEUE_ID_PREFIXES = {"sge": "SGE:", "lsf": "LSF:", "local": "PID:"}
+
+class Backend(object):
+    def __init__(self, name, queue_type, max_submitted=None, min_mem=None, max_mem=None, overflow=False, is_default=False, submit_options=None):
+        if re.match("^[A-Za-z0-9-]+$", name) is None:
+            raise Exception("Backend names may only contain letters, digits and dashes: %s" % repr(name))
+        if queue_type not in QUEUE_TYPES:
+            raise Exception("Unknown queue type %s for backend %s" % (repr(queue_type), name))
+        self.name = name
+        self.queue_type = queue_type
+        self.max_submitted = max_submitted
+        self.min_mem = min_mem
+        self.max_mem = max_mem
+        self.overflow = overflow
+        self.submit_options = submit_options
+        self.external_id_prefix = QUEUE_ID_PREFIXES[queue_type]
+        if not is_default:
+            self.external_id_prefix = "%s@%s" % (name, self.external_id_prefix)
+
+    def accepts(self, mem):
+        " whether a task asking for mem MB (None if unknown) may run here "
+        return self.max_mem is None or mem is None or mem <= self.max_mem
+
+    def _add_submit_options(self, options):
+        " returns the run's options (which may be None) followed by this backend's "
+        return " ".join([o for o in [options, self.submit_options] if o])
+
+    def create_queue(self, listener, config=None, mem=None):
+        " returns a queue submitting to this backend.  config may be None for a queue only used to list or kill jobs "
+        workdir = "./"
+        if config is not None:
+            workdir = config.workdir
+        if self.queue_type == "local":
+            queue = LocalBgQueue(listener, workdir)
+        elif self.queue_type == "lsf":
+            if config is None:
+                queue = LSFQueue(listener, None, None, workdir)
+            else:
+                queue = LSFQueue(listener, self._add_submit_options(config.bsub_options), self._add_submit_options(config.scatter_bsub_options), workdir)
+        else:
+            if config is None:
+                queue = SGEQueue(listener, None, None, "", workdir, None)
+            else:
+                queue = SGEQueue(listener, self._add_submit_options(config.qsub_options), self._add_submit_options(config.scatter_qsub_options), config.name, workdir, mem)
+        queue.external_id_prefix = self.external_id_prefix
+        return queue
+
+def parse_backend(spec, is_default=False, default_max_submitted=None):
+    " returns the Backend described by NAME:TYPE[:key=value...] "
+    fields = spec.split(":")
+    if len(fields) < 2:
+        raise Exception("Expected NAME:TYPE[:key=value...] but got %s" % repr(spec))
+    options = dict(max_submitted=default_max_submitted)
+    for field in fields[2:]:
+        key, value = field.split("=", 1)
+        if key in ["max_submitted", "min_mem", "max_mem"]:
+            options[key] = int(value)
+        elif key == "overflow":
+            options[key] = value == "1"
+        elif key == "submit_options":
+            options[key] = value
+        else:
+            raise Exception("Unknown backend option %s in %s" % (repr(key), repr(spec)))
+    return Backend(fields[0], fields[1], is_default=is_default, **options)
+
+class BackendRouter(object):
+    def __init__(self, backends):
+        assert len(backends) > 0
+        self.backends = backends
+        self.by_name = dict([(backend.name, backend) for backend in backends])
+        self.default = backends[0]
+
+    def free_slots(self, submitted_counts):
+        " the total number of tasks which may be submitted, given the number waiting in each backend's queue "
+        free = 0
+        for backend in self.backends:
+            if backend.max_submitted is not None:
+                free += max(0, backend.max_submitted - submitted_counts.get(backend.name, 0))
+        return free
+
+    def _has_room(self, backend, submitted_counts):
+        return backend.max_submitted is None or submitted_counts.get(backend.name, 0) < backend.max_submitted
+
+    def choose(self, requested, mem, submitted_counts):
+        """ returns the backend a task should be submitted to, or None if the backends it may go to are all full.
+            requested is the backend named in the run's config, or None to choose by mem """
+        if requested is not None:
+            backend = self.by_name.get(requested)
+            if backend is None:
+                log.warn("Unknown backend %s, using %s", requested, self.default.name)
+                backend = self.default
+            # the run asked for this backend, so don't send its tasks anywhere else
+            if self._has_room(backend, submitted_counts):
+                return backend
+            return None
+
+        # the backend for the most memory the task needs, otherwise the first without a minimum
+        candidates = [b for b in self.backends if b.min_mem is not None and mem is not None and mem >= b.min_mem and b.accepts(mem)]
+        candidates.sort(key=lambda b: -b.min_mem)
+        candidates.extend([b for b in self.backends if b.min_mem is None and b.accepts(mem)])
+        if len(candidates) > 0 and self._has_room(candidates[0], submitted_counts):
+            return candidates[0]
+
+        # spill to any overflow backend which can take it
+        for backend in self.backends:
+            if backend.overflow and backend.accepts(mem) and self._has_room(backend, submitted_counts):
+                return backend
+        return None
+
+    def find_backend(self, external_id):
+        " returns the backend a job was submitted to, or None if it isn't one of ours "
+        for backend in self.backends:
+            if external_id.startswith(backend.external_id_prefix):
+                return backend
+        return None
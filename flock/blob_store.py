@@ -0,0 +1,135 @@
+import os
+import sys
+import errno
+import hashlib
+import pickle
+import tempfile
+import logging
+import result_cache
+
+log = logging.getLogger("flock")
+
+# Content addressed store for large files shared between runs (such as flock_common_state).  Each blob is kept once
+# under [store_dir]/objects/[first two chars of digest]/[digest] and every run's copy is a hardlink to it.  The link
+# count of the object therefore is the reference count: deleting or moving a run off the filesystem drops its links,
+# and collect_garbage() removes objects which are no longer referenced by any run.
+
+class BlobStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, "objects")
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _make_object_dir(self, path):
+        object_dir = os.path.dirname(path)
+        if not os.path.exists(object_dir):
+            try:
+                os.makedirs(object_dir)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        return object_dir
+
+    def put(self, filename):
+        """ replaces filename with a hardlink to the blob with the same content, adding it to the store if this is the
+            first copy.  Returns the digest of the content """
+        digest = result_cache.digest_file(filename)
+        path = self._object_path(digest)
+        self._make_object_dir(path)
+
+        while True:
+            try:
+                os.link(filename, path)
+                return digest
+            except OSError as ex:
+                if ex.errno == errno.EXDEV:
+                    log.warn("%s is not on the same filesystem as the blob store %s, so will not be shared", filename, self.store_dir)
+                    return digest
+                if ex.errno != errno.EEXIST:
+                    raise
+
+            # already have an identical blob, so swap in a link to it.  Link to a temp name and rename over the
+            # original so filename is never missing.
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".blob-")
+            os.close(fd)
+            os.unlink(temp_path)
+            try:
+                os.link(path, temp_path)
+            except OSError as ex:
+                # collect_garbage removed the blob since, so add this copy in its place
+                if ex.errno != errno.ENOENT:
+                    raise
+                continue
+            os.rename(temp_path, filename)
+            return digest
+
+    def put_pickle(self, obj, filename):
+        """ pickles obj to filename via the store.  When an identical blob already exists only a link is created and
+            nothing is written. Returns the digest """
+        data = pickle.dumps(obj)
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._object_path(digest)
+
+        while True:
+            if not os.path.exists(path):
+                fd, temp_path = tempfile.mkstemp(dir=self._make_object_dir(path), prefix=".tmp-")
+                with os.fdopen(fd, "w") as temp_fd:
+                    temp_fd.write(data)
+                os.rename(temp_path, path)
+
+            if os.path.exists(filename):
+                os.unlink(filename)
+            try:
+                os.link(path, filename)
+                return digest
+            except OSError as ex:
+                if ex.errno == errno.ENOENT:
+                    # collect_garbage removed the blob since it was checked for, so write it again
+                    continue
+                if ex.errno != errno.EXDEV:
+                    raise
+                log.warn("%s is not on the same filesystem as the blob store %s, so will not be shared", filename, self.store_dir)
+                with open(filename, "w") as fd:
+                    fd.write(data)
+                return digest
+
+    def reference_count(self, digest):
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            return 0
+        return os.stat(path).st_nlink - 1
+
+    def collect_garbage(self):
+        " removes all blobs which are no longer referenced by any run.  Returns the number of bytes reclaimed "
+        reclaimed = 0
+        if not os.path.exists(self.objects_dir):
+            return reclaimed
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for name in os.listdir(prefix_dir):
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(prefix_dir, name)
+                s = os.stat(path)
+                if s.st_nlink <= 1:
+                    os.unlink(path)
+                    reclaimed += s.st_size
+        log.info("Reclaimed %d bytes from blob store %s", reclaimed, self.store_dir)
+        return reclaimed
+
+def main(args):
+    if len(args) < 2 or args[0] not in ["put", "gc"]:
+        print "Usage: put store_dir filename... | gc store_dir"
+        sys.exit(-1)
+
+    store = BlobStore(args[1])
+    if args[0] == "put":
+        for filename in args[2:]:
+            store.put(filename)
+    else:
+        store.collect_garbage()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,20 @@
+import json
+import zlib
+import xmlrpclib
+
+# Pages of tasks and runs are sent from wingman packed column by column, as zlib compressed json, which is far smaller
+# than a list of xmlrpc structs.  This module has no other dependencies so clients such as the web UI can import it.
+
+def pack_columns(names, rows):
+    " packs rows (tuples of the values of names) as zlib compressed json holding a list of values per name "
+    columns = dict([(name, []) for name in names])
+    for row in rows:
+        for name, value in zip(names, row):
+            columns[name].append(value)
+    return xmlrpclib.Binary(zlib.compress(json.dumps(columns)))
+
+def unpack_columns(packed):
+    " returns the rows packed by pack_columns as a list of dicts "
+    columns = json.loads(zlib.decompress(packed.data))
+    names = columns.keys()
+    return [dict(zip(names, values)) for values in zip(*[columns[name] for name in names])]
@@ -9,7 +9,8 @@ log = logging.getLogger("flock")
 Config = collections.namedtuple("Config", ["base_run_dir", "executor", "invoke", "bsub_options", "qsub_options",
                                            "scatter_bsub_options", "scatter_qsub_options", "workdir", "name", "run_id",
                                            "wingman_host",
-                                           "wingman_port", "environment_variables", "language"])
+                                           "wingman_port", "environment_variables", "language", "blob_store_dir", "scratch_dir",
+                                           "user", "priority", "share", "max_running", "backend"])
 
 def parse_config(f, multivalue_keys):
     props = {}
@@ -54,7 +55,8 @@ def parse_config(f, multivalue_keys):
 
 
 def load_config(filenames, run_id, overrides):
-    config = {"bsub_options": "", "qsub_options": "", "workdir": ".", "name": "", "base_run_dir": ".", "wingman_host":None, "wingman_port":3010, "setenv":[], "language": "R"}
+    config = {"bsub_options": "", "qsub_options": "", "workdir": ".", "name": "", "base_run_dir": ".", "wingman_host":None, "wingman_port":3010, "setenv":[], "language": "R", "blob_store_dir": None, "scratch_dir": None,
+              "user": None, "priority": 0, "share": 1, "max_running": None, "backend": None}
     for filename in filenames:
         log.info("Reading config from %s", filename)
         with open(filename) as f:
@@ -81,6 +83,10 @@ def load_config(filenames, run_id, overrides):
 
     config.update(overrides)
 
+    # a relative blob store is shared by all runs under base_run_dir
+    if config['blob_store_dir'] != None:
+        config['blob_store_dir'] = os.path.abspath(os.path.join(config['base_run_dir'], config['blob_store_dir']))
+
     assert "base_run_dir" in config
     assert "executor" in config
     assert "invoke" in config
@@ -1,30 +1,96 @@
 import sys
+import os
 import pickle
 import time
+import result_cache
+import storage
+import task_timing
+import flock_support
+
+timer = task_timing.PhaseTimer()
+timer.record_startup()
 
 this_script, py_flock_state_file, common_state_file, per_task_state_file = sys.argv
 
+# when the task has been staged to node-local scratch, read and write the copy of the task dir instead
+job_dir = os.environ.get('FLOCK_JOB_DIR')
+staged_job_dir = os.environ.get('FLOCK_STAGED_JOB_DIR')
+common_dir = os.environ.get('FLOCK_COMMON_DIR')
+
+marker_storage = storage.LocalStorage()
+
+def write_timestamp(filename):
+  marker_storage.write(filename, time.strftime('%a %b %d %X %Y', time.localtime()))
+
+def localize(path):
+  if staged_job_dir and isinstance(path, str):
+    if path.startswith(job_dir + "/"):
+      return staged_job_dir + path[len(job_dir):]
+    # the common state is staged into .flock-common
+    staged_common_file = os.path.join(staged_job_dir, ".flock-common", os.path.basename(path))
+    if common_dir and os.path.dirname(path) == common_dir and os.path.exists(staged_common_file):
+      return staged_common_file
+  return path
+
+per_task_state_file = localize(per_task_state_file)
+common_state_file = localize(common_state_file)
+
 with open(py_flock_state_file) as fd:
   scripts = pickle.load(fd)
 
-with open(common_state_file) as fd:
-  common_state = pickle.load(fd)
-  
 with open(per_task_state_file) as fd:
   per_task_state = pickle.load(fd)
-
-# find the function to invoke
-sys.path.extend(scripts["path"])
-module = __import__(scripts['module_name'])
-task_function = getattr(module, scripts['function_name'])
+# the checkpoint stays in the real task dir, since a staged copy is lost along with the node
+per_task_state['flock_checkpoint_file'] = os.path.join(os.path.dirname(per_task_state['flock_completion_file']), flock_support.CHECKPOINT_FILE)
+for k, v in per_task_state.items():
+  if k != 'flock_checkpoint_file':
+    per_task_state[k] = localize(v)
+timer.end_phase("load_input")
 
 print per_task_state
 
-with open(per_task_state['flock_starting_file'], 'w') as fd:
-  fd.write(time.strftime('%a %b %d %X %Y', time.localtime()))
+write_timestamp(per_task_state['flock_starting_file'])
+
+cache = None
+if per_task_state.get('flock_result_cache_dir') != None:
+  cache = result_cache.ResultCache(per_task_state['flock_result_cache_dir'], per_task_state.get('flock_result_cache_max_bytes'))
+
+# another run may have computed the same result since this task was created
+if cache != None and cache.link_into(per_task_state['flock_cache_key'], per_task_state['flock_output_file']):
+  print "Using cached result for %s" % per_task_state['flock_cache_key']
+  timer.end_phase("cache_hit")
+else:
+  with open(common_state_file) as fd:
+    common_state = pickle.load(fd)
+  timer.end_phase("load_common_state")
+
+  # find the function to invoke
+  sys.path.extend([os.path.join(os.environ.get('FLOCK_WORKDIR', ''), p) for p in scripts["path"]])
+  module = __import__(scripts['module_name'])
+  task_function = getattr(module, scripts['function_name'])
+  timer.end_phase("import_module")
+
+  # a task restarted after saving a checkpoint picks up from there
+  per_task_state['flock_checkpoint'] = flock_support.load_checkpoint(per_task_state)
+  if per_task_state['flock_checkpoint'] != None:
+    print "Resuming from checkpoint %s" % per_task_state['flock_checkpoint_file']
+
+  task_function(common_state, per_task_state)
+  timer.end_phase("run")
+
+  if cache != None and os.path.exists(per_task_state['flock_output_file']):
+    cache.store(per_task_state['flock_cache_key'], per_task_state['flock_output_file'])
+
+# fill in any identical tasks from this run which were not submitted
+for duplicate_job_dir in per_task_state.get('flock_duplicate_job_dirs', []):
+  if os.path.exists(per_task_state['flock_output_file']):
+    result_cache.link_or_copy(per_task_state['flock_output_file'], os.path.join(duplicate_job_dir, "output.pickle"))
+  write_timestamp(os.path.join(duplicate_job_dir, "finished-time.txt"))
+timer.end_phase("write_outputs")
+marker_storage.write(os.path.join(os.path.dirname(per_task_state['flock_completion_file']), task_timing.TIMINGS_FILE), timer.to_json())
 
-task_function(common_state, per_task_state)
+# the output supersedes the checkpoint
+flock_support.remove_checkpoint(per_task_state)
 
 # write out record that task completed successfully
-with open(per_task_state['flock_completion_file'], 'w') as fd:
-  fd.write(time.strftime('%a %b %d %X %Y', time.localtime()))
+write_timestamp(per_task_state['flock_completion_file'])
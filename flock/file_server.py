@@ -0,0 +1,166 @@
+import os
+import re
+import zlib
+import threading
+import urlparse
+import logging
+from BaseHTTPServer import BaseHTTPRequestHandler
+from metrics import ThreadingHTTPServer
+
+# pysendfile is optional.  Without it files are copied through a buffer.
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+log = logging.getLogger("monitor")
+
+# Serves the files of runs over plain HTTP, as an alternative to fetching them in base64 encoded pieces with
+# get_file_content.  GET /files?run_dir=...&path=... returns the file at path (relative to run_dir).  A single byte
+# range may be requested with a Range header, and the response is gzipped if the client accepts it (except for
+# range requests and files which are already compressed).
+
+CHUNK_SIZE = 1024*1024
+COMPRESSED_EXTENSIONS = (".gz", ".bz2", ".zip", ".pdf", ".png", ".jpg", ".rds", ".rdata")
+
+def parse_range(header, size):
+    """ returns (offset, length) of the single byte range requested by a Range header, or None to send the whole
+        file.  Raises ValueError if the range starts past the end of the file """
+    if header is None:
+        return None
+    m = re.match(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", header)
+    if m is None or (m.group(1) == "" and m.group(2) == ""):
+        # multiple ranges or something unparsable, which may be ignored
+        return None
+    if m.group(1) == "":
+        # the last n bytes
+        length = min(int(m.group(2)), size)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return size - length, length
+    start = int(m.group(1))
+    if start >= size:
+        raise ValueError("Range starts past the end of the file")
+    end = size - 1
+    if m.group(2) != "":
+        end = min(int(m.group(2)), end)
+        if end < start:
+            return None
+    return start, end - start + 1
+
+def _copy_to_socket(src_fd, sock, offset, length):
+    if sendfile is not None:
+        while length > 0:
+            sent = sendfile(sock.fileno(), src_fd.fileno(), offset, min(length, CHUNK_SIZE))
+            if sent == 0:
+                break
+            offset += sent
+            length -= sent
+        return
+    src_fd.seek(offset)
+    while length > 0:
+        buffer = src_fd.read(min(length, CHUNK_SIZE))
+        if buffer == "":
+            break
+        sock.sendall(buffer)
+        length -= len(buffer)
+
+def read_chunks(path, offset, length):
+    " yields the content of path from offset in pieces of at most CHUNK_SIZE "
+    with open(path, "rb") as fd:
+        fd.seek(offset)
+        while length > 0:
+            buffer = fd.read(min(length, CHUNK_SIZE))
+            if buffer == "":
+                break
+            length -= len(buffer)
+            yield buffer
+
+def make_handler(store):
+    class FileHandler(BaseHTTPRequestHandler):
+        def _find_file(self):
+            " returns the full path of the file requested, or None after sending an error "
+            parsed = urlparse.urlparse(self.path)
+            if parsed.path != "/files":
+                self.send_error(404)
+                return None
+            params = dict(urlparse.parse_qsl(parsed.query))
+            run_dir = params.get("run_dir")
+            path = params.get("path")
+            if run_dir is None or path is None:
+                self.send_error(400, "run_dir and path are required")
+                return None
+            try:
+                store._assert_run_valid(run_dir)
+                store._assert_path_sane(path)
+            except AssertionError:
+                self.send_error(404)
+                return None
+            return os.path.join(run_dir, path)
+
+        def do_GET(self):
+            full_path = self._find_file()
+            if full_path is None:
+                return
+            try:
+                info = store.storage.stat(full_path)
+            except (IOError, OSError):
+                self.send_error(404)
+                return
+            if info['is_dir']:
+                self.send_error(404)
+                return
+            size = info['size']
+
+            try:
+                byte_range = parse_range(self.headers.get("Range"), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            offset, length = 0, size
+            if byte_range is not None:
+                offset, length = byte_range
+            compress = byte_range is None and "gzip" in self.headers.get("Accept-Encoding", "") and \
+                not full_path.lower().endswith(COMPRESSED_EXTENSIONS)
+
+            if byte_range is not None:
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, offset + length - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Type", "application/octet-stream")
+            if compress:
+                # the compressed length isn't known up front, so the end of the response is marked by closing
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Connection", "close")
+            else:
+                self.send_header("Content-Length", str(length))
+            self.end_headers()
+            self.wfile.flush()
+
+            if compress:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                for buffer in read_chunks(full_path, offset, length):
+                    self.wfile.write(compressor.compress(buffer))
+                self.wfile.write(compressor.flush())
+            else:
+                with open(full_path, "rb") as fd:
+                    _copy_to_socket(fd, self.connection, offset, length)
+
+        def log_message(self, format, *args):
+            log.debug("%s %s", self.address_string(), format % args)
+
+    return FileHandler
+
+def start_file_server(store, port):
+    " serves the files of the runs in store on port from a background thread.  Returns the server "
+    server = ThreadingHTTPServer(("0.0.0.0", port), make_handler(store))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
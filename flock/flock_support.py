@@ -2,6 +2,13 @@ import os
 import math
 import pickle
 import subprocess
+import time
+import result_cache
+import blob_store
+import storage
+
+# the name of the file in a task dir which holds the task's last checkpoint
+CHECKPOINT_FILE = "checkpoint.pickle"
 
 global_flock_settings = None
 
@@ -9,7 +16,15 @@ def create_if_missing(dir_name):
   if not os.path.exists(dir_name):
     os.makedirs(dir_name)
 
-def flock_run(inputs, module_path, task_function_name, flock_settings=None, gather_function_name=None, flock_common_state=None):
+def write_timestamp(filename):
+  with open(filename, 'w') as fd:
+    fd.write(time.strftime('%a %b %d %X %Y', time.localtime()))
+
+def flock_run(inputs, module_path, task_function_name, flock_settings=None, gather_function_name=None, flock_common_state=None,
+              result_cache_dir=None, code_version=None, result_cache_max_bytes=None):
+  # if result_cache_dir is set, outputs of tasks are stored in a content addressed cache keyed by the function, the
+  # common state and the task's input.  Tasks found in the cache are marked finished without being submitted, and
+  # tasks which are identical to an earlier task in this run are filled in by that task instead of running again.
   if flock_settings == None:
     flock_settings = global_flock_settings
 
@@ -31,9 +46,18 @@ def flock_run(inputs, module_path, task_function_name, flock_settings=None, gath
   
   # write out common state
   flock_common_state_file = os.path.join(flock_run_dir,task_dir,'flock_common_state.pickle')
-  with open(flock_common_state_file, "w") as fd:
-    pickle.dump(flock_common_state, fd)
-  
+  if flock_settings.get("flock_blob_store_dir") != None:
+    blob_store.BlobStore(flock_settings["flock_blob_store_dir"]).put_pickle(flock_common_state, flock_common_state_file)
+  else:
+    with open(flock_common_state_file, "w") as fd:
+      pickle.dump(flock_common_state, fd)
+
+  cache = None
+  if result_cache_dir != None:
+    cache = result_cache.ResultCache(result_cache_dir, result_cache_max_bytes)
+    common_state_digest = result_cache.digest_file(flock_common_state_file)
+  primary_state_by_key = {}
+
   id_fmt_str = "%%0%.0f.0f" % (math.ceil(math.log(len(inputs))/math.log(10)))
   flock_job_details = []
   created_jobs = []
@@ -62,10 +86,31 @@ def flock_run(inputs, module_path, task_function_name, flock_settings=None, gath
 #    state = flock_starting_file, flock_run_dir, flock_job_dir, flock_input_file, flock_output_file, flock_per_task_state, flock_completion_file
     state = dict(flock_run_dir=flock_run_dir, flock_job_dir=flock_job_dir, flock_input_file=flock_input_file, flock_output_file=flock_output_file, flock_per_task_state=flock_per_task_state,
           flock_starting_file=    flock_starting_file,     flock_completion_file =     flock_completion_file)
-    with open(flock_input_file, "w") as fd:
-      pickle.dump(state, fd)
-    submit_command("1", os.path.join(job_subdir, "task.sh"), "exec %s %s %s %s %s" % (python_path, execute_task_path, per_task_pyflock_file, flock_common_state_file, flock_input_file))
     flock_job_details.append(state)
+
+    if cache != None:
+      key = result_cache.compute_task_key(module_path, module_name, function_name, code_version, common_state_digest, flock_per_task_state)
+      state.update(flock_cache_key=key, flock_result_cache_dir=result_cache_dir, flock_result_cache_max_bytes=result_cache_max_bytes,
+                   flock_duplicate_job_dirs=[])
+      if key in primary_state_by_key:
+        # an identical task was already created in this run, so let it produce the output for this one too
+        primary_state_by_key[key]['flock_duplicate_job_dirs'].append(flock_job_dir)
+        continue
+      primary_state_by_key[key] = state
+      if cache.link_into(key, flock_output_file):
+        write_timestamp(flock_completion_file)
+        continue
+
+    submit_command("1", os.path.join(job_subdir, "task.sh"), "exec %s %s %s %s %s" % (python_path, execute_task_path, per_task_pyflock_file, flock_common_state_file, flock_input_file))
+
+  # input files are written only after all tasks are known, because a task's state lists the duplicates it must fill in
+  for state in flock_job_details:
+    with open(state['flock_input_file'], "w") as fd:
+      pickle.dump(state, fd)
+    if os.path.exists(state['flock_completion_file']):
+      for duplicate_job_dir in state.get('flock_duplicate_job_dirs', []):
+        result_cache.link_or_copy(state['flock_output_file'], os.path.join(duplicate_job_dir, "output.pickle"))
+        write_timestamp(os.path.join(duplicate_job_dir, "finished-time.txt"))
   
   if False and gather_function_name != None:
     create_if_missing(os.path.join(flock_run_dir, task_dir, "gather"))
@@ -88,6 +133,34 @@ def flock_run(inputs, module_path, task_function_name, flock_settings=None, gath
   if flock_settings["flock_notify_command"] != None:
     subprocess.check_call("%s taskset %s %s" % (flock_settings["flock_notify_command"], flock_run_dir, taskset_file), shell=True)
 
+def save_checkpoint(per_task_state, state):
+  """ records state as the progress of a task so far.  If the task is restarted (for instance because its node went
+      away) execute_task passes the last state saved back as per_task_state['flock_checkpoint'].  The checkpoint is
+      replaced atomically, so a task killed while saving still has the previous one """
+  path = per_task_state['flock_checkpoint_file']
+  data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+  temp_path = "%s.tmp-%d" % (path, os.getpid())
+  with open(temp_path, "wb") as fd:
+    fd.write(data)
+    fd.flush()
+    os.fsync(fd.fileno())
+  os.rename(temp_path, path)
+
+def load_checkpoint(per_task_state):
+  " returns the state last passed to save_checkpoint by this task, or None if it never saved one "
+  path = per_task_state.get('flock_checkpoint_file')
+  if path == None:
+    return None
+  checkpoint_storage = storage.LocalStorage()
+  if not checkpoint_storage.exists(path):
+    return None
+  return pickle.loads(checkpoint_storage.read(path))
+
+def remove_checkpoint(per_task_state):
+  path = per_task_state.get('flock_checkpoint_file')
+  if path != None:
+    storage.LocalStorage().delete(path)
+
 def run_commands(commands):
   flock_run(commands, [], "flock_support:execute_shell_command")
 
@@ -0,0 +1,96 @@
+import time
+import socket
+import threading
+import logging
+
+log = logging.getLogger("monitor")
+
+# While a task runs, watch_proc.py sends a small UDP datagram to wingman every few seconds:
+#
+#   hb TASK NODE_NAME CPU_SECONDS VSIZE_MB RSS_MB [CHECKPOINT_TIME]
+#
+# where CHECKPOINT_TIME is when the task last saved a checkpoint (see flock_support.save_checkpoint), so wingman can
+# tell how much work would be lost if the task had to be restarted.
+#
+# Wingman only remembers when it last heard from each task, so a task (or the node it was on) which has died is
+# noticed after a few missed beats instead of waiting for the queue to be polled or the node to be found gone.
+# Datagrams may be lost, which is why several beats have to be missed.
+
+HEARTBEAT_INTERVAL = 5
+MISSED_BEATS = 3
+MAX_DATAGRAM = 1024
+
+class HeartbeatMonitor(object):
+    def __init__(self, interval=HEARTBEAT_INTERVAL, missed_beats=MISSED_BEATS):
+        self.interval = interval
+        self.missed_beats = missed_beats
+        self._lock = threading.Lock()
+        # task -> (time last heard from, node_name, cpu, vsize, rss, checkpoint_time)
+        self._last_seen = {}
+
+    def beat(self, task, node_name, cpu=None, vsize=None, rss=None, now=None, checkpoint_time=None):
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._last_seen[task] = (now, node_name, cpu, vsize, rss, checkpoint_time)
+
+    def handle_datagram(self, data, now=None):
+        " records the beat in data.  Returns False if it was malformed "
+        fields = data.strip().split(" ")
+        if len(fields) not in (6, 7) or fields[0] != "hb":
+            return False
+        def to_float(value):
+            try:
+                return float(value)
+            except ValueError:
+                return None
+        checkpoint_time = None
+        if len(fields) == 7:
+            checkpoint_time = to_float(fields[6])
+        self.beat(fields[1], fields[2], to_float(fields[3]), to_float(fields[4]), to_float(fields[5]), now, checkpoint_time)
+        return True
+
+    def find_silent_tasks(self, now=None):
+        """ returns a list of (task, node_name) for the tasks which have missed too many beats, and forgets them.  A
+            task which finished normally also goes silent, so the caller has to check which are still running """
+        if now is None:
+            now = time.time()
+        deadline = now - self.interval * self.missed_beats
+        with self._lock:
+            silent = [(task, record[1]) for task, record in self._last_seen.items() if record[0] < deadline]
+            for task, node_name in silent:
+                del self._last_seen[task]
+        return silent
+
+    def get_state(self, now=None):
+        """ returns a list of dict(task, node_name, age, cpu, vsize, rss, checkpoint_age) for each task heard from
+            recently.  checkpoint_age is None for tasks which haven't saved a checkpoint """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            records = self._last_seen.items()
+        result = []
+        for task, (seen, node_name, cpu, vsize, rss, checkpoint_time) in sorted(records):
+            checkpoint_age = None
+            if checkpoint_time is not None:
+                checkpoint_age = now - checkpoint_time
+            result.append(dict(task=task, node_name=node_name, age=now - seen, cpu=cpu, vsize=vsize, rss=rss, checkpoint_age=checkpoint_age))
+        return result
+
+def start_listener(monitor, port):
+    " receives heartbeats on UDP port from a background thread.  Returns the socket "
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", port))
+    def receive():
+        while True:
+            try:
+                data, address = sock.recvfrom(MAX_DATAGRAM)
+            except socket.error:
+                log.exception("Could not receive heartbeat")
+                continue
+            if not monitor.handle_datagram(data):
+                log.warn("Ignoring malformed heartbeat from %s: %s", address, repr(data))
+    t = threading.Thread(target=receive)
+    t.daemon = True
+    t.start()
+    return sock
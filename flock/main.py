@@ -6,6 +6,7 @@ import shutil
 import logging
 import config as flock_config
 import wingman_client
+import blob_store
 
 from queue.lsf import LSFQueue
 from queue.sge import SGEQueue
@@ -32,7 +33,7 @@ def main(cmd_line_args=None):
     parser.add_argument('--rundir', help="Override the run directory used by this run")
     parser.add_argument('--workdir', help="Override the working directory used by each task")
     parser.add_argument('--executor', help="Override the execution method")
-    parser.add_argument('command', help='One of: run, check, poll, retry or kill')
+    parser.add_argument('command', help='One of: run, check, poll, retry, kill, failed, timings or gc-blobs')
     parser.add_argument('run_id', help='Path to config file, which in turn will be used as the id for this run')
 
     args = parser.parse_args(cmd_line_args)
@@ -86,13 +87,15 @@ def main(cmd_line_args=None):
 
     f = flock.Flock(job_queue, flock_home, listener.get_notify_command())
     job_queue.system = f.system
+    job_queue.scratch_dir = config.scratch_dir
 
     if command == "run":
         if args.test and os.path.exists(run_id):
             log.warn("%s already exists -- removing before running job", run_id)
             shutil.rmtree(run_id)
 
-        f.run(run_id, config.invoke, not args.nowait, args.maxsubmit, test_job_count, config.environment_variables, config.language)
+        f.run(run_id, config.invoke, not args.nowait, args.maxsubmit, test_job_count, config.environment_variables, config.language,
+              blob_store_dir=config.blob_store_dir)
     elif command == "submit":
         wingman_host = config.wingman_host
         if wingman_host == None:
@@ -117,6 +120,12 @@ def main(cmd_line_args=None):
         f.retry(run_id, not args.nowait, args.maxsubmit)
     elif command == "failed":
         f.list_failures(run_id)
+    elif command == "timings":
+        f.print_timings(run_id)
+    elif command == "gc-blobs":
+        if config.blob_store_dir == None:
+            raise Exception("No blob_store_dir configured")
+        blob_store.BlobStore(config.blob_store_dir).collect_garbage()
     else:
         raise Exception("Unknown command: %s" % command)
 
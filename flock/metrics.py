@@ -0,0 +1,182 @@
+import time
+import threading
+import logging
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+log = logging.getLogger("monitor")
+
+# Counters and histograms rendered in the Prometheus text exposition format, so they can be scraped from a side
+# port.  Rates (such as submissions per minute) are left to the scraper: counters only ever go up.
+
+# upper bounds in seconds, suited to anything from a db transaction up to a qstat call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(["%s=\"%s\"" % (name, _escape(value)) for name, value in pairs]) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value) == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+class Counter(object):
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append("%s%s %s" % (self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+class Histogram(object):
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._lock = threading.Lock()
+        # label values -> [count in each bucket, sum, count]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            record = self._values.get(label_values)
+            if record is None:
+                record = [[0] * len(self.buckets), 0.0, 0]
+                self._values[label_values] = record
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    record[0][i] += 1
+                    break
+            record[1] += value
+            record[2] += 1
+
+    def get_count(self, *label_values):
+        record = self._values.get(label_values)
+        if record is None:
+            return 0
+        return record[2]
+
+    def time(self, *label_values):
+        " returns a context manager which observes the time spent inside it "
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.label_names, label_values, [("le", _format_value(bound))])
+                    lines.append("%s_bucket%s %d" % (self.name, labels, cumulative))
+                labels = _format_labels(self.label_names, label_values)
+                lines.append("%s_sum%s %s" % (self.name, labels, repr(total)))
+                lines.append("%s_count%s %d" % (self.name, labels, count))
+        return lines
+
+class _Timer(object):
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.time() - self.start, *self.label_values)
+
+class GaugeFunction(object):
+    " a gauge whose values are read when scraped.  fn returns a list of (label values, value) "
+    def __init__(self, name, help, label_names, fn):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.fn = fn
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        for label_values, value in self.fn():
+            lines.append("%s%s %s" % (self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics = [m for m in self._metrics if m.name != metric.name] + [metric]
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self.register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def gauge_function(self, name, help, label_names, fn):
+        return self.register(GaugeFunction(name, help, label_names, fn))
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics):
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                log.exception("Could not collect %s", metric.name)
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    " an HTTPServer handling each request on its own daemon thread, also used by file_server "
+    daemon_threads = True
+
+def start_http_server(port, registry=REGISTRY):
+    " serves registry at /metrics on port from a background thread.  Returns the server "
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            content = registry.render()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            # scrapes come every few seconds, don't fill the log with them
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
@@ -2,6 +2,7 @@ import collections
 import flock
 import os
 import time
+import pipes
 
 class TaskStatusCache:
     def __init__(self):
@@ -90,11 +91,80 @@ class TaskStatusCache:
             else:
                 return flock.WAITING
 
+STAGING_SCRIPT = """set -e
+export FLOCK_JOB_DIR=%(task_dir)s
+export FLOCK_WORKDIR=`pwd`
+export FLOCK_STAGED_JOB_DIR=`mktemp -d %(scratch_dir)s/flock-XXXXXXXX`
+trap 'rm -rf "$FLOCK_STAGED_JOB_DIR"' EXIT
+
+# stage the inputs to node-local scratch
+find "$FLOCK_JOB_DIR" -maxdepth 1 -type f ! -name 'stdout.txt*' ! -name 'stderr.txt*' ! -name 'staging-std*.txt' ! -name proc_stats.txt -exec cp -p -t "$FLOCK_STAGED_JOB_DIR" {} +
+
+# the run's common state lives in a parent of the task dir and is shared by all of its tasks, so it is copied to the
+# node once and linked into .flock-common.  Blob store links share an inode, so runs with identical state share a copy.
+export FLOCK_COMMON_DIR=""
+d="$FLOCK_JOB_DIR"
+for i in 1 2 3 ; do
+  d=`dirname "$d"`
+  if ls "$d"/flock_common_state.* > /dev/null 2>&1 ; then
+    FLOCK_COMMON_DIR="$d"
+    break
+  fi
+done
+mkdir "$FLOCK_STAGED_JOB_DIR/.flock-common"
+if [ -n "$FLOCK_COMMON_DIR" ] ; then
+  common_cache=%(scratch_dir)s/flock-common
+  mkdir -p "$common_cache"
+  find "$common_cache" -type f -mtime +1 -delete 2> /dev/null || true
+  for f in "$FLOCK_COMMON_DIR"/flock_common_state.* ; do
+    cached="$common_cache/`stat -L -c '%%d-%%i-%%s-%%Y' "$f"`"
+    if [ ! -e "$cached" ] ; then
+      cp "$f" "$cached.$$"
+      mv -f "$cached.$$" "$cached"
+    fi
+    touch "$cached"
+    ln -s "$cached" "$FLOCK_STAGED_JOB_DIR/.flock-common/`basename "$f"`"
+  done
+fi
+
+# remember what was staged, so only what the task added or changed is copied back.  Timestamps aren't used since
+# they may be too coarse to tell an input from an output written in the same second.
+cd "$FLOCK_STAGED_JOB_DIR"
+find . -type f -exec cksum {} + | LC_ALL=C sort > .flock-manifest
+
+set +e
+( cd "$FLOCK_STAGED_JOB_DIR" && bash %(task_script)s > "$FLOCK_STAGED_JOB_DIR/stdout.txt" 2> "$FLOCK_STAGED_JOB_DIR/stderr.txt" )
+ret=$?
+set -e
+
+# copy back everything the task wrote in one pass.  The completion marker goes last so it only exists if
+# everything else made it back.
+cd "$FLOCK_STAGED_JOB_DIR"
+find . -type f ! -name finished-time.txt ! -name .flock-manifest ! -path './.flock-common/*' -exec cksum {} + | LC_ALL=C sort | \
+  LC_ALL=C comm -13 .flock-manifest - | cut -d ' ' -f 3- | tr '\\n' '\\0' | xargs -0 -r cp -p --parents -t "$FLOCK_JOB_DIR"
+if [ -e finished-time.txt ] ; then
+  cp finished-time.txt "$FLOCK_JOB_DIR/finished-time.txt"
+fi
+cd /
+exit $ret
+"""
+
+def write_staging_script(task_full_path, task_script, scratch_dir):
+    """ writes a script which runs task_script with its task directory staged to a temp dir under scratch_dir.
+        returns the (script, stdout, stderr) to submit in place of the original """
+    d = task_full_path
+    script_to_execute = "%s/staged_task.sh" % d
+    with open(script_to_execute, "w") as fd:
+        fd.write(STAGING_SCRIPT % dict(task_dir=pipes.quote(d), task_script=pipes.quote(task_script), scratch_dir=pipes.quote(scratch_dir)))
+    return (script_to_execute, "%s/staging-stdout.txt" % d, "%s/staging-stderr.txt" % d)
+
 class AbstractQueue(object):
     def __init__(self, listener):
         self.cache = TaskStatusCache()
         self.last_estimate = None
         self.listener = listener
+        # if set, tasks (other than scatter tasks) run from a copy of their task directory under this directory
+        self.scratch_dir = None
 
     def submit(self, run_id, task_full_path, is_scatter):
         self.clean_task_dir(task_full_path)
@@ -104,10 +174,18 @@ class AbstractQueue(object):
         stderr = "%s/stderr.txt" % d
         script_to_execute = "%s/task.sh" % d
 
+        if self.scratch_dir != None and not is_scatter:
+            script_to_execute, stdout, stderr = write_staging_script(d, script_to_execute, self.scratch_dir)
+
         script_to_execute, stdout, stderr = self.listener.presubmit(run_id, task_full_path, script_to_execute, stdout, stderr)
 
         self.add_to_queue(task_full_path, is_scatter, script_to_execute, stdout, stderr)
 
+    def kill_by_name(self, name):
+        """ kills every job of the run with the given name in one call.  Returns False if this queue can't, in which
+            case the jobs need to be passed to kill() """
+        return False
+
     def get_last_estimate(self):
         return self.last_estimate
 
@@ -0,0 +1,114 @@
+import os
+import shlex
+import collections
+import logging
+
+log = logging.getLogger("flock")
+
+# Reads the records the batch system appends to its accounting file as each job finishes (SGE's
+# $SGE_ROOT/$SGE_CELL/common/accounting, LSF's lsb.acct).  The file is read incrementally from a saved offset, so
+# each call only parses what was written since the last one.
+
+JobExit = collections.namedtuple("JobExit", ["job_id", "exit_status", "failure_reason", "wall_time", "max_vmem_mb"])
+
+bytes_per_mb = 1000*1000
+
+# the reasons for the common values of the "failed" field of SGE's accounting file
+SGE_FAILURE_REASONS = {1: "assumedly before job", 3: "before writing config", 4: "before writing pid",
+                       7: "before prolog", 8: "in prolog", 10: "in pestart", 11: "in job", 12: "before pestop",
+                       13: "in pestop", 14: "before epilog", 15: "in epilog", 19: "before job",
+                       21: "in recognizing job", 25: "rescheduling", 26: "opening input/output file",
+                       27: "searching requested shell", 28: "changing into working directory",
+                       37: "qmaster enforced h_rt, h_cpu or h_vmem limit", 100: "assumedly after job"}
+
+def parse_sge_accounting_line(line):
+    " returns a JobExit for a line of an SGE accounting file, or None for comments "
+    if line.startswith("#") or line.strip() == "":
+        return None
+    fields = line.rstrip("\n").split(":")
+    if len(fields) < 43:
+        log.warn("Ignoring malformed accounting line: %s", repr(line))
+        return None
+    failed = int(fields[11].split()[0])
+    failure_reason = None
+    if failed != 0:
+        failure_reason = SGE_FAILURE_REASONS.get(failed, "failed %d" % failed)
+    return JobExit(fields[5], int(fields[12]), failure_reason, float(fields[13]), float(fields[42]) / bytes_per_mb)
+
+# jStatus of a finished LSF job
+LSF_JOB_DONE = 64
+LSF_JOB_EXIT = 32
+# number of rusage fields following the command in a JOB_FINISH record
+LSF_RUSAGE_FIELDS = 19
+
+def parse_lsf_acct_line(line):
+    " returns a JobExit for a JOB_FINISH record of an LSF lsb.acct file, or None for other records "
+    if not line.startswith('"JOB_FINISH"'):
+        return None
+    try:
+        fields = shlex.split(line)
+        job_id = fields[3]
+        start_time = int(fields[10])
+        term_time = int(fields[9])
+        # the lists of asked for and execution hosts are variable length
+        i = 22
+        i += 1 + int(fields[i])
+        i += 1 + int(fields[i])
+        job_status = int(fields[i])
+        # skip jStatus, hostFactor, jobName, command, the rusage fields, mailUser and projectName
+        i += 4 + LSF_RUSAGE_FIELDS + 2
+        wait_status = int(fields[i])
+        # skip exitStatus, maxNumProcessors, loginShell, timeEvent and idx
+        max_rmem_kb = int(fields[i + 5])
+    except (ValueError, IndexError):
+        log.warn("Ignoring malformed lsb.acct record: %s", repr(line))
+        return None
+
+    exit_status = wait_status >> 8
+    failure_reason = None
+    if wait_status & 0x7f != 0:
+        failure_reason = "killed by signal %d" % (wait_status & 0x7f)
+    elif job_status != LSF_JOB_DONE and exit_status == 0:
+        failure_reason = "exited with status %d" % job_status
+    wall_time = None
+    if start_time > 0:
+        wall_time = float(term_time - start_time)
+    return JobExit(job_id, exit_status, failure_reason, wall_time, max_rmem_kb * 1000.0 / bytes_per_mb)
+
+PARSERS = {"sge": parse_sge_accounting_line, "lsf": parse_lsf_acct_line}
+
+# the most to read from the file in one call
+MAX_READ = 16*1024*1024
+
+class AccountingFileTail(object):
+    def __init__(self, path, parse_line):
+        self.path = path
+        self.parse_line = parse_line
+
+    def read_new_records(self, offset, inode):
+        """ returns (records, offset, inode) for the complete lines written after offset.  Pass in the offset and
+            inode returned by the previous call, or None for both to skip everything already in the file.  If the
+            file was rotated since (a different inode or shorter than offset) it is read from the start """
+        if not os.path.exists(self.path):
+            return [], offset, inode
+        s = os.stat(self.path)
+        if offset is None:
+            return [], s.st_size, s.st_ino
+        if s.st_ino != inode or s.st_size < offset:
+            log.info("%s was rotated, reading from the start", self.path)
+            offset = 0
+
+        with open(self.path) as fd:
+            fd.seek(offset)
+            data = fd.read(MAX_READ)
+
+        # leave any partially written line for next time
+        end = data.rfind("\n")
+        if end < 0:
+            return [], offset, s.st_ino
+        records = []
+        for line in data[:end].split("\n"):
+            record = self.parse_line(line)
+            if record is not None:
+                records.append(record)
+        return records, offset + end + 1, s.st_ino
@@ -53,6 +53,7 @@ class LocalBgQueue(AbstractQueue):
     def kill(self, tasks):
         for task in tasks:
             os.kill(int(task.external_id), signal.SIGINT)
+        return True
 
 
 class LocalQueue(AbstractQueue):
@@ -70,10 +70,16 @@ class LSFQueue(AbstractQueue):
         self.listener.task_submitted(d, self.external_id_prefix + lsf_job_id)
 
     def kill(self, tasks):
+        " returns False if bkill failed for any of the tasks (including ones whose jobs had already left the queue) "
+        killed = True
         for batch in divide_into_batches(tasks, 100):
             cmd = ["bkill"]
             cmd.extend([task.external_id for task in batch])
             handle = subprocess.Popen(cmd)
             handle.communicate()
+            if handle.returncode != 0:
+                log.warn("%s exited with %s", cmd, handle.returncode)
+                killed = False
+        return killed
 
 
@@ -30,6 +30,9 @@ def rewrite_options_with_override(options, override_req_mem_in_megs):
     print options
     return options
 
+def safe_job_name(name):
+    return re.sub("\\W+", "-", name)
+
 class SGEQueue(AbstractQueue):
     def __init__(self, listener, qsub_options, scatter_qsub_options, name, workdir, override_req_mem_in_megs=None):
         super(SGEQueue, self).__init__(listener)
@@ -38,7 +41,7 @@ class SGEQueue(AbstractQueue):
         self.external_id_prefix = "SGE:"
 
         self.name = name
-        self.safe_name = re.sub("\\W+", "-", name)
+        self.safe_name = safe_job_name(name)
         self.workdir = workdir
 
     def get_jobs_from_external_queue(self):
@@ -92,9 +95,23 @@ class SGEQueue(AbstractQueue):
         sge_job_id = m.group(1)
         self.listener.task_submitted(d, self.external_id_prefix + sge_job_id)
 
+    def kill_by_name(self, name):
+        " kills all of the jobs of the run with the given name with a single qdel "
+        cmd = ["qdel", "*-%s" % safe_job_name(name)]
+        log.info("EXEC: %s", cmd)
+        handle = subprocess.Popen(cmd)
+        handle.communicate()
+        return True
+
     def kill(self, tasks):
+        " returns False if qdel failed for any of the tasks (including ones whose jobs had already left the queue) "
+        killed = True
         for batch in divide_into_batches(tasks, 100):
             cmd = ["qdel"]
             cmd.extend([task.external_id for task in batch])
             handle = subprocess.Popen(cmd)
             handle.communicate()
+            if handle.returncode != 0:
+                log.warn("%s exited with %s", cmd, handle.returncode)
+                killed = False
+        return killed
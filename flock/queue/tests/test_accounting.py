@@ -0,0 +1,53 @@
+from flock.queue import accounting
+import os
+import tempfile
+import shutil
+
+def sge_line(job_number, failed, exit_status, wallclock, maxvmem):
+    fields = ["all.q", "node001", "users", "ubuntu", "t1-name", str(job_number), "sge", "0", "1414771000", "1414771010",
+              "1414771070", str(failed), str(exit_status), str(wallclock)] + ["0"] * 22 + ["0.5", "0.1", "0.0", "NONE", "0.0", "NONE", "%d" % maxvmem, "0", "0"]
+    return ":".join(fields) + "\n"
+
+LSF_LINE = '"JOB_FINISH" "9.1" 1414771070 6265891 501 33554450 1 1414771000 0 1414771070 1414771010 "pmontgo" "bhour" "" "" "" "tin" "/home" "" "" "" "1414771000.6265891" 0 1 "node001" 64 100.0 "t1" "bash task.sh" ' \
+           + " ".join(["0.0"] * 19) + ' "" "default" 256 1 "/bin/sh" 0 0 2048000 0\n'
+
+def test_parse_records():
+    job_exit = accounting.parse_sge_accounting_line(sge_line(561860, 100, 137, 60, 2 * 1000 * 1000 * 1000))
+    assert job_exit == accounting.JobExit("561860", 137, "assumedly after job", 60.0, 2000.0)
+    assert accounting.parse_sge_accounting_line("# Version: 2011.11\n") is None
+
+    job_exit = accounting.parse_lsf_acct_line(LSF_LINE)
+    assert job_exit == accounting.JobExit("6265891", 1, None, 60.0, 2048.0)
+    assert accounting.parse_lsf_acct_line('"JOB_NEW" "9.1" 1414771000 6265891\n') is None
+
+def test_tail_reads_only_complete_new_lines():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "accounting")
+        with open(path, "w") as fd:
+            fd.write(sge_line(1, 0, 0, 10, 0))
+        tail = accounting.AccountingFileTail(path, accounting.parse_sge_accounting_line)
+
+        # jobs which finished before we started following the file are skipped
+        records, offset, inode = tail.read_new_records(None, None)
+        assert records == []
+
+        with open(path, "a") as fd:
+            fd.write(sge_line(2, 0, 0, 10, 0))
+            fd.write(sge_line(3, 0, 1, 10, 0)[:20])
+        records, offset, inode = tail.read_new_records(offset, inode)
+        assert [r.job_id for r in records] == ["2"]
+
+        with open(path, "a") as fd:
+            fd.write(sge_line(3, 0, 1, 10, 0)[20:])
+        records, offset, inode = tail.read_new_records(offset, inode)
+        assert [(r.job_id, r.exit_status) for r in records] == [("3", 1)]
+
+        # after the file is rotated, the new one is read from the start
+        os.unlink(path)
+        with open(path, "w") as fd:
+            fd.write(sge_line(4, 0, 0, 10, 0))
+        records, offset, inode = tail.read_new_records(offset, inode)
+        assert [r.job_id for r in records] == ["4"]
+    finally:
+        shutil.rmtree(temp_dir)
@@ -6,8 +6,8 @@ import subprocess
 JOB_OUTPUT = ("JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME\n"+
               "6265422 pmontgo PEND  bhour      tin                     *h -c echo May  9 17:11\n")
 
-def mock_popen(stdout="", stderr=""):
-    handle = mock.Mock()
+def mock_popen(stdout="", stderr="", returncode=0):
+    handle = mock.Mock(returncode=returncode)
     handle.communicate = mock.Mock(return_value=(stdout, stderr))
     m = mock.Mock(return_value=handle)
     return m
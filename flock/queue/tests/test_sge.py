@@ -21,8 +21,8 @@ JOB_XML = """<?xml version='1.0'?>
 </job_info>"""
 
 
-def mock_popen(stdout="", stderr=""):
-    handle = mock.Mock()
+def mock_popen(stdout="", stderr="", returncode=0):
+    handle = mock.Mock(returncode=returncode)
     handle.communicate = mock.Mock(return_value=(stdout, stderr))
     m = mock.Mock(return_value=handle)
     return m
@@ -62,11 +62,26 @@ qdel_popen_mock = mock_popen("Killed")
 def test_kill():
     listener = mock.Mock()
     queue = SGEQueue(listener, "", "", "name", "workdir")
-    queue.kill([Task("task", "100", "running", "/home/task")])
+    assert queue.kill([Task("task", "100", "running", "/home/task")])
 
     qdel_popen_mock.assert_called_once_with(["qdel", "100"])
 
+@mock.patch("subprocess.Popen", mock_popen("denied", returncode=1))
+def test_failed_kill():
+    listener = mock.Mock()
+    queue = SGEQueue(listener, "", "", "name", "workdir")
+    assert not queue.kill([Task("task", "100", "running", "/home/task")])
+
 def test_rewrite_options():
     assert rewrite_options_with_override(["-o", "stdout"], None) == ["-o", "stdout"]
     assert rewrite_options_with_override(["-o", "stdout"], 80) == ["-o", "stdout", "-l", "h_vmem=80M,virtual_free=80M"]
-    assert rewrite_options_with_override(["-l", "h_vmem=1G,virtual_free=1G", "-o", "stdout"], 80) == ["-o", "stdout", "-l", "h_vmem=80M,virtual_free=80M"]
\ No newline at end of file
+    assert rewrite_options_with_override(["-l", "h_vmem=1G,virtual_free=1G", "-o", "stdout"], 80) == ["-o", "stdout", "-l", "h_vmem=80M,virtual_free=80M"]
+
+qdel_by_name_popen_mock = mock_popen()
+
+
+@mock.patch("subprocess.Popen", qdel_by_name_popen_mock)
+def test_kill_by_name():
+    queue = SGEQueue(mock.Mock(), "", "", "name", "workdir")
+    assert queue.kill_by_name("my run")
+    qdel_by_name_popen_mock.assert_called_once_with(["qdel", "*-my-run"])
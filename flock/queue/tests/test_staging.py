@@ -0,0 +1,48 @@
+from flock.queue import write_staging_script
+import os
+import subprocess
+import tempfile
+import shutil
+
+TASK_SCRIPT = """echo "ran in `pwd`"
+test "`pwd`" = "$FLOCK_STAGED_JOB_DIR"
+cat input.txt > output.txt
+cat .flock-common/flock_common_state.pickle >> output.txt
+# rewritten within the same second and at the same size as the staged copy
+echo -n INPUT > input.txt
+date > finished-time.txt
+"""
+
+def test_staged_task_copies_back_outputs():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        task_dir = os.path.join(temp_dir, "my run", "tasks", "1")
+        scratch_dir = os.path.join(temp_dir, "scratch")
+        os.makedirs(task_dir)
+        os.makedirs(scratch_dir)
+        with open(os.path.join(task_dir, "input.txt"), "w") as fd:
+            fd.write("input")
+        with open(os.path.join(temp_dir, "my run", "tasks", "flock_common_state.pickle"), "w") as fd:
+            fd.write(" common")
+        with open(os.path.join(task_dir, "task.sh"), "w") as fd:
+            fd.write(TASK_SCRIPT)
+
+        script, stdout, stderr = write_staging_script(task_dir, os.path.join(task_dir, "task.sh"), scratch_dir)
+        assert stdout == os.path.join(task_dir, "staging-stdout.txt")
+
+        assert subprocess.call(["bash", script], cwd=temp_dir) == 0
+
+        with open(os.path.join(task_dir, "output.txt")) as fd:
+            assert fd.read() == "input common"
+        with open(os.path.join(task_dir, "input.txt")) as fd:
+            assert fd.read() == "INPUT"
+        with open(os.path.join(task_dir, "stdout.txt")) as fd:
+            assert fd.read().startswith("ran in %s/flock-" % scratch_dir)
+        assert os.path.exists(os.path.join(task_dir, "finished-time.txt"))
+
+        # scratch space is cleaned up after the task, leaving only the common state cached for other tasks
+        assert os.listdir(scratch_dir) == ["flock-common"]
+        assert not os.path.exists(os.path.join(task_dir, ".flock-common"))
+        assert not os.path.exists(os.path.join(task_dir, ".flock-manifest"))
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,152 @@
+import os
+import errno
+import shutil
+import hashlib
+import pickle
+import tempfile
+import time
+import logging
+
+log = logging.getLogger("flock")
+
+# Content addressed cache of task outputs.  Entries live under
+#   [cache_dir]/[first two chars of key]/[key]
+# and the mtime of each entry is bumped on every hit so eviction can drop the least recently used.  Evicting walks the
+# whole cache, so store only does it when the mtime of [cache_dir]/.last-eviction is over EVICT_INTERVAL seconds old.
+
+EVICT_INTERVAL = 300
+
+def digest_file(filename, block_size=1024*1024):
+    h = hashlib.sha1()
+    with open(filename, "rb") as fd:
+        while True:
+            block = fd.read(block_size)
+            if block == "":
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def compute_task_key(module_path, module_name, function_name, code_version, common_state_digest, per_task_state):
+    """ returns the cache key for a single task: a hash over the identity of the function to invoke, the digest of
+        the common state file and the serialized per-task input """
+    h = hashlib.sha1()
+    h.update(repr((list(module_path), module_name, function_name, code_version)))
+    h.update(common_state_digest)
+    h.update(pickle.dumps(per_task_state, 2))
+    return h.hexdigest()
+
+def link_or_copy(src, dest):
+    if os.path.exists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError as ex:
+        if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(src, dest)
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def lookup(self, key):
+        " returns the path to the cached output for key, or None if it is not in the cache "
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            # not being able to record the access only affects eviction order
+            pass
+        return path
+
+    def link_into(self, key, dest):
+        " links the cached output for key to dest.  Returns False if there was no cached output "
+        path = self.lookup(key)
+        if path is None:
+            return False
+        link_or_copy(path, dest)
+        return True
+
+    def store(self, key, output_file):
+        " adds output_file to the cache under key.  Writes go to a temp file first so readers never see a partial entry "
+        path = self._entry_path(key)
+        if os.path.exists(path):
+            return path
+        entry_dir = os.path.dirname(path)
+        if not os.path.exists(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir, prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(output_file, temp_path)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        if self.max_bytes is not None and self._eviction_due():
+            self.evict(self.max_bytes)
+        return path
+
+    def _eviction_due(self):
+        " returns True, and records the time, if no process has evicted from this cache in the last EVICT_INTERVAL seconds "
+        stamp = os.path.join(self.cache_dir, ".last-eviction")
+        try:
+            if time.time() - os.path.getmtime(stamp) < EVICT_INTERVAL:
+                return False
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        with open(stamp, "a"):
+            pass
+        os.utime(stamp, None)
+        return True
+
+    def _entries(self):
+        entries = []
+        if not os.path.exists(self.cache_dir):
+            return entries
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(prefix_dir, name)
+                try:
+                    s = os.stat(path)
+                except OSError:
+                    # removed by a concurrent eviction
+                    continue
+                entries.append((s.st_mtime, s.st_size, path))
+        return entries
+
+    def evict(self, max_bytes):
+        " removes the least recently used entries until the cache holds at most max_bytes.  Returns the number removed "
+        entries = self._entries()
+        total = sum([size for mtime, size, path in entries])
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        if removed > 0:
+            log.info("Evicted %d entries from result cache %s", removed, self.cache_dir)
+        return removed
@@ -0,0 +1,101 @@
+import time
+import heapq
+import logging
+
+log = logging.getLogger("monitor")
+
+# Decides how many of the free submission slots each run gets.  Runs with a higher priority are served first.  Runs
+# of the same priority share the slots in proportion to their share, counting the tasks they already have in flight,
+# so a small run gets its tasks in right away while a large run takes whatever is left.  A run which has had ready
+# tasks but got no slots for a while is treated as if its priority were higher, so nothing waits forever.
+
+# each interval a run spends waiting raises its effective priority by one
+AGING_INTERVAL = 10*60
+
+class FairShareScheduler(object):
+    def __init__(self, max_per_run=None, max_per_user=None, aging_interval=AGING_INTERVAL):
+        self.max_per_run = max_per_run
+        self.max_per_user = max_per_user
+        self.aging_interval = aging_interval
+        # run_id -> time it first had ready tasks but got no slots
+        self.waiting_since = {}
+        self.last_decision = dict(time=None, slots=0, runs=[])
+
+    def _effective_priority(self, run, now):
+        since = self.waiting_since.get(run['run_id'])
+        if since is None:
+            return run['priority']
+        return run['priority'] + int((now - since) / self.aging_interval)
+
+    def _run_limit(self, run):
+        " the most tasks this run may have in flight "
+        limits = [x for x in [run.get('max_running'), self.max_per_run] if x is not None]
+        if len(limits) == 0:
+            return None
+        return min(limits)
+
+    def allocate(self, runs, slots, now=None):
+        """ runs is a list of dict(run_id, owner, priority, share, max_running, ready, in_flight) with one entry for
+            each run with tasks ready or in flight.  Returns a dict of run_id -> number of ready tasks to submit """
+        if now is None:
+            now = time.time()
+
+        user_in_flight = {}
+        for run in runs:
+            user_in_flight[run['owner']] = user_in_flight.get(run['owner'], 0) + run['in_flight']
+
+        allocation = {}
+        remaining = {}
+        for run in runs:
+            allocation[run['run_id']] = 0
+            remaining[run['run_id']] = run['ready']
+            limit = self._run_limit(run)
+            if limit is not None:
+                remaining[run['run_id']] = max(0, min(run['ready'], limit - run['in_flight']))
+
+        tiers = {}
+        for run in runs:
+            if remaining[run['run_id']] > 0:
+                tiers.setdefault(self._effective_priority(run, now), []).append(run)
+
+        free = slots
+        for priority in sorted(tiers.keys(), reverse=True):
+            # hand out one slot at a time to the run with the fewest tasks in flight relative to its share
+            heap = [(float(run['in_flight']) / run['share'], run['run_id'], run) for run in tiers[priority]]
+            heapq.heapify(heap)
+            while free > 0 and len(heap) > 0:
+                load, run_id, run = heapq.heappop(heap)
+                if self.max_per_user is not None and user_in_flight[run['owner']] >= self.max_per_user:
+                    continue
+                allocation[run_id] += 1
+                remaining[run_id] -= 1
+                user_in_flight[run['owner']] += 1
+                free -= 1
+                if remaining[run_id] > 0:
+                    heapq.heappush(heap, (float(run['in_flight'] + allocation[run_id]) / run['share'], run_id, run))
+
+        decisions = []
+        for run in runs:
+            run_id = run['run_id']
+            if run['ready'] > 0 and allocation[run_id] == 0:
+                self.waiting_since.setdefault(run_id, now)
+            else:
+                self.waiting_since.pop(run_id, None)
+            decision = dict(run)
+            decision['effective_priority'] = self._effective_priority(run, now)
+            decision['allocated'] = allocation[run_id]
+            decision['waiting_seconds'] = now - self.waiting_since.get(run_id, now)
+            decisions.append(decision)
+
+        # forget runs which have nothing left to schedule
+        run_ids = set([run['run_id'] for run in runs])
+        for run_id in self.waiting_since.keys():
+            if run_id not in run_ids:
+                del self.waiting_since[run_id]
+
+        self.last_decision = dict(time=now, slots=slots, runs=decisions)
+        return dict([(run_id, count) for run_id, count in allocation.items() if count > 0])
+
+    def get_state(self):
+        " the inputs and outcome of the last allocation "
+        return self.last_decision
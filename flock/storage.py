@@ -0,0 +1,46 @@
+import os
+import errno
+import glob
+import logging
+
+log = logging.getLogger("flock")
+
+# Run state (marker files, inputs, outputs and logs) is addressed by absolute paths on a (shared) POSIX filesystem,
+# and wingman reads it through a LocalStorage so tests can substitute their own.
+
+class LocalStorage(object):
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def read(self, path, offset=0, length=None):
+        with open(path) as fd:
+            fd.seek(offset)
+            if length is None:
+                return fd.read()
+            return fd.read(length)
+
+    def write(self, path, content):
+        with open(path, "w") as fd:
+            fd.write(content)
+
+    def delete(self, path):
+        " removes path.  Does nothing if it doesn't exist "
+        try:
+            os.unlink(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def stat(self, path):
+        " returns dict(size, mtime, is_dir) "
+        s = os.stat(path)
+        return dict(size=s.st_size, mtime=s.st_mtime, is_dir=os.path.isdir(path))
+
+    def list_files(self, run_dir, wildcard):
+        " returns a list of dict(name, size, mtime, is_dir) for each path under run_dir matching wildcard "
+        result = []
+        for filename in glob.glob(os.path.join(run_dir, wildcard)):
+            record = self.stat(filename)
+            record['name'] = filename[len(run_dir)+1:]
+            result.append(record)
+        return result
@@ -0,0 +1,103 @@
+import os
+import time
+import json
+import resource
+import collections
+import storage as flock_storage
+
+# Per-phase resource accounting for a task.  execute_task.py (and execute_task.R, which writes the same format)
+# records one entry per phase into [task_dir]/timings.json and summarize_timings() aggregates them over a run.
+
+TIMINGS_FILE = "timings.json"
+METRICS = ["wall", "cpu", "read_bytes", "write_bytes", "peak_rss_kb"]
+
+def read_io_counters():
+    " returns (bytes read, bytes written) by this process so far, or (None, None) if not available "
+    try:
+        with open("/proc/self/io") as fd:
+            counters = dict([line.split(":") for line in fd.read().strip().split("\n")])
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+def process_start_time():
+    " returns the wall clock time this process started, or None if it can't be determined "
+    try:
+        with open("/proc/self/stat") as fd:
+            # skip past the command name which may contain spaces
+            fields = fd.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as fd:
+            uptime = float(fd.read().split()[0])
+        starttime = float(fields[19]) / os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+        return time.time() - uptime + starttime
+    except (IOError, IndexError, ValueError):
+        return None
+
+class PhaseTimer(object):
+    def __init__(self):
+        self.phases = []
+        self._start_phase()
+
+    def _start_phase(self):
+        self._wall = time.time()
+        self._cpu = cpu_time()
+        self._read, self._written = read_io_counters()
+
+    def record_startup(self):
+        " records the time from process start up until now as the 'startup' phase "
+        start = process_start_time()
+        wall = None
+        if start is not None:
+            wall = max(0.0, time.time() - start)
+        read, written = read_io_counters()
+        self.phases.append(dict(name="startup", wall=wall, cpu=cpu_time(), read_bytes=read, write_bytes=written,
+                                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        self._start_phase()
+
+    def end_phase(self, name):
+        read, written = read_io_counters()
+        def delta(end, start):
+            if end is None or start is None:
+                return None
+            return end - start
+        self.phases.append(dict(name=name, wall=time.time() - self._wall, cpu=cpu_time() - self._cpu,
+                                read_bytes=delta(read, self._read), write_bytes=delta(written, self._written),
+                                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        self._start_phase()
+
+    def to_json(self):
+        return json.dumps(dict(phases=self.phases))
+
+def percentile(sorted_values, p):
+    " percentile of a sorted list, taking the value at the index nearest to p% of the way from first to last "
+    if len(sorted_values) == 0:
+        return None
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def summarize_timings(task_full_paths, percentiles=(50, 90, 99, 100), storage=None):
+    """ reads timings.json from each task dir and returns a list of (phase, metric, task_count, [values at each
+        percentile]) in the order phases were first seen """
+    if storage is None:
+        storage = flock_storage.LocalStorage()
+    values = collections.OrderedDict()
+    for task_full_path in task_full_paths:
+        filename = os.path.join(task_full_path, TIMINGS_FILE)
+        if not storage.exists(filename):
+            continue
+        phases = json.loads(storage.read(filename))["phases"]
+        for phase in phases:
+            for metric in METRICS:
+                value = phase.get(metric)
+                if value is not None:
+                    values.setdefault((phase["name"], metric), []).append(value)
+
+    result = []
+    for (phase, metric), phase_values in values.items():
+        phase_values.sort()
+        result.append((phase, metric, len(phase_values), [percentile(phase_values, p) for p in percentiles]))
+    return result
@@ -0,0 +1,39 @@
+from flock.backends import Backend, BackendRouter, parse_backend
+
+def make_router():
+    return BackendRouter([Backend("sge", "sge", 10, is_default=True),
+                          parse_backend("bigmem:local:max_submitted=2:min_mem=16000"),
+                          parse_backend("spare:lsf:max_submitted=5:max_mem=8000:overflow=1")])
+
+def test_parse_backend():
+    backend = parse_backend("bigmem:local:max_submitted=2:min_mem=16000", default_max_submitted=100)
+    assert (backend.name, backend.queue_type, backend.max_submitted, backend.min_mem, backend.overflow) == ("bigmem", "local", 2, 16000, False)
+    assert backend.external_id_prefix == "bigmem@PID:"
+    assert parse_backend("other:sge", default_max_submitted=100).max_submitted == 100
+    assert parse_backend("sge:sge", is_default=True).external_id_prefix == "SGE:"
+
+def test_backend_submit_options():
+    import mock
+    backend = parse_backend("bigmem:sge:submit_options=-q bigmem.q")
+    config = mock.Mock(qsub_options="-l h_vmem=4G", scatter_qsub_options=None, workdir="./")
+    config.name = "run"
+    queue = backend.create_queue(None, config)
+    assert queue.qsub_options == ["-l", "h_vmem=4G", "-q", "bigmem.q"]
+    assert queue.scatter_qsub_options == ["-q", "bigmem.q"]
+
+def test_route_by_memory_and_config():
+    router = make_router()
+    assert router.choose(None, 1000, {}).name == "sge"
+    assert router.choose(None, 32000, {}).name == "bigmem"
+    assert router.choose("spare", 32000, {}).name == "spare"
+    # a run which asked for a backend waits for it
+    assert router.choose("bigmem", 1000, {"bigmem": 2}) is None
+
+def test_overflow_to_free_backend():
+    router = make_router()
+    assert router.free_slots({"sge": 10, "bigmem": 1}) == 6
+    assert router.choose(None, 1000, {"sge": 10}).name == "spare"
+    # too big for the overflow backend
+    assert router.choose(None, 12000, {"sge": 10}) is None
+    assert router.find_backend("spare@LSF:12").name == "spare"
+    assert router.find_backend("SGE:12").name == "sge"
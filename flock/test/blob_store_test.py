@@ -0,0 +1,75 @@
+import flock.blob_store as blob_store
+import os
+import pickle
+import tempfile
+import shutil
+from nose import with_setup
+
+temp_dir = None
+
+def setup_temp_dir():
+    global temp_dir
+    temp_dir = tempfile.mkdtemp()
+
+def cleanup_temp_dir():
+    global temp_dir
+    shutil.rmtree(temp_dir)
+    temp_dir = None
+
+@with_setup(setup_temp_dir, cleanup_temp_dir)
+def test_identical_files_share_blob():
+    store = blob_store.BlobStore(os.path.join(temp_dir, "blobs"))
+    filenames = [os.path.join(temp_dir, "run%d" % i) for i in range(3)]
+    for filename in filenames:
+        with open(filename, "w") as fd:
+            fd.write("common state")
+
+    digests = set([store.put(filename) for filename in filenames])
+    assert len(digests) == 1
+    digest = digests.pop()
+    assert store.reference_count(digest) == 3
+    assert os.stat(filenames[0]).st_ino == os.stat(filenames[2]).st_ino
+
+    # nothing is reclaimed while a run still references the blob
+    os.unlink(filenames[0])
+    os.unlink(filenames[1])
+    assert store.collect_garbage() == 0
+    assert store.reference_count(digest) == 1
+
+    os.unlink(filenames[2])
+    assert store.collect_garbage() == len("common state")
+    assert store.reference_count(digest) == 0
+
+@with_setup(setup_temp_dir, cleanup_temp_dir)
+def test_put_pickle():
+    store = blob_store.BlobStore(os.path.join(temp_dir, "blobs"))
+    a = os.path.join(temp_dir, "a.pickle")
+    b = os.path.join(temp_dir, "b.pickle")
+
+    digest = store.put_pickle({"x": [1, 2, 3]}, a)
+    assert store.put_pickle({"x": [1, 2, 3]}, b) == digest
+    assert store.reference_count(digest) == 2
+    with open(b) as fd:
+        assert pickle.load(fd) == {"x": [1, 2, 3]}
+
+@with_setup(setup_temp_dir, cleanup_temp_dir)
+def test_put_rewrites_blob_collected_meanwhile():
+    import mock
+    store = blob_store.BlobStore(os.path.join(temp_dir, "blobs"))
+    filename = os.path.join(temp_dir, "run")
+    store.put_pickle({"a": 1}, os.path.join(temp_dir, "other"))
+    os.unlink(os.path.join(temp_dir, "other"))
+
+    # the blob is collected after put_pickle saw that it exists
+    real_link = os.link
+    collected = []
+    def link_after_gc(src, dst):
+        if dst == filename and not collected:
+            collected.append(store.collect_garbage())
+        return real_link(src, dst)
+    with mock.patch("os.link", link_after_gc):
+        digest = store.put_pickle({"a": 1}, filename)
+    assert collected[0] > 0
+    assert store.reference_count(digest) == 1
+    with open(filename) as fd:
+        assert pickle.load(fd) == {"a": 1}
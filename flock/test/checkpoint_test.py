@@ -0,0 +1,21 @@
+import flock.flock_support as flock_support
+import os
+import tempfile
+import shutil
+
+def test_save_and_load_checkpoint():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        per_task_state = dict(flock_checkpoint_file=os.path.join(temp_dir, flock_support.CHECKPOINT_FILE))
+        assert flock_support.load_checkpoint(per_task_state) is None
+
+        flock_support.save_checkpoint(per_task_state, dict(iteration=1))
+        flock_support.save_checkpoint(per_task_state, dict(iteration=2))
+        assert flock_support.load_checkpoint(per_task_state) == dict(iteration=2)
+        # nothing is left behind from writing it
+        assert os.listdir(temp_dir) == [flock_support.CHECKPOINT_FILE]
+
+        flock_support.remove_checkpoint(per_task_state)
+        assert flock_support.load_checkpoint(per_task_state) is None
+    finally:
+        shutil.rmtree(temp_dir)
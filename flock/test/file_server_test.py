@@ -0,0 +1,63 @@
+import flock.wingman as wingman
+import flock.file_server as file_server
+import os
+import gzip
+import httplib
+import urllib
+import tempfile
+import shutil
+import StringIO
+
+def test_parse_range():
+    assert file_server.parse_range(None, 100) is None
+    assert file_server.parse_range("bytes=10-19", 100) == (10, 10)
+    assert file_server.parse_range("bytes=90-", 100) == (90, 10)
+    assert file_server.parse_range("bytes=90-200", 100) == (90, 10)
+    assert file_server.parse_range("bytes=-30", 100) == (70, 30)
+    assert file_server.parse_range("bytes=0-1,5-6", 100) is None
+    try:
+        file_server.parse_range("bytes=100-", 100)
+        assert False
+    except ValueError:
+        pass
+
+def test_serve_run_files():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        run_dir = os.path.join(temp_dir, "files")
+        os.makedirs(run_dir)
+        content = "".join(["line %d\n" % i for i in range(100000)])
+        with open(os.path.join(run_dir, "log.txt"), "w") as fd:
+            fd.write(content)
+
+        store = wingman.TaskStore(os.path.join(temp_dir, "db"), "flock_home", endpoint_url="http://invalid:2000")
+        store.run_created(run_dir, "name", "config", "{}")
+        server = file_server.start_file_server(store, 0)
+        try:
+            def get(path, headers={}):
+                connection = httplib.HTTPConnection("localhost", server.server_address[1])
+                connection.request("GET", "/files?" + urllib.urlencode(dict(run_dir=run_dir, path=path)), headers=headers)
+                response = connection.getresponse()
+                return response, response.read()
+
+            response, body = get("log.txt")
+            assert response.status == 200 and body == content
+
+            response, body = get("log.txt", {"Range": "bytes=7-13"})
+            assert response.status == 206
+            assert response.getheader("Content-Range") == "bytes 7-13/%d" % len(content)
+            assert body == content[7:14]
+
+            response, body = get("log.txt", {"Accept-Encoding": "gzip"})
+            assert response.getheader("Content-Encoding") == "gzip"
+            assert len(body) < len(content)
+            assert gzip.GzipFile(fileobj=StringIO.StringIO(body)).read() == content
+
+            response, body = get("log.txt", {"Range": "bytes=%d-" % len(content)})
+            assert response.status == 416
+            assert get("../db")[0].status == 404
+            assert get("missing.txt")[0].status == 404
+        finally:
+            server.shutdown()
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,34 @@
+import flock.heartbeat as heartbeat
+import flock.watch_proc as watch_proc
+import os
+import socket
+
+def test_silent_tasks_found_after_missed_beats():
+    monitor = heartbeat.HeartbeatMonitor(interval=5, missed_beats=3)
+    assert monitor.handle_datagram("hb 1 node01 1.5 100 50", now=0)
+    assert monitor.handle_datagram("hb 2 node02 NA NA NA", now=0)
+    assert not monitor.handle_datagram("garbage", now=0)
+    monitor.beat("1", "node01", now=10)
+
+    assert monitor.find_silent_tasks(now=14) == []
+    assert monitor.find_silent_tasks(now=16) == [("2", "node02")]
+    assert [(s['task'], s['age'], s['cpu']) for s in monitor.get_state(now=16)] == [("1", 6, None)]
+    assert monitor.find_silent_tasks(now=26) == [("1", "node01")]
+    assert monitor.get_state(now=26) == []
+
+    assert monitor.handle_datagram("hb 3 node01 1.5 100 50 20", now=30)
+    assert monitor.get_state(now=30)[0]['checkpoint_age'] == 10
+
+def test_watch_proc_sends_heartbeats():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(5)
+    try:
+        sender = watch_proc.Heartbeat("127.0.0.1:%d" % sock.getsockname()[1], "7", 5)
+        sender.send(os.getpid())
+        monitor = heartbeat.HeartbeatMonitor()
+        assert monitor.handle_datagram(sock.recv(heartbeat.MAX_DATAGRAM), now=0)
+        state = monitor.get_state(now=0)
+        assert state[0]['task'] == "7" and state[0]['rss'] > 0
+    finally:
+        sock.close()
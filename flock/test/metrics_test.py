@@ -0,0 +1,61 @@
+import flock.metrics as metrics
+import flock.wingman as wingman
+
+def test_render_counters_and_histograms():
+    registry = metrics.Registry()
+    calls = registry.counter("calls_total", "Calls", ["method"])
+    seconds = registry.histogram("call_seconds", "Call time", ["method"], buckets=(0.1, 1))
+    registry.gauge_function("tasks", "Tasks", ["status"], lambda: [(("READY",), 3)])
+
+    calls.inc(1, "get_runs")
+    calls.inc(2, "get_runs")
+    seconds.observe(0.05, "get_runs")
+    seconds.observe(0.5, "get_runs")
+    seconds.observe(5, "get_runs")
+
+    text = registry.render()
+    assert 'calls_total{method="get_runs"} 3\n' in text
+    assert 'call_seconds_bucket{method="get_runs",le="0.1"} 1\n' in text
+    assert 'call_seconds_bucket{method="get_runs",le="1"} 2\n' in text
+    assert 'call_seconds_bucket{method="get_runs",le="+Inf"} 3\n' in text
+    assert 'call_seconds_count{method="get_runs"} 3\n' in text
+    assert 'tasks{status="READY"} 3\n' in text
+    assert "# TYPE call_seconds histogram\n" in text
+
+def test_rpc_calls_counted():
+    def failing_call():
+        raise Exception("expected")
+    def get_version():
+        return "1"
+
+    before = wingman.RPC_CALLS.get("get_version", "ok")
+    assert wingman.make_function_wrapper(get_version, sample=0)() == "1"
+    assert wingman.RPC_CALLS.get("get_version", "ok") == before + 1
+
+    errors_before = wingman.RPC_CALLS.get("failing_call", "error")
+    count_before = wingman.RPC_SECONDS.get_count("failing_call")
+    wrapped = wingman.make_function_wrapper(failing_call, sample=0)
+    try:
+        wrapped()
+        assert False
+    except Exception:
+        pass
+    assert wingman.RPC_CALLS.get("failing_call", "error") == errors_before + 1
+    assert wingman.RPC_SECONDS.get_count("failing_call") == count_before + 1
+
+def test_heavy_calls_fail_fast_when_busy():
+    import threading
+    import xmlrpclib
+    def get_run_files():
+        return []
+    semaphore = threading.Semaphore(1)
+    wrapped = wingman.make_function_wrapper(get_run_files, semaphore, sample=0)
+
+    semaphore.acquire()
+    try:
+        wrapped()
+        assert False
+    except xmlrpclib.Fault as ex:
+        assert ex.faultCode == wingman.BUSY_FAULT
+    semaphore.release()
+    assert wrapped() == []
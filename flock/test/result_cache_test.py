@@ -0,0 +1,117 @@
+import flock.result_cache as result_cache
+import flock.flock_support as flock_support
+import os
+import time
+import pickle
+import tempfile
+import shutil
+from nose import with_setup
+
+temp_dir = None
+
+def setup_temp_dir():
+    global temp_dir
+    temp_dir = tempfile.mkdtemp()
+
+def cleanup_temp_dir():
+    global temp_dir
+    shutil.rmtree(temp_dir)
+    temp_dir = None
+
+def write_file(filename, content):
+    with open(filename, "w") as fd:
+        fd.write(content)
+
+def read_file(filename):
+    with open(filename) as fd:
+        return fd.read()
+
+def test_task_key():
+    key = result_cache.compute_task_key(["path"], "module", "fn", None, "digest", {"x": 1})
+    assert key == result_cache.compute_task_key(["path"], "module", "fn", None, "digest", {"x": 1})
+    assert key != result_cache.compute_task_key(["path"], "module", "fn", None, "digest", {"x": 2})
+    assert key != result_cache.compute_task_key(["path"], "module", "fn", "v2", "digest", {"x": 1})
+    assert key != result_cache.compute_task_key(["path"], "module", "fn", None, "other", {"x": 1})
+
+@with_setup(setup_temp_dir, cleanup_temp_dir)
+def test_store_and_link():
+    cache = result_cache.ResultCache(os.path.join(temp_dir, "cache"))
+    output = os.path.join(temp_dir, "output")
+    write_file(output, "result")
+
+    assert cache.lookup("abcd") is None
+    cache.store("abcd", output)
+    assert cache.lookup("abcd") is not None
+
+    dest = os.path.join(temp_dir, "dest")
+    assert cache.link_into("abcd", dest)
+    assert read_file(dest) == "result"
+    assert not cache.link_into("ef01", os.path.join(temp_dir, "other"))
+
+@with_setup(setup_temp_dir, cleanup_temp_dir)
+def test_evict_least_recently_used():
+    cache = result_cache.ResultCache(os.path.join(temp_dir, "cache"))
+    output = os.path.join(temp_dir, "output")
+    write_file(output, "0123456789")
+
+    now = time.time()
+    for i, key in enumerate(["aa01", "bb02", "cc03"]):
+        path = cache.store(key, output)
+        os.utime(path, (now - 100 + i, now - 100 + i))
+
+    assert cache.evict(20) == 1
+    assert cache.lookup("aa01") is None
+    assert cache.lookup("bb02") is not None
+    assert cache.lookup("cc03") is not None
+
+@with_setup(setup_temp_dir, cleanup_temp_dir)
+def test_store_evicts_at_most_once_per_interval():
+    cache = result_cache.ResultCache(os.path.join(temp_dir, "cache"), max_bytes=5)
+    output = os.path.join(temp_dir, "output")
+    write_file(output, "0123456789")
+
+    # the first store evicts (including the entry just stored, which is over max_bytes on its own)
+    cache.store("aa01", output)
+    assert cache.lookup("aa01") is None
+    # the next is within EVICT_INTERVAL of that, so the cache isn't walked again
+    cache.store("bb02", output)
+    assert cache.lookup("bb02") is not None
+
+    stamp = os.path.join(temp_dir, "cache", ".last-eviction")
+    old = time.time() - result_cache.EVICT_INTERVAL - 1
+    os.utime(stamp, (old, old))
+    cache.store("cc03", output)
+    assert cache.lookup("bb02") is None
+
+@with_setup(setup_temp_dir, cleanup_temp_dir)
+def test_flock_run_uses_cache():
+    run_dir = os.path.join(temp_dir, "run")
+    cache_dir = os.path.join(temp_dir, "cache")
+    settings = dict(python_path="python", flock_home="flock_home", flock_run_dir=run_dir, flock_test_job_count=None,
+                    flock_notify_command=None)
+
+    # populate the cache with the result of the task with input 1
+    flock_support.flock_run([1, 2, 1], [], "module:fn", flock_settings=settings, result_cache_dir=cache_dir)
+    with open(os.path.join(run_dir, "tasks", "0", "input.pickle")) as fd:
+        key = pickle.load(fd)['flock_cache_key']
+
+    # the third task is identical to the first, so it is not submitted and the first task will fill it in
+    with open(os.path.join(run_dir, "tasks", "task_dirs.txt")) as fd:
+        assert fd.read() == "1 tasks/0\n1 tasks/1\n"
+    with open(os.path.join(run_dir, "tasks", "0", "input.pickle")) as fd:
+        assert pickle.load(fd)['flock_duplicate_job_dirs'] == [os.path.join(run_dir, "tasks", "2")]
+
+    write_file(os.path.join(temp_dir, "output"), "cached")
+    result_cache.ResultCache(cache_dir).store(key, os.path.join(temp_dir, "output"))
+
+    # a second run with the same inputs finds the result without running the task
+    run_dir = os.path.join(temp_dir, "run2")
+    settings['flock_run_dir'] = run_dir
+    flock_support.flock_run([1, 2, 1], [], "module:fn", flock_settings=settings, result_cache_dir=cache_dir)
+    for task in ["0", "2"]:
+        assert os.path.exists(os.path.join(run_dir, "tasks", task, "finished-time.txt"))
+        assert read_file(os.path.join(run_dir, "tasks", task, "output.pickle")) == "cached"
+    assert not os.path.exists(os.path.join(run_dir, "tasks", "1", "finished-time.txt"))
+    # only the task which wasn't in the cache is submitted
+    with open(os.path.join(run_dir, "tasks", "task_dirs.txt")) as fd:
+        assert fd.read() == "1 tasks/1\n"
@@ -0,0 +1,34 @@
+import flock.scheduler as scheduler
+
+def make_run(run_id, ready, in_flight=0, priority=0, share=1.0, owner="user", max_running=None):
+    return dict(run_id=run_id, owner=owner, priority=priority, share=share, max_running=max_running, ready=ready, in_flight=in_flight)
+
+def test_small_run_not_starved_by_large_run():
+    s = scheduler.FairShareScheduler()
+    allocation = s.allocate([make_run(1, 100000, in_flight=50), make_run(2, 5)], 10, now=0)
+    assert allocation == {1: 5, 2: 5}
+
+def test_shares_and_priorities():
+    s = scheduler.FairShareScheduler()
+    allocation = s.allocate([make_run(1, 100, share=3.0), make_run(2, 100)], 8, now=0)
+    assert allocation == {1: 6, 2: 2}
+
+    allocation = s.allocate([make_run(1, 100), make_run(2, 3, priority=1)], 8, now=0)
+    assert allocation == {1: 5, 2: 3}
+
+def test_caps():
+    s = scheduler.FairShareScheduler(max_per_user=4)
+    allocation = s.allocate([make_run(1, 100, max_running=2), make_run(2, 100, in_flight=1), make_run(3, 100, owner="other")], 10, now=0)
+    assert allocation == {1: 2, 2: 1, 3: 4}
+
+def test_waiting_runs_age():
+    s = scheduler.FairShareScheduler(aging_interval=60)
+    runs = [make_run(1, 100, priority=1), make_run(2, 100)]
+    assert s.allocate(runs, 1, now=0) == {1: 1}
+    assert s.allocate(runs, 1, now=30) == {1: 1}
+
+    # after waiting a full interval, run 2 is treated as the same priority as run 1, and has fewer in flight
+    runs[0]['in_flight'] = 2
+    assert s.allocate(runs, 1, now=60) == {2: 1}
+    state = s.get_state()
+    assert [(r['run_id'], r['effective_priority'], r['allocated']) for r in state['runs']] == [(1, 1, 0), (2, 0, 1)]
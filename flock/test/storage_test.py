@@ -0,0 +1,23 @@
+import flock.storage as storage
+import os
+import tempfile
+import shutil
+
+def test_local_storage():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        s = storage.LocalStorage()
+        os.makedirs(os.path.join(temp_dir, "tasks", "1"))
+        s.write(os.path.join(temp_dir, "tasks", "1", "finished-time.txt"), "done")
+        assert s.exists(os.path.join(temp_dir, "tasks", "1", "finished-time.txt"))
+        assert s.read(os.path.join(temp_dir, "tasks", "1", "finished-time.txt"), 1, 2) == "on"
+
+        files = s.list_files(temp_dir, "tasks/*")
+        assert [(f['name'], f['is_dir']) for f in files] == [("tasks/1", True)]
+
+        s.delete(os.path.join(temp_dir, "tasks", "1", "finished-time.txt"))
+        assert not s.exists(os.path.join(temp_dir, "tasks", "1", "finished-time.txt"))
+        # deleting something already gone is not an error
+        s.delete(os.path.join(temp_dir, "tasks", "1", "finished-time.txt"))
+    finally:
+        shutil.rmtree(temp_dir)
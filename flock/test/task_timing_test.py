@@ -0,0 +1,35 @@
+import flock.task_timing as task_timing
+import os
+import json
+import tempfile
+import shutil
+
+def test_phase_timer():
+    timer = task_timing.PhaseTimer()
+    timer.record_startup()
+    sum(range(10000))
+    timer.end_phase("run")
+
+    phases = json.loads(timer.to_json())["phases"]
+    assert [p["name"] for p in phases] == ["startup", "run"]
+    for phase in phases:
+        assert phase["wall"] >= 0
+        assert phase["peak_rss_kb"] > 0
+
+def test_summarize_timings():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        task_dirs = []
+        for i in range(1, 11):
+            task_dir = os.path.join(temp_dir, str(i))
+            os.makedirs(task_dir)
+            with open(os.path.join(task_dir, "timings.json"), "w") as fd:
+                fd.write(json.dumps(dict(phases=[dict(name="run", wall=float(i), cpu=None)])))
+            task_dirs.append(task_dir)
+        # tasks which haven't run yet have no timings
+        task_dirs.append(os.path.join(temp_dir, "missing"))
+
+        summary = task_timing.summarize_timings(task_dirs)
+        assert summary == [("run", "wall", 10, [6.0, 9.0, 10.0, 10.0])]
+    finally:
+        shutil.rmtree(temp_dir)
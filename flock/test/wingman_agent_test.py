@@ -0,0 +1,71 @@
+import flock.wingman_agent as wingman_agent
+import os
+import tempfile
+import shutil
+import socket
+
+def spool_event(spool_dir, name, fields):
+    with open(os.path.join(spool_dir, name + ".event"), "w") as fd:
+        fd.write("\t".join(fields) + "\n")
+
+class RecordingService(object):
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    def tasks_updated(self, events):
+        if self.fail:
+            raise socket.error("connection refused")
+        self.batches.append(events)
+        return True
+
+def test_forward_events_in_order():
+    spool_dir = tempfile.mkdtemp()
+    try:
+        spool_event(spool_dir, "1000-node01-1", ["started", "/run/tasks/1", "node01"])
+        spool_event(spool_dir, "1001-node01-2", ["completed", "/run/tasks/1", "node01"])
+        # partially written events are not picked up
+        with open(os.path.join(spool_dir, ".1002-node01-3"), "w") as fd:
+            fd.write("started\t/run/tasks/2")
+
+        service = RecordingService()
+        assert wingman_agent.forward_events(spool_dir, service) == 2
+        assert service.batches == [[["started", "/run/tasks/1", "node01"], ["completed", "/run/tasks/1", "node01"]]]
+        assert os.listdir(spool_dir) == [".1002-node01-3"]
+    finally:
+        shutil.rmtree(spool_dir)
+
+def test_events_kept_until_delivered():
+    spool_dir = tempfile.mkdtemp()
+    try:
+        spool_event(spool_dir, "1000-node01-1", ["failed", "/run/tasks/1", "node01"])
+        try:
+            wingman_agent.forward_events(spool_dir, RecordingService(fail=True))
+            assert False, "expected failure"
+        except socket.error:
+            pass
+        assert os.listdir(spool_dir) == ["1000-node01-1.event"]
+
+        service = RecordingService()
+        assert wingman_agent.forward_events(spool_dir, service) == 1
+        assert os.listdir(spool_dir) == []
+    finally:
+        shutil.rmtree(spool_dir)
+
+def test_rejected_batch_set_aside():
+    import mock
+    import xmlrpclib
+    spool_dir = tempfile.mkdtemp()
+    try:
+        spool_event(spool_dir, "1000-node01-1", ["bogus", "/run/tasks/1", "node01"])
+        proxy = mock.Mock()
+        proxy.tasks_updated.side_effect = xmlrpclib.Fault(1, "unknown event")
+        with mock.patch("xmlrpclib.ServerProxy", return_value=proxy):
+            with mock.patch("time.sleep"):
+                wingman_agent.run_agent(spool_dir, "http://invalid:3010", idle_timeout=0.1)
+        assert proxy.tasks_updated.call_count == wingman_agent.MAX_FAULTS
+        assert os.listdir(os.path.join(spool_dir, "rejected")) == ["1000-node01-1.event"]
+        # the agent gave up its lock and pid file when it went idle
+        assert not os.path.exists(os.path.join(spool_dir, "agent.pid"))
+    finally:
+        shutil.rmtree(spool_dir)
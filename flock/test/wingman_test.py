@@ -1,4 +1,5 @@
 import flock.wingman as wingman
+from flock.backends import Backend, BackendRouter
 import os
 import tempfile
 import shutil
@@ -38,6 +39,9 @@ def cleanup_run_dir():
 
     global temp_db
     os.unlink(temp_db)
+    for suffix in ["-wal", "-shm"]:
+        if os.path.exists(temp_db + suffix):
+            os.unlink(temp_db + suffix)
     print "deleting %s" % temp_db
     temp_db = None
 
@@ -157,3 +161,528 @@ def test_file_ops():
     import base64
     file_content = store.get_file_content(run_dir, "sample", 0, 10000)
     assert base64.standard_b64decode(file_content['data']) == "test-text"
+
+def create_run_with_tasks(store, task_count, group_count=1):
+    " registers a run with task_count tasks per group directly, without running a scatter "
+    store.run_created(run_dir, "name", config_path, "{}")
+    os.makedirs(run_dir)
+    task_definition_path = os.path.join(run_dir, "task_dirs.txt")
+    with open(task_definition_path, "w") as fd:
+        for group in range(1, group_count+1):
+            for i in range(task_count):
+                fd.write("%d tasks/%d-%d\n" % (group, group, i))
+    return store.taskset_created(run_dir, task_definition_path)
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_concurrent_updates_are_batched():
+    import threading
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000", group_commit_delay=0.05)
+    task_dirs = create_run_with_tasks(store, 20)
+
+    with store.transaction() as db:
+        db.execute("PRAGMA journal_mode")
+        assert db.fetchall()[0][0] == "wal"
+
+    threads = [threading.Thread(target=store.task_started, args=(task_dir, "node01")) for task_dir in task_dirs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    runs = store.get_runs()
+    assert runs[0]['status']['STARTED'] == 20
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_failed_update_in_batch_is_undone():
+    import threading
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000", group_commit_delay=0.05)
+    create_run_with_tasks(store, 2)
+    def bad_update(db):
+        db.execute("UPDATE TASKS SET node_name = 'bad' WHERE task_id = 1")
+        raise Exception("expected")
+    def good_update(db):
+        db.execute("UPDATE TASKS SET node_name = 'good' WHERE task_id = 2")
+        return True
+    errors = []
+    def run_bad():
+        try:
+            store._updates.execute(bad_update)
+        except Exception as ex:
+            errors.append(ex)
+    threads = [threading.Thread(target=run_bad), threading.Thread(target=lambda: store._updates.execute(good_update))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert [str(ex) for ex in errors] == ["expected"]
+    assert [t['node_name'] for t in store.get_run_tasks(run_dir)] == [None, "good"]
+
+def test_pooled_server_handles_calls_concurrently():
+    import threading
+    import xmlrpclib
+
+    release_slow_call = threading.Event()
+    def slow():
+        release_slow_call.wait(10)
+        return "slow"
+    def fast():
+        return "fast"
+
+    server = wingman.PooledXMLRPCServer(("localhost", 0), 2, allow_none=True, logRequests=False)
+    server.register_function(slow, "slow")
+    server.register_function(fast, "fast")
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url = "http://localhost:%d" % server.server_address[1]
+
+    try:
+        results = []
+        slow_thread = threading.Thread(target=lambda: results.append(xmlrpclib.ServerProxy(url).slow()))
+        slow_thread.start()
+
+        # the fast call completes while the slow call is still blocked
+        assert xmlrpclib.ServerProxy(url).fast() == "fast"
+        assert results == []
+
+        release_slow_call.set()
+        slow_thread.join()
+        assert results == ["slow"]
+    finally:
+        release_slow_call.set()
+        server.shutdown()
+        server.server_close()
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_tasks_updated_in_bulk():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 3)
+
+    store.tasks_updated([["started", task_dirs[0], "node01"], ["started", task_dirs[1], "node01"], ["started", task_dirs[2], "node02"],
+                         ["completed", task_dirs[0], "node01"], ["failed", task_dirs[1], "node01"]])
+
+    status = store.get_runs()[0]['status']
+    assert status == {"COMPLETED": 1, "FAILED": 1, "STARTED": 1}
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_groups_released_when_prerequisites_finish():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 2, group_count=3)
+
+    # only the first group can start
+    assert store.release_waiting_tasks() == 2
+    assert store.get_runs()[0]['status'] == {"READY": 2, "WAITING": 4}
+
+    # the second group is released as soon as the last task in the first completes
+    store.task_completed(task_dirs[0])
+    assert store.get_runs()[0]['status'] == {"COMPLETED": 1, "READY": 1, "WAITING": 4}
+    store.task_completed(task_dirs[1])
+    assert store.get_runs()[0]['status'] == {"COMPLETED": 2, "READY": 2, "WAITING": 2}
+
+    # a failure in the second group fails everything after it
+    store.task_failed(task_dirs[2])
+    store.task_completed(task_dirs[3])
+    assert store.get_runs()[0]['status'] == {"COMPLETED": 3, "FAILED": 1, "PREREQ_FAILED": 2}
+    assert store.release_waiting_tasks() == 0
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_status_counts_follow_transitions():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 2, group_count=2)
+    store.release_waiting_tasks()
+    store.task_submitted(task_dirs[0], "1")
+    store.task_started(task_dirs[1], "node01")
+    store.task_completed(task_dirs[1])
+
+    assert store.count_tasks_by_status(wingman.SUBMITTED) == 1
+    assert store.count_tasks_by_status(wingman.KILLED) == 0
+    assert dict(store.count_tasks_by_group_number(1)) == {1: [1, 0, 1, 0], 2: [0, 0, 0, 2]}
+
+    # counts are rebuilt from TASKS for a database which predates the counters table
+    with store.transaction() as db:
+        db.execute("DROP TABLE STATUS_COUNTS")
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    assert store.get_runs()[0]['status'] == {"SUBMITTED": 1, "COMPLETED": 1, "WAITING": 2}
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_tasks_identified_by_id():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 2)
+    tasks = store.get_run_tasks(run_dir)
+    assert [t['task_dir'] for t in tasks] == task_dirs
+
+    # notifications carry the task id as a string, older tasks send their full path
+    store.task_started(str(tasks[0]['task_id']), "node01")
+    store.task_started(task_dirs[1], "node01")
+    assert store.get_runs()[0]['status'] == {"STARTED": 2}
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_migrate_to_task_ids():
+    import sqlite3
+    import mock
+    db = sqlite3.connect(temp_db)
+    db.execute("CREATE TABLE TASKS (run_id INTEGER, task_dir STRING primary key, status INTEGER, try_count INTEGER, node_name STRING, external_id STRING, group_number INTEGER )")
+    db.execute("CREATE INDEX IDX_TASK_DIR ON TASKS (task_dir)")
+    db.execute("CREATE TABLE RUNS (run_id integer primary key autoincrement, run_dir STRING UNIQUE, name STRING, flock_config_path STRING, parameters STRING, required_mem_override INTEGER)")
+    db.execute("INSERT INTO RUNS (run_dir, name) VALUES (?, 'name')", [run_dir])
+    db.execute("INSERT INTO TASKS VALUES (1, ?, ?, 1, 'node01', 'sge:1', 1)", [run_dir + "/tasks/0", wingman.STARTED])
+    db.execute("INSERT INTO TASKS VALUES (1, ?, ?, 0, NULL, NULL, 1)", [run_dir + "/tasks/1", wingman.READY])
+    db.commit()
+    db.close()
+
+    # a migration which fails after dropping the old table leaves it in place
+    failing = wingman.MIGRATE_TO_TASK_IDS_STATEMENTS[:-len(wingman.TASKS_INDEX_STATEMENTS)-1] + ["SELECT * FROM NO_SUCH_TABLE"]
+    try:
+        with mock.patch.object(wingman, "MIGRATE_TO_TASK_IDS_STATEMENTS", failing):
+            wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+        assert False
+    except sqlite3.OperationalError:
+        pass
+    db = sqlite3.connect(temp_db)
+    assert db.execute("SELECT count(*) FROM TASKS WHERE task_dir IS NOT NULL").fetchall() == [(2,)]
+    db.close()
+
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    tasks = store.get_run_tasks(run_dir)
+    assert [(t['task_dir'], t['status'], t['external_id']) for t in tasks] == [(run_dir + "/tasks/0", "STARTED", "sge:1"), (run_dir + "/tasks/1", "READY", None)]
+    assert store.get_runs()[0]['status'] == {"STARTED": 1, "READY": 1}
+
+    store.task_completed(run_dir + "/tasks/0")
+    assert store.get_runs()[0]['status'] == {"COMPLETED": 1, "READY": 1}
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_archive_finished_runs():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 2)
+    store.task_completed(task_dirs[0])
+    assert store.archive_finished_runs(100, now=1000) == 0
+
+    # the run becomes eligible once it has been finished for long enough
+    store.task_failed(task_dirs[1])
+    assert store.archive_finished_runs(100, now=1000) == 0
+    assert store.archive_finished_runs(100, now=1100) == 1
+    assert store.find_tasks_by_status(wingman.COMPLETED) == []
+
+    # only the counts stay in the hot tables, but the tasks can still be listed
+    assert store.get_runs()[0]['status'] == {"COMPLETED": 1, "FAILED": 1}
+    assert [(t['task_dir'], t['status']) for t in store.get_run_tasks(run_dir)] == [(task_dirs[0], "COMPLETED"), (task_dirs[1], "FAILED")]
+
+    # retrying brings the tasks back
+    store.retry_run(run_dir)
+    assert store.get_runs()[0]['status'] == {"COMPLETED": 1, "WAITING": 1}
+    assert len(store.find_tasks_by_status(wingman.WAITING)) == 1
+    assert store.archive_finished_runs(100, now=2000) == 0
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_run_tasks_paged_and_filtered():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 3, group_count=2)
+    for task_dir in task_dirs[:5]:
+        store.task_completed(task_dir)
+    store.task_failed(task_dirs[5])
+
+    def check_pages():
+        page = store.get_run_tasks_page(run_dir, 1, 2)
+        assert (page['total'], page['status']) == (6, {"COMPLETED": 5, "FAILED": 1})
+        assert [(t['path'], t['status']) for t in wingman.unpack_columns(page['tasks'])] == [("tasks/1-1", "COMPLETED"), ("tasks/1-2", "COMPLETED")]
+
+        page = store.get_run_tasks_page(run_dir, 0, 10, "FAILED", 2)
+        assert [t['path'] for t in wingman.unpack_columns(page['tasks'])] == ["tasks/2-2"]
+        summary = store.get_run_tasks_page(run_dir, 0, 10, ["COMPLETED"], 2, None, True)
+        assert (summary['total'], summary['tasks']) == (2, None)
+
+    check_pages()
+    # archived runs are paged the same way
+    assert store.archive_finished_runs(0, now=10**10) == 1
+    check_pages()
+
+    page = store.get_runs_page(0, 10, True)
+    assert page['total'] == 1
+    assert wingman.unpack_columns(page['runs']) == [dict(run_dir=run_dir, name="name", status={"COMPLETED": 5, "FAILED": 1})]
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_schedulable_runs():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 3)
+    store.set_run_schedule(run_dir, 2, 0.5, 10)
+    store.release_waiting_tasks()
+    store.task_started(task_dirs[0], "node01")
+
+    runs = store.get_schedulable_runs()
+    assert [(r['priority'], r['share'], r['max_running'], r['ready'], r['in_flight']) for r in runs] == [(2, 0.5, 10, 2, 1)]
+    assert [t[2] for t in store.find_ready_tasks(runs[0]['run_id'], 1)] == [task_dirs[1]]
+
+def write_proc_stats(task_dir, rss_samples):
+    os.makedirs(task_dir)
+    with open(os.path.join(task_dir, "proc_stats.txt"), "w") as fd:
+        fd.write("state timestamp utime stime vsizeMB rssMB\n")
+        for rss in rss_samples:
+            fd.write("r 0 0 0 10 %d\n" % rss)
+        fd.write("s(0) 0 NA NA NA NA\n")
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_memory_requests_learned_from_completed_tasks():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 7)
+    run_id = 1
+    for i, task_dir in enumerate(task_dirs[:5]):
+        write_proc_stats(task_dir, [100, 1000 + i*100])
+        store.task_completed(task_dir)
+
+    assert store.get_memory_estimate(run_id) is None
+    assert store.sample_memory_usage() == 5
+    assert store.get_memory_estimate(run_id) == int(1300 * (1 + wingman.MEM_MARGIN))
+
+    # a task which fails near its request gets more on its next attempt
+    store.set_task_mem_request(6, 1000)
+    write_proc_stats(task_dirs[5], [950])
+    store.task_failed(task_dirs[5])
+    assert store.sample_memory_usage() == 1
+    store.retry_run(run_dir)
+    store.release_waiting_tasks()
+    mem_requests = dict([(t[1], t[4]) for t in store.find_ready_tasks(run_id, 10)])
+    assert mem_requests[6] == 2000
+    assert wingman.choose_mem_request(None, 1560, mem_requests[6]) == 2000
+    assert wingman.choose_mem_request(None, 1560, None) == 1560
+    assert wingman.choose_mem_request(4000, 1560, None) == 4000
+    # an explicit override wins even when it is lower than the task's previous request
+    assert wingman.choose_mem_request(500, 1560, mem_requests[6]) == 500
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_job_exits_read_from_accounting_file():
+    from flock.queue import accounting
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 3)
+    for i, task_dir in enumerate(task_dirs):
+        store.task_submitted(task_dir, "SGE:%d" % (100 + i))
+    store.task_started(task_dirs[2], "node01")
+
+    accounting_path = os.path.join(temp_dir, "accounting")
+    with open(accounting_path, "w") as fd:
+        fd.write("# Version: 2011.11\n")
+    tail = accounting.AccountingFileTail(accounting_path, accounting.parse_sge_accounting_line)
+    assert wingman.read_accounting_file(store, tail, "SGE:") == 0
+
+    # the first task wrote its marker, the second was killed for exceeding its memory, the third is still running
+    os.makedirs(task_dirs[0])
+    with open(os.path.join(task_dirs[0], "finished-time.txt"), "w") as fd:
+        fd.write("done")
+    with open(accounting_path, "a") as fd:
+        fd.write("all.q:node01:users:u:t0:100:sge:0:0:0:0:0:0:12" + ":0" * 28 + ":1000000000:0:0\n")
+        fd.write("all.q:node01:users:u:t1:101:sge:0:0:0:0:37:137:30" + ":0" * 28 + ":4000000000:0:0\n")
+    assert wingman.read_accounting_file(store, tail, "SGE:") == 2
+
+    tasks = store.get_run_tasks(run_dir)
+    assert [t['status'] for t in tasks] == ["COMPLETED", "FAILED", "STARTED"]
+    with store.transaction() as db:
+        db.execute("SELECT exit_status, failure_reason, wall_time, max_vmem_mb FROM TASKS WHERE external_id = 'SGE:101'")
+        assert db.fetchall() == [(137, "qmaster enforced h_rt, h_cpu or h_vmem limit", 30.0, 4000.0)]
+    assert wingman.read_accounting_file(store, tail, "SGE:") == 0
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_kill_run_in_bulk():
+    import mock
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 3)
+    for i, task_dir in enumerate(task_dirs):
+        store.task_submitted(task_dir, "SGE:%d" % i)
+    store.kill_run(run_dir)
+
+    queue = mock.Mock(external_id_prefix="SGE:")
+    queue.kill_by_name.return_value = True
+    other_queue = mock.Mock(external_id_prefix="bigmem@PID:")
+    assert wingman.handle_kill_pending_tasks(store, [queue, other_queue], kill_by_name=True)
+    queue.kill_by_name.assert_called_once_with("name")
+    assert not queue.kill.called
+    assert not other_queue.kill_by_name.called
+    assert store.get_runs()[0]['status'] == {"KILL_SUBMITTED": 3}
+    assert not wingman.handle_kill_pending_tasks(store, [queue, other_queue])
+
+    # by default jobs are killed by id, since the name could match jobs this wingman doesn't know about
+    store.retry_run(run_dir)
+    for i, task_dir in enumerate(task_dirs):
+        store.task_submitted(task_dir, "SGE:%d" % i)
+    store.kill_run(run_dir)
+    queue = mock.Mock(external_id_prefix="SGE:")
+    assert wingman.handle_kill_pending_tasks(store, [queue])
+    assert not queue.kill_by_name.called
+    assert sorted([task.external_id for task in queue.kill.call_args[0][0]]) == ["0", "1", "2"]
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_tasks_of_unknown_backends_are_missing():
+    import mock
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 3)
+    store.release_waiting_tasks()
+    store.task_submitted(task_dirs[0], "SGE:1")
+    store.task_submitted(task_dirs[1], "gone@PID:2")
+    store.task_submitted(task_dirs[2], "gone@PID:3")
+    store.set_task_status(3, wingman.KILL_SUBMITTED)
+
+    queue = mock.Mock(external_id_prefix="SGE:")
+    assert wingman.handle_tasks_of_unknown_backends(store, [queue]) == 2
+    assert [t['status'] for t in store.get_run_tasks(run_dir)] == ["SUBMITTED", "MISSING", "KILLED"]
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_reconcile_at_startup():
+    import mock
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 4)
+    store.release_waiting_tasks()
+    for i, task_dir in enumerate(task_dirs):
+        store.task_submitted(task_dir, "SGE:%d" % i)
+    store.task_started(task_dirs[0], "node")
+    # the first finished while wingman was down, the second is still queued and the third vanished
+    os.makedirs(task_dirs[0])
+    with open(os.path.join(task_dirs[0], "finished-time.txt"), "w") as fd:
+        fd.write("done")
+    queue = mock.Mock(external_id_prefix="SGE:")
+    queue.get_jobs_from_external_queue.return_value = {"1": None, "3": None}
+    # tasks in a queue which can't be listed are left alone
+    unreachable_queue = mock.Mock(external_id_prefix="other@LSF:")
+    unreachable_queue.get_jobs_from_external_queue.side_effect = Exception("down")
+    store.task_submitted(task_dirs[3], "other@LSF:3")
+
+    assert wingman.reconcile_at_startup(store, [queue, unreachable_queue], threads=2) == 2
+    assert [t['status'] for t in store.get_run_tasks(run_dir)] == ["COMPLETED", "SUBMITTED", "MISSING", "SUBMITTED"]
+    assert wingman.reconcile_at_startup(store, [queue], threads=2) == 0
+
+def test_job_name_is_unique():
+    assert wingman.job_name_is_unique("run", ["other"])
+    assert not wingman.job_name_is_unique("run", ["my run"])
+    assert not wingman.job_name_is_unique("run", ["run"])
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_configs_and_queues_cached_between_passes():
+    import mock
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    create_run_with_tasks(store, 6)
+    listener = mock.Mock(task_ids={})
+    queue_factory = mock.Mock()
+    cache = wingman.RunQueueCache(listener, queue_factory)
+    router = lambda max_submitted: BackendRouter([Backend("sge", "sge", max_submitted, is_default=True)])
+
+    wingman.submit_created_tasks(listener, store, queue_factory, router(2), cache)
+    wingman.submit_created_tasks(listener, store, queue_factory, router(3), cache)
+    assert queue_factory.call_count == 1
+    assert queue_factory.return_value.submit.call_count == 5
+
+    # a changed mem override gets a queue requesting the new amount
+    store.set_required_mem_override(run_dir, 2000)
+    wingman.submit_created_tasks(listener, store, queue_factory, router(4), cache)
+    assert queue_factory.call_count == 2
+    assert queue_factory.call_args[0][3] == 2000
+
+    # editing the config replaces the queues built from it
+    os.utime(config_path, (0, 0))
+    wingman.submit_created_tasks(listener, store, queue_factory, router(5), cache)
+    assert queue_factory.call_count == 3
+
+    # the config file is only checked once per pass, not once per task
+    before = queue_factory.return_value.submit.call_count
+    with mock.patch("os.path.getmtime", wraps=os.path.getmtime) as getmtime:
+        wingman.submit_created_tasks(listener, store, queue_factory, router(20), cache)
+        assert queue_factory.return_value.submit.call_count - before > 1
+        assert getmtime.call_count == 1
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_tasks_spill_to_overflow_backend():
+    import mock
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    create_run_with_tasks(store, 5)
+    listener = mock.Mock(task_ids={})
+    queues = {}
+    def queue_factory(backend, listener, config, mem):
+        queues[backend.name] = mock.Mock()
+        return queues[backend.name]
+    router = BackendRouter([Backend("sge", "sge", 2, is_default=True), Backend("spare", "local", 1, overflow=True)])
+
+    wingman.submit_created_tasks(listener, store, queue_factory, router, wingman.RunQueueCache(listener, queue_factory))
+    assert queues["sge"].submit.call_count == 2
+    assert queues["spare"].submit.call_count == 1
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_attempts_recorded_and_summarized():
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 4)
+    store.release_waiting_tasks()
+    for i, task_dir in enumerate(task_dirs[:3]):
+        store.task_submitted(task_dir, "SGE:%d" % i)
+        store.task_started(task_dir, "node%d" % (i % 2))
+    store.task_completed(task_dirs[0])
+    store.task_completed(task_dirs[1])
+    store.task_failed(task_dirs[2])
+
+    # the failed task's second attempt is still waiting in the queue
+    store.retry_run(run_dir)
+    store.release_waiting_tasks()
+    store.task_submitted(task_dirs[2], "SGE:10")
+
+    with store.transaction() as db:
+        db.execute("SELECT task_id, external_id, node_name, status, ended_time IS NULL FROM TASK_ATTEMPTS ORDER BY attempt_id")
+        assert db.fetchall() == [(1, "SGE:0", "node0", wingman.COMPLETED, 0), (2, "SGE:1", "node1", wingman.COMPLETED, 0),
+                                 (3, "SGE:2", "node0", wingman.FAILED, 0), (3, "SGE:10", None, None, 1)]
+        # pin down the times: each waited 10s more than the last and ran for 100s
+        for task_id in [1, 2, 3]:
+            db.execute("UPDATE TASK_ATTEMPTS SET submitted_time = 1000, started_time = ?, ended_time = ? WHERE task_id = ? AND external_id != 'SGE:10'",
+                       [1000 + task_id * 10, 1100 + task_id * 10, task_id])
+
+    stats = store.get_run_stats(run_dir, now=1200)
+    assert stats['queue_wait'] == {"50": 20, "90": 30, "99": 30, "100": 30}
+    assert stats['run_time']["50"] == 100
+    assert [(n['node'], n['attempts'], n['completed'], n['failed']) for n in stats['nodes']] == [("node0", 2, 1, 1), ("node1", 1, 1, 0)]
+    assert stats['throughput'] == [dict(start=600, completed=2, total_completed=2)]
+    assert stats['remaining'] == 2
+    assert stats['eta'] == 2 / (2.0 / wingman.ETA_WINDOW)
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_tasks_which_stop_beating_are_resubmitted():
+    import mock
+    from flock import heartbeat
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 4)
+    store.release_waiting_tasks()
+    for i, task_dir in enumerate(task_dirs):
+        store.task_submitted(task_dir, "SGE:%d" % (i + 1))
+        store.task_started(task_dir, "node01")
+    store.task_completed(task_dirs[0])
+    with store.transaction() as db:
+        db.execute("UPDATE TASKS SET try_count = ? WHERE task_id = 3", [wingman.MAX_HEARTBEAT_TRIES])
+    # the fourth finished, but its notification hasn't arrived yet
+    os.makedirs(task_dirs[3])
+    open(os.path.join(task_dirs[3], "finished-time.txt"), "w").close()
+
+    monitor = heartbeat.HeartbeatMonitor(interval=5, missed_beats=3)
+    for task_id in ["1", "2", "3", "4"]:
+        monitor.beat(task_id, "node01", now=0)
+    queue = mock.Mock(external_id_prefix="SGE:")
+    queue.kill.return_value = True
+    assert wingman.handle_silent_tasks(store, monitor, [queue]) == 2
+    assert [t['status'] for t in store.get_run_tasks(run_dir)] == ["COMPLETED", "WAITING", "MISSING", "COMPLETED"]
+    # the old jobs are killed before the tasks are resubmitted
+    assert sorted([task.external_id for task in queue.kill.call_args[0][0]]) == ["2", "3"]
+
+@with_setup(setup_run_dir, cleanup_run_dir)
+def test_silent_tasks_which_cant_be_killed_are_missing():
+    import mock
+    from flock import heartbeat
+    store = wingman.TaskStore(temp_db, "flock_home", endpoint_url="http://invalid:2000")
+    task_dirs = create_run_with_tasks(store, 2)
+    store.release_waiting_tasks()
+    store.task_submitted(task_dirs[0], "SGE:1")
+    store.task_submitted(task_dirs[1], "bigmem@PID:2")
+    for task_dir in task_dirs:
+        store.task_started(task_dir, "node01")
+
+    monitor = heartbeat.HeartbeatMonitor(interval=5, missed_beats=3)
+    for task_id in ["1", "2"]:
+        monitor.beat(task_id, "node01", now=0)
+    queue = mock.Mock(external_id_prefix="SGE:")
+    # qdel exited with an error
+    queue.kill.return_value = False
+    # no queue for the second task's backend, so nothing can kill its job either
+    assert wingman.handle_silent_tasks(store, monitor, [queue]) == 2
+    assert [t['status'] for t in store.get_run_tasks(run_dir)] == ["MISSING", "MISSING"]
+
+    assert "--heartbeat wingman:3010 2 5 " in wingman.format_watch_command("flock_home", "proc_stats.txt", "wingman:3010", 2, 5)
@@ -4,6 +4,7 @@ import time
 import os
 import subprocess
 import signal
+import socket
 
 Stats = collections.namedtuple("Stats", ["timestamp", "utime", "stime", "starttime", "vsize", "rss"])
 
@@ -40,6 +41,40 @@ def write_stats(fd, pid):
     fd.write("m NA NA NA NA NA\n")
   fd.flush()
 
+class Heartbeat(object):
+  " sends 'hb task node cpu vsize rss checkpoint_time' datagrams to wingman (see heartbeat.py) "
+  def __init__(self, address, task, interval, checkpoint_files=[]):
+    host, port = address.rsplit(":", 1)
+    self.address = (host, int(port))
+    self.task = task
+    self.interval = interval
+    self.node_name = socket.gethostname()
+    self.checkpoint_files = checkpoint_files
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def checkpoint_time(self):
+    " the time the task last saved a checkpoint, or NA "
+    times = [int(os.path.getmtime(fn)) for fn in self.checkpoint_files if os.path.exists(fn)]
+    if len(times) == 0:
+      return "NA"
+    return max(times)
+
+  def send(self, pid):
+    stats = None
+    try:
+      stats = read_stats(pid)
+    except (IOError, AssertionError):
+      pass
+    if stats != None:
+      message = "hb %s %s %s %s %s %s" % (self.task, self.node_name, stats.utime + stats.stime, stats.vsize, stats.rss, self.checkpoint_time())
+    else:
+      message = "hb %s %s NA NA NA %s" % (self.task, self.node_name, self.checkpoint_time())
+    try:
+      self.sock.sendto(message, self.address)
+    except socket.error:
+      # a lost beat is expected now and then, wingman waits for several to be missed
+      pass
+
 class Timeout(Exception):
   pass
 
@@ -51,7 +86,7 @@ def adjust_omm_score(pid):
   except IOError:
     pass
 
-def run_and_watch(log_file, args, delay_between_checks=10):
+def run_and_watch(log_file, args, delay_between_checks=10, heartbeat=None):
   if os.path.exists(log_file):
     fd = open(log_file, "a")
   else:
@@ -65,15 +100,26 @@ def run_and_watch(log_file, args, delay_between_checks=10):
   def _timeout(x, y): raise Timeout()
   handler = signal.signal(signal.SIGALRM, _timeout)
 
+  # wake up often enough to send each heartbeat, but only record stats every delay_between_checks
+  tick = delay_between_checks
+  if heartbeat != None:
+    tick = min(tick, heartbeat.interval)
+    heartbeat.send(proc.pid)
+  last_stats = time.time()
+
   ret = None
   while ret == None:
     try:
-      signal.alarm(delay_between_checks)
+      signal.alarm(tick)
       ret = proc.wait()
       signal.alarm(0)
       break
     except Timeout:
-      write_stats(fd, proc.pid)
+      if heartbeat != None:
+        heartbeat.send(proc.pid)
+      if time.time() - last_stats >= delay_between_checks - 0.5:
+        write_stats(fd, proc.pid)
+        last_stats = time.time()
 
   signal.signal(signal.SIGALRM, handler)
   fd.write("s(%s) %s NA NA NA NA\n" % (ret, int(time.time())))
@@ -82,11 +128,21 @@ def run_and_watch(log_file, args, delay_between_checks=10):
   return ret
 
 if __name__ == "__main__":
-  if len(sys.argv) < 3:
-    print "Usage: logfile delay_in_seconds args..."
+  args = sys.argv[1:]
+  heartbeat = None
+  if len(args) > 0 and args[0] == "--heartbeat":
+    heartbeat = Heartbeat(args[1], args[2], int(args[3]))
+    args = args[4:]
+    if len(args) > 0:
+      # the task saves its checkpoints next to the log file (see flock_support)
+      task_dir = os.path.dirname(os.path.abspath(args[0]))
+      heartbeat.checkpoint_files = [os.path.join(task_dir, "checkpoint.pickle"), os.path.join(task_dir, "checkpoint.Rdata")]
+
+  if len(args) < 2:
+    print "Usage: [--heartbeat host:port task_id interval_in_seconds] logfile delay_in_seconds args..."
     sys.exit(1)
 
-  log_file = sys.argv[1]
-  delay = int(sys.argv[2])
-  ret = run_and_watch(log_file, sys.argv[3:], delay_between_checks=delay)
+  log_file = args[0]
+  delay = int(args[1])
+  ret = run_and_watch(log_file, args[2:], delay_between_checks=delay, heartbeat=heartbeat)
   sys.exit(ret)
@@ -7,33 +7,83 @@ import threading
 import socket
 import traceback
 import json
+import xmlrpclib
 import wingman_client
-from queue.sge import SGEQueue
-from queue.local import LocalBgQueue
+from queue.sge import safe_job_name
+from queue.util import divide_into_batches
+from queue import accounting
 import config as flock_config
+import storage as flock_storage
 import time
 import glob
 import base64
 import hashlib
 import collections
+import Queue
+import zlib
+import pwd
+import scheduler as flock_scheduler
+import metrics as flock_metrics
+import file_server
+import heartbeat as flock_heartbeat
+import backends as flock_backends
+from columns import pack_columns, unpack_columns
+import random
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger("monitor")
 
 __author__ = 'pmontgom'
 
-# schema: SGE job number, job directory, try count, status = STARTED | FAILED | SUCCESS
+# schema: tasks are identified by an integer task_id, which is what tasks pass back in their notifications.  The task
+# directory is not stored, but is the run_dir of the run followed by a path relative to it, such as "tasks/12".  Those
+# relative paths repeat across runs, so each is stored once in PATHS.
 
-DB_INIT_STATEMENTS = ["CREATE TABLE TASKS (run_id INTEGER, task_dir STRING primary key, status INTEGER, try_count INTEGER, node_name STRING, external_id STRING, group_number INTEGER )",
- "CREATE INDEX IDX_RUN_ID ON TASKS (run_id)",
- "CREATE INDEX IDX_TASK_DIR ON TASKS (task_dir)",
- "CREATE INDEX IDX_EXTERNAL_ID ON TASKS (external_id)",
- "CREATE INDEX IDX_NODE_NAME ON TASKS (node_name)",
- "CREATE TABLE RUNS (run_id integer primary key autoincrement, run_dir STRING UNIQUE, name STRING, flock_config_path STRING, parameters STRING, required_mem_override INTEGER)",
+CREATE_TASKS_TABLE = "CREATE TABLE %s (task_id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER, path_id INTEGER, status INTEGER, try_count INTEGER, node_name STRING, external_id STRING, group_number INTEGER, mem_request INTEGER, exit_status INTEGER, failure_reason STRING, wall_time REAL, max_vmem_mb REAL, UNIQUE (run_id, path_id))"
+
+# indexes for the lookups made while tasks are running: by status when submitting and polling, by run and status
+# for run level operations, and by external id when reconciling with the queue
+TASKS_INDEX_STATEMENTS = ["CREATE INDEX IDX_TASKS_STATUS ON TASKS (status)",
+ "CREATE INDEX IDX_TASKS_RUN_STATUS ON TASKS (run_id, status)",
+ "CREATE INDEX IDX_TASKS_EXTERNAL_ID ON TASKS (external_id)"]
+
+DB_INIT_STATEMENTS = [CREATE_TASKS_TABLE % "TASKS"] + TASKS_INDEX_STATEMENTS + [
+ "CREATE TABLE PATHS (path_id INTEGER PRIMARY KEY, path STRING UNIQUE)",
+ "CREATE TABLE RUNS (run_id integer primary key autoincrement, run_dir STRING UNIQUE, name STRING, flock_config_path STRING, parameters STRING, required_mem_override INTEGER, finished_time REAL, owner STRING, priority INTEGER DEFAULT 0, share REAL DEFAULT 1, max_running INTEGER)",
  "CREATE INDEX IDX_RUN_DIR ON RUNS (run_dir)"]
 
-# Make run_id auto inc primary key
-# Make task_dir into primary key
-# make status into index
+# columns added to TASKS and RUNS since they were first created
+ADDED_TASKS_COLUMNS = [("mem_request", "INTEGER"), ("exit_status", "INTEGER"), ("failure_reason", "STRING"), ("wall_time", "REAL"), ("max_vmem_mb", "REAL")]
+ADDED_RUNS_COLUMNS = [("finished_time", "REAL"), ("owner", "STRING"), ("priority", "INTEGER DEFAULT 0"), ("share", "REAL DEFAULT 1"), ("max_running", "INTEGER")]
+
+# how far into the batch system's accounting file wingman has read
+ACCOUNTING_STATEMENTS = ["CREATE TABLE IF NOT EXISTS ACCOUNTING_OFFSETS (path STRING PRIMARY KEY, offset INTEGER, inode INTEGER)"]
+
+# Once every task of a run has finished, finished_time is set on the run.  After the run has been finished for a while
+# its tasks are moved out of TASKS into a single compressed row of ARCHIVED_RUNS, leaving only its STATUS_COUNTS.
+# Retrying the run moves them back.
+ARCHIVE_STATEMENTS = ["CREATE TABLE IF NOT EXISTS ARCHIVED_RUNS (run_id INTEGER PRIMARY KEY, tasks BLOB)"]
+
+# how long a run must have been finished before it is archived
+DEFAULT_ARCHIVE_AFTER = 7*24*60*60
+
+# converts a database where TASKS was keyed by the full task_dir.  These all run in one explicit transaction (see
+# TaskStore._migrate_to_task_ids), so an interrupted migration is rolled back and simply redone on next start.
+MIGRATE_TO_TASK_IDS_STATEMENTS = ["DROP TABLE IF EXISTS NEW_TASKS",
+ "DROP TRIGGER IF EXISTS TRG_LIVE_STATUS_COUNTS_INSERT", "DROP TRIGGER IF EXISTS TRG_LIVE_STATUS_COUNTS_DELETE",
+ "DROP TRIGGER IF EXISTS TRG_STATUS_COUNTS_UPDATE", "DROP TABLE IF EXISTS STATUS_COUNTS",
+ "CREATE TABLE IF NOT EXISTS PATHS (path_id INTEGER PRIMARY KEY, path STRING UNIQUE)",
+ "INSERT OR IGNORE INTO PATHS (path) SELECT DISTINCT substr(TASKS.task_dir, length(RUNS.run_dir) + 2) FROM TASKS JOIN RUNS ON RUNS.run_id = TASKS.run_id",
+ CREATE_TASKS_TABLE % "NEW_TASKS",
+ "INSERT INTO NEW_TASKS (run_id, path_id, status, try_count, node_name, external_id, group_number) "
+ "SELECT TASKS.run_id, PATHS.path_id, TASKS.status, TASKS.try_count, TASKS.node_name, TASKS.external_id, TASKS.group_number "
+ "FROM TASKS JOIN RUNS ON RUNS.run_id = TASKS.run_id JOIN PATHS ON PATHS.path = substr(TASKS.task_dir, length(RUNS.run_dir) + 2)",
+ "DROP TABLE TASKS",
+ "ALTER TABLE NEW_TASKS RENAME TO TASKS"] + TASKS_INDEX_STATEMENTS
+
+# the full task directory of each row of TASKS_WITH_PATHS
+TASK_DIR_COLUMN = "RUNS.run_dir || '/' || PATHS.path"
+TASKS_WITH_PATHS = "TASKS JOIN RUNS ON RUNS.run_id = TASKS.run_id JOIN PATHS ON PATHS.path_id = TASKS.path_id"
 
 WAITING = 1
 READY = 2
@@ -56,70 +106,397 @@ PREREQ_FAILED = -6
 status_code_to_name = {WAITING: "WAITING", READY:"READY", SUBMITTED: "SUBMITTED", STARTED: "STARTED",
                        COMPLETED: "COMPLETED", FAILED: "FAILED", MISSING: "MISSING", KILLED: "KILLED",
                        KILL_PENDING : "KILL_PENDING", KILL_SUBMITTED: "KILL_SUBMITTED", PREREQ_FAILED: "PREREQ_FAILED"}
+status_name_to_code = dict([(name, code) for code, name in status_code_to_name.items()])
+
+FAILED_STATES = "(%d, %d, %d)" % (FAILED, KILLED, PREREQ_FAILED)
+TERMINAL_STATES = "(%d, %d, %d, %d)" % (COMPLETED, FAILED, KILLED, PREREQ_FAILED)
+
+# get_run_tasks and get_runs return a struct per task or run, which for a big run is a huge response.
+# get_run_tasks_page and get_runs_page instead return one slice at a time, packed column by column into compressed json.
+MAX_PAGE_SIZE = 10000
+TASK_PAGE_COLUMNS = ["task_id", "path", "status", "try_count", "node_name", "external_id", "group_number"]
+
+# The peak memory of each completed task is recorded in TASK_MEMORY, and tasks are submitted asking for a high quantile
+# of what the tasks of their run have needed so far.  MEMORY_PENDING queues up the tasks whose proc_stats.txt still
+# need to be read, so that happens in the main loop instead of while handling a notification.
+MEMORY_STATEMENTS = ["CREATE TABLE IF NOT EXISTS TASK_MEMORY (task_id INTEGER PRIMARY KEY, run_id INTEGER, peak_mem_mb REAL)",
+ "CREATE INDEX IF NOT EXISTS IDX_TASK_MEMORY_RUN ON TASK_MEMORY (run_id, peak_mem_mb)",
+ "CREATE TABLE IF NOT EXISTS MEMORY_PENDING (task_id INTEGER PRIMARY KEY)",
+ "CREATE TRIGGER IF NOT EXISTS TRG_MEMORY_PENDING AFTER UPDATE OF status ON TASKS WHEN NEW.status IN (%d, %d) AND OLD.status != NEW.status BEGIN "
+ "INSERT OR REPLACE INTO MEMORY_PENDING VALUES (NEW.task_id); END" % (COMPLETED, FAILED)]
+
+# TASK_ATTEMPTS records each time a task went through the queue: when it was submitted, started and ended, where it
+# ran and how it ended, so queue waits and run times can be summarized per run and per node.  Like STATUS_COUNTS it is
+# kept up to date by triggers on TASKS.  An attempt is open until its task leaves the in-flight states.
+IN_FLIGHT_STATES = "(%d, %d, %d, %d, %d)" % (SUBMITTED, STARTED, MISSING, KILL_PENDING, KILL_SUBMITTED)
+SQL_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+ATTEMPTS_STATEMENTS = ["CREATE TABLE IF NOT EXISTS TASK_ATTEMPTS (attempt_id INTEGER PRIMARY KEY AUTOINCREMENT, task_id INTEGER, run_id INTEGER, "
+                       "external_id STRING, node_name STRING, submitted_time REAL, started_time REAL, ended_time REAL, status INTEGER, exit_status INTEGER)",
+ "CREATE INDEX IF NOT EXISTS IDX_TASK_ATTEMPTS_TASK ON TASK_ATTEMPTS (task_id, ended_time)",
+ "CREATE INDEX IF NOT EXISTS IDX_TASK_ATTEMPTS_RUN ON TASK_ATTEMPTS (run_id, ended_time)",
+ "CREATE TRIGGER IF NOT EXISTS TRG_ATTEMPT_SUBMITTED AFTER UPDATE OF status ON TASKS WHEN NEW.status = %(submitted)d AND OLD.status != NEW.status BEGIN "
+ "UPDATE TASK_ATTEMPTS SET ended_time = %(now)s, status = OLD.status WHERE task_id = NEW.task_id AND ended_time IS NULL; "
+ "INSERT INTO TASK_ATTEMPTS (task_id, run_id, external_id, submitted_time) VALUES (NEW.task_id, NEW.run_id, NEW.external_id, %(now)s); END" % dict(submitted=SUBMITTED, now=SQL_NOW),
+ # tasks run by the local queue start without being submitted
+ "CREATE TRIGGER IF NOT EXISTS TRG_ATTEMPT_STARTED AFTER UPDATE OF status ON TASKS WHEN NEW.status = %(started)d AND OLD.status != NEW.status BEGIN "
+ "INSERT INTO TASK_ATTEMPTS (task_id, run_id, external_id) SELECT NEW.task_id, NEW.run_id, NEW.external_id "
+ "  WHERE NOT EXISTS (SELECT 1 FROM TASK_ATTEMPTS WHERE task_id = NEW.task_id AND ended_time IS NULL); "
+ "UPDATE TASK_ATTEMPTS SET started_time = %(now)s, node_name = NEW.node_name WHERE task_id = NEW.task_id AND ended_time IS NULL; END" % dict(started=STARTED, now=SQL_NOW),
+ "CREATE TRIGGER IF NOT EXISTS TRG_ATTEMPT_ENDED AFTER UPDATE OF status ON TASKS WHEN NEW.status NOT IN %(in_flight)s AND OLD.status != NEW.status BEGIN "
+ "UPDATE TASK_ATTEMPTS SET ended_time = %(now)s, status = NEW.status, exit_status = NEW.exit_status WHERE task_id = NEW.task_id AND ended_time IS NULL; END" % dict(in_flight=IN_FLIGHT_STATES, now=SQL_NOW),
+ # the accounting file may report the exit after the task has already reported back
+ "CREATE TRIGGER IF NOT EXISTS TRG_ATTEMPT_EXIT_STATUS AFTER UPDATE OF exit_status ON TASKS WHEN NEW.exit_status IS NOT NULL BEGIN "
+ "UPDATE TASK_ATTEMPTS SET exit_status = NEW.exit_status WHERE task_id = NEW.task_id AND external_id = NEW.external_id; END"]
+
+# the percentiles of queue wait and run time reported by get_run_stats
+STATS_PERCENTILES = [50, 90, 99, 100]
+# the width in seconds of each interval of the completions over time reported by get_run_stats
+THROUGHPUT_INTERVAL = 10*60
+# the ETA is based on the rate tasks completed over this many seconds
+ETA_WINDOW = 60*60
+
+# memory requests are this quantile of the peaks seen so far plus a margin, once there are enough samples
+MEM_QUANTILE = 0.95
+MEM_MARGIN = 0.2
+MIN_MEM_SAMPLES = 5
+MIN_MEM_REQUEST = 256
+# a task which fails after using this much of its request is assumed to have run out, and asks for more next time
+MEM_NEAR_LIMIT = 0.9
+MEM_ESCALATION_FACTOR = 2
+
+# STATUS_COUNTS holds the number of tasks in each status for each group of each run.  The triggers keep it in sync
+# with TASKS within the same transaction as each change to TASKS, so run summaries, the number of tasks in flight and
+# whether a group can start are all answered without scanning TASKS.
+def _adjust_status_count(row, delta):
+    return "INSERT OR IGNORE INTO STATUS_COUNTS VALUES (%(row)s.run_id, %(row)s.group_number, %(row)s.status, 0); " \
+           "UPDATE STATUS_COUNTS SET count = count %(delta)s WHERE run_id = %(row)s.run_id AND group_number = %(row)s.group_number AND status = %(row)s.status; " % dict(row=row, delta=delta)
+
+STATUS_COUNTS_STATEMENTS = ["CREATE TABLE IF NOT EXISTS STATUS_COUNTS (run_id INTEGER, group_number INTEGER, status INTEGER, count INTEGER, PRIMARY KEY (run_id, group_number, status))",
+ "CREATE INDEX IF NOT EXISTS IDX_STATUS_COUNTS_STATUS ON STATUS_COUNTS (status)",
+ # the counts of an archived run stay put while its tasks are moved in or out of TASKS
+ "CREATE TRIGGER IF NOT EXISTS TRG_LIVE_STATUS_COUNTS_INSERT AFTER INSERT ON TASKS WHEN NOT EXISTS (SELECT 1 FROM ARCHIVED_RUNS WHERE run_id = NEW.run_id) BEGIN %s END" % _adjust_status_count("NEW", "+ 1"),
+ "CREATE TRIGGER IF NOT EXISTS TRG_LIVE_STATUS_COUNTS_DELETE AFTER DELETE ON TASKS WHEN NOT EXISTS (SELECT 1 FROM ARCHIVED_RUNS WHERE run_id = OLD.run_id) BEGIN %s END" % _adjust_status_count("OLD", "- 1"),
+ "CREATE TRIGGER IF NOT EXISTS TRG_STATUS_COUNTS_UPDATE AFTER UPDATE OF status ON TASKS WHEN OLD.status != NEW.status BEGIN %s%s END" % (_adjust_status_count("OLD", "- 1"), _adjust_status_count("NEW", "+ 1"))]
+
+# used to fill in STATUS_COUNTS for databases created before it existed
+POPULATE_STATUS_COUNTS = "INSERT INTO STATUS_COUNTS SELECT run_id, group_number, status, count(*) FROM TASKS GROUP BY run_id, group_number, status"
 
 MONITOR_POLL_INTERVAL = 60
-def format_watch_command(flock_home, log_file):
-    return "python %s/watch_proc.py %s %d" % (flock_home, log_file, MONITOR_POLL_INTERVAL)
-
-def format_notify_command(flock_home, endpoint_url):
+def format_watch_command(flock_home, log_file, heartbeat_address=None, task=None, heartbeat_interval=None):
+    " heartbeat_address is the host:port heartbeats for task are sent to, or None to not send any "
+    heartbeat = ""
+    if heartbeat_address is not None:
+        heartbeat = "--heartbeat %s %s %d " % (heartbeat_address, task, heartbeat_interval)
+    return "python %s/watch_proc.py %s%s %d" % (flock_home, heartbeat, log_file, MONITOR_POLL_INTERVAL)
+
+# a task which stops sending heartbeats is resubmitted until it has been started this many times, then marked MISSING
+MAX_HEARTBEAT_TRIES = 3
+
+def read_peak_memory(proc_stats):
+    """ returns the peak memory in MB of a task from the content of the proc_stats.txt written by watch_proc.py, or
+        None if it has no samples.  This is the larger of the virtual size and RSS, since h_vmem limits the former """
+    peak = None
+    for line in proc_stats.split("\n"):
+        fields = line.split(" ")
+        if len(fields) != 6 or fields[0] != "r":
+            continue
+        try:
+            mem = max(float(fields[4]), float(fields[5]))
+        except ValueError:
+            continue
+        if peak is None or mem > peak:
+            peak = mem
+    return peak
+
+def choose_mem_request(override, estimate, previous_request):
+    """ the memory to ask for when submitting a task.  An override set on the run is always used as is, even if it is
+        lower than the task asked for before.  Otherwise a task is never given less than its previous request, as that
+        may have been raised after it ran out """
+    if override is not None:
+        return override
+    request = estimate
+    if previous_request is not None and (request is None or previous_request > request):
+        request = previous_request
+    return request
+
+def format_notify_command(flock_home, endpoint_url, spool_dir=None):
+    if spool_dir != None:
+        # events go to a node-local spool, and are forwarded to wingman in batches by wingman_agent.py
+        return "sh %s/wingman_spool.sh %s %s" % (flock_home, spool_dir, endpoint_url)
     return "python %s/wingman_notify.py %s" % (flock_home, endpoint_url)
 
+# how long an update waits for others to arrive so they can all be committed together
+GROUP_COMMIT_DELAY = 0.005
+
+RPC_CALLS = flock_metrics.REGISTRY.counter("wingman_rpc_calls_total", "RPC calls handled", ["method", "outcome"])
+RPC_SECONDS = flock_metrics.REGISTRY.histogram("wingman_rpc_seconds", "Time spent handling each RPC call", ["method"])
+TRANSACTION_SECONDS = flock_metrics.REGISTRY.histogram("wingman_db_transaction_seconds", "Time from starting a transaction (including waiting for the write lock) until it is committed", ["mode"])
+LOOP_SECONDS = flock_metrics.REGISTRY.histogram("wingman_main_loop_seconds", "Time spent in each pass of the scheduling loop, not counting the wait for new tasks")
+QUEUE_POLL_SECONDS = flock_metrics.REGISTRY.histogram("wingman_queue_poll_seconds", "Time spent listing the jobs in the batch queue (qstat)")
+TASKS_SUBMITTED = flock_metrics.REGISTRY.counter("wingman_tasks_submitted_total", "Tasks handed to the batch queue")
+TASKS_FINISHED = flock_metrics.REGISTRY.counter("wingman_tasks_finished_total", "Tasks which completed or failed", ["status"])
+
 class TransactionContext:
+    " a thread's transaction.  Nested uses share it, and it is committed when the outermost one exits "
     def __init__(self, connection, lock):
         self.connection = connection
         self.depth = 0
         self.lock = lock
+        self.exclusive = True
+        self._holds_lock = False
+        self._begun = False
+        self._cursors = []
 
     def __enter__(self):
         if self.depth == 0:
+            self._started = time.time()
+        # readers don't need the lock: with WAL they see the last committed state while a write is in progress
+        if self.exclusive and not self._holds_lock:
             self.lock.acquire()
-        self._db = self.connection.cursor()
+            self._holds_lock = True
+        if self.exclusive and not self._begun:
+            self.connection.execute("BEGIN")
+            self._begun = True
+        db = self.connection.cursor()
+        self._cursors.append(db)
         self.depth += 1
-        return self._db
+        return db
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.depth -= 1
         if self.depth == 0:
-            self.connection.commit()
-            self._db.close()
-            self.lock.release()
+            if self._begun:
+                self.connection.execute("COMMIT")
+                self._begun = False
+            for db in self._cursors:
+                db.close()
+            self._cursors = []
+            if self._holds_lock:
+                self._holds_lock = False
+                self.lock.release()
+            TRANSACTION_SECONDS.observe(time.time() - self._started, "write" if self.exclusive else "read")
+
+class GroupCommitter:
+    """ runs updates which arrive within GROUP_COMMIT_DELAY of each other in a single transaction.  The first caller
+        of a batch waits for the others and commits on their behalf.  Every caller returns only after its update is
+        committed. """
+    def __init__(self, store, delay):
+        self.store = store
+        self.delay = delay
+        self._mutex = threading.Lock()
+        self._pending = []
+        self._leader_waiting = False
+
+    def execute(self, update):
+        " runs update(db) and returns its result "
+        if self.store.in_transaction():
+            # already inside a transaction, so can't wait on another thread to commit this
+            with self.store.transaction() as db:
+                return update(db)
+
+        entry = dict(update=update, done=threading.Event(), result=None, error=None)
+        with self._mutex:
+            self._pending.append(entry)
+            is_leader = not self._leader_waiting
+            self._leader_waiting = True
+
+        if is_leader:
+            if self.delay > 0:
+                time.sleep(self.delay)
+            with self._mutex:
+                batch = self._pending
+                self._pending = []
+                self._leader_waiting = False
+            try:
+                with self.store.transaction() as db:
+                    for e in batch:
+                        # undo the writes of an update which fails partway through, without losing the others
+                        db.execute("SAVEPOINT group_update")
+                        try:
+                            e['result'] = e['update'](db)
+                        except Exception as ex:
+                            e['error'] = ex
+                            db.execute("ROLLBACK TO group_update")
+                        db.execute("RELEASE group_update")
+            except Exception as ex:
+                for e in batch:
+                    e['error'] = ex
+            for e in batch:
+                e['done'].set()
+        else:
+            entry['done'].wait()
+
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
 
 class TaskStore:
-    def __init__(self, db_path, flock_home, endpoint_url):
+    def __init__(self, db_path, flock_home, endpoint_url, storage=None, group_commit_delay=GROUP_COMMIT_DELAY):
         self.flock_home = flock_home
         self.endpoint_url = endpoint_url
+        if storage is None:
+            storage = flock_storage.LocalStorage()
+        self.storage = storage
+        self.db_path = db_path
         new_db = not os.path.exists(db_path)
 
-        self._connection = sqlite3.connect(db_path, check_same_thread=False)
-        self._db = self._connection.cursor()
+        # each thread gets its own connection and transaction.  Writes are serialized by _lock.
+        self._local = threading.local()
         self._lock = threading.Lock()
-        self._active_transaction = None
         self._cv_created = threading.Condition(self._lock)
+        self._updates = GroupCommitter(self, group_commit_delay)
+        self.scheduler = flock_scheduler.FairShareScheduler()
+        # set to a heartbeat.HeartbeatMonitor when tasks send heartbeats
+        self.heartbeats = None
 
-        if new_db:
-            for statement in DB_INIT_STATEMENTS:
-                self._db.execute(statement)
-
-    # serialize all access to db via transaction
-    def transaction(self):
-        if self._active_transaction is None:
-            self._active_transaction = TransactionContext(self._connection, self._lock)
-        return self._active_transaction
+        if not new_db:
+            self._migrate_to_task_ids()
+        with self.transaction() as db:
+            if new_db:
+                for statement in DB_INIT_STATEMENTS:
+                    db.execute(statement)
+            self._upgrade_schema(db)
+
+    def _migrate_to_task_ids(self):
+        """ converts TASKS to integer task ids if it still has a task_dir column.  The sqlite3 module commits before
+            each DDL statement in its default mode, so this uses its own connection in autocommit mode and wraps the
+            statements in an explicit transaction """
+        connection = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            if "task_dir" not in [row[1] for row in connection.execute("PRAGMA table_info(TASKS)").fetchall()]:
+                return
+            log.warn("Migrating %s to integer task ids", self.db_path)
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in MIGRATE_TO_TASK_IDS_STATEMENTS:
+                    connection.execute(statement)
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def _upgrade_schema(self, db):
+        db.execute("PRAGMA table_info(RUNS)")
+        existing_columns = [row[1] for row in db.fetchall()]
+        for column, column_type in ADDED_RUNS_COLUMNS:
+            if column not in existing_columns:
+                db.execute("ALTER TABLE RUNS ADD COLUMN %s %s" % (column, column_type))
+        db.execute("PRAGMA table_info(TASKS)")
+        existing_columns = [row[1] for row in db.fetchall()]
+        for column, column_type in ADDED_TASKS_COLUMNS:
+            if column not in existing_columns:
+                db.execute("ALTER TABLE TASKS ADD COLUMN %s %s" % (column, column_type))
+        for statement in ARCHIVE_STATEMENTS + MEMORY_STATEMENTS + ACCOUNTING_STATEMENTS + ATTEMPTS_STATEMENTS:
+            db.execute(statement)
+        db.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'STATUS_COUNTS'")
+        has_status_counts = db.fetchall()[0][0] > 0
+        for statement in STATUS_COUNTS_STATEMENTS:
+            db.execute(statement)
+        if not has_status_counts:
+            db.execute(POPULATE_STATUS_COUNTS)
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # the sqlite3 module would commit before each SAVEPOINT, so transactions are begun by TransactionContext
+            connection = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode, NORMAL only syncs at checkpoints, and can't corrupt the db
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def in_transaction(self):
+        active_transaction = getattr(self._local, "transaction", None)
+        return active_transaction is not None and active_transaction.depth > 0
+
+    # serialize all writes to db via transaction.  Pass exclusive=False for reads which don't need to wait on writers.
+    def transaction(self, exclusive=True):
+        active_transaction = getattr(self._local, "transaction", None)
+        if active_transaction is None:
+            active_transaction = TransactionContext(self._get_connection(), self._lock)
+            self._local.transaction = active_transaction
+        if active_transaction.depth == 0:
+            active_transaction.exclusive = exclusive
+        elif exclusive and not active_transaction.exclusive:
+            # upgrade a read into a write
+            active_transaction.exclusive = True
+        return active_transaction
 
     # TODO: Switch this to look up runs by name, not run_dir
     def get_run_tasks(self, run_dir):
-        with self.transaction() as db:
+        with self.transaction(exclusive=False) as db:
             result = []
             log.warn("getting run_id")
             run_id = self._assert_run_valid(run_dir)
-            db.execute("SELECT task_dir, status, try_count, node_name, external_id, group_number FROM TASKS WHERE run_id = ?", [run_id])
-            for task_dir, status, try_count, node_name, external_id, group_number in db.fetchall():
-                task = {'task_dir':task_dir, 'status':status_code_to_name[status], 'try_count': try_count, 'node_name':node_name, 'external_id':external_id, 'group_number':group_number}
+            archived_tasks = self._read_archived_tasks(db, run_id)
+            if archived_tasks is not None:
+                for task_id, path, status, try_count, node_name, external_id, group_number in archived_tasks:
+                    result.append({'task_id':task_id, 'task_dir':run_dir + "/" + path, 'status':status_code_to_name[status], 'try_count': try_count, 'node_name':node_name, 'external_id':external_id, 'group_number':group_number})
+                return result
+
+            db.execute("SELECT TASKS.task_id, %s, status, try_count, node_name, external_id, group_number FROM %s WHERE TASKS.run_id = ? ORDER BY TASKS.task_id" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS), [run_id])
+            for task_id, task_dir, status, try_count, node_name, external_id, group_number in db.fetchall():
+                task = {'task_id':task_id, 'task_dir':task_dir, 'status':status_code_to_name[status], 'try_count': try_count, 'node_name':node_name, 'external_id':external_id, 'group_number':group_number}
                 result.append(task)
             return result
 
+    def get_run_tasks_page(self, run_dir, offset=0, limit=MAX_PAGE_SIZE, status=None, group_number=None, node_name=None, summary_only=False):
+        """ returns dict(total, status, offset, tasks) for the tasks of a run matching all of the given filters, where
+            status may be a status name or a list of them.  total and status count every matching task, while tasks
+            holds at most limit of them starting at offset, packed by pack_columns with TASK_PAGE_COLUMNS.  Paths are
+            relative to run_dir.  With summary_only, tasks is None """
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        if isinstance(status, basestring):
+            status = [status]
+        status_codes = None
+        if status is not None:
+            status_codes = [status_name_to_code[name] for name in status]
+
+        with self.transaction(exclusive=False) as db:
+            run_id = self._assert_run_valid(run_dir)
+            archived_tasks = self._read_archived_tasks(db, run_id)
+            if archived_tasks is not None:
+                rows = [row for row in archived_tasks if (status_codes is None or row[2] in status_codes) and
+                        (group_number is None or row[6] == group_number) and (node_name is None or row[4] == node_name)]
+                counts = collections.defaultdict(int)
+                for row in rows:
+                    counts[row[2]] += 1
+                rows = rows[offset:offset+limit]
+            else:
+                conditions = ["TASKS.run_id = ?"]
+                params = [run_id]
+                if status_codes is not None:
+                    conditions.append("TASKS.status IN (%s)" % ",".join(["?"] * len(status_codes)))
+                    params.extend(status_codes)
+                if group_number is not None:
+                    conditions.append("TASKS.group_number = ?")
+                    params.append(group_number)
+                if node_name is not None:
+                    conditions.append("TASKS.node_name = ?")
+                    params.append(node_name)
+                where = " AND ".join(conditions)
+                db.execute("SELECT status, count(*) FROM TASKS WHERE %s GROUP BY status" % where, params)
+                counts = dict(db.fetchall())
+                rows = []
+                if not summary_only:
+                    db.execute("SELECT TASKS.task_id, PATHS.path, status, try_count, node_name, external_id, group_number FROM TASKS "
+                               "JOIN PATHS ON PATHS.path_id = TASKS.path_id WHERE %s ORDER BY TASKS.task_id LIMIT ? OFFSET ?" % where,
+                               params + [limit, offset])
+                    rows = db.fetchall()
+
+        tasks = None
+        if not summary_only:
+            tasks = pack_columns(TASK_PAGE_COLUMNS, [(task_id, path, status_code_to_name[code], try_count, task_node_name, external_id, task_group_number)
+                                                     for task_id, path, code, try_count, task_node_name, external_id, task_group_number in rows])
+        return dict(total=sum(counts.values()), status=dict([(status_code_to_name[code], count) for code, count in counts.items()]),
+                    offset=offset, tasks=tasks)
+
     def get_run(self, name):
-        with self.transaction() as db:
+        with self.transaction(exclusive=False) as db:
             db.execute("SELECT run_dir, name, parameters FROM RUNS WHERE name = ?", [name])
             rows = db.fetchall()
             assert len(rows) == 1
@@ -127,21 +504,102 @@ class TaskStore:
             return dict(run_dir=run_dir, name=name, parameters=parameters)
 
     def get_runs(self):
-        with self.transaction() as db:
+        with self.transaction(exclusive=False) as db:
+            summaries = collections.defaultdict(dict)
+            db.execute("SELECT run_id, status, sum(count) FROM STATUS_COUNTS WHERE count > 0 GROUP BY run_id, status")
+            for run_id, status, count in db.fetchall():
+                summaries[run_id][status_code_to_name[status]] = count
+
             db.execute("SELECT run_id, run_dir, name, parameters FROM RUNS")
             rows = db.fetchall()
             result = []
             for run_id, run_dir, name, parameters in rows:
                 if parameters != None:
                     parameters = json.loads(parameters)
-
-                db.execute("SELECT status, count(1) FROM TASKS WHERE run_id = ? GROUP BY status", [run_id])
-                summary = {}
-                for status, count in db.fetchall():
-                    summary[status_code_to_name[status]] = count
-                result.append(dict(run_dir=run_dir, name=name, parameters=parameters, status=summary))
+                result.append(dict(run_dir=run_dir, name=name, parameters=parameters, status=summaries.get(run_id, {})))
             return result
 
+    def get_runs_page(self, offset=0, limit=MAX_PAGE_SIZE, summary_only=False):
+        """ returns dict(total, offset, runs) where runs holds at most limit runs starting at offset, packed by
+            pack_columns with the keys of get_runs.  With summary_only the (possibly large) parameters are left out """
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT count(*) FROM RUNS")
+            total = db.fetchall()[0][0]
+            db.execute("SELECT run_id, run_dir, name, parameters FROM RUNS ORDER BY run_id LIMIT ? OFFSET ?", [limit, offset])
+            rows = db.fetchall()
+
+            summaries = collections.defaultdict(dict)
+            for batch in divide_into_batches([row[0] for row in rows], 500):
+                db.execute("SELECT run_id, status, sum(count) FROM STATUS_COUNTS WHERE count > 0 AND run_id IN (%s) GROUP BY run_id, status" %
+                           ",".join(["?"] * len(batch)), batch)
+                for run_id, status, count in db.fetchall():
+                    summaries[run_id][status_code_to_name[status]] = count
+
+        if summary_only:
+            runs = pack_columns(["run_dir", "name", "status"], [(run_dir, name, summaries.get(run_id, {})) for run_id, run_dir, name, parameters in rows])
+        else:
+            runs = pack_columns(["run_dir", "name", "status", "parameters"],
+                                [(run_dir, name, summaries.get(run_id, {}), json.loads(parameters) if parameters is not None else None)
+                                 for run_id, run_dir, name, parameters in rows])
+        return dict(total=total, offset=offset, runs=runs)
+
+    def _attempt_percentiles(self, db, value, condition, params):
+        """ returns a dict of percentile -> value (nearest rank) of the expression value over the attempts matching
+            condition, picking out the ranks with a window so only those rows are returned """
+        ranks = " OR ".join(["rn = CAST(%f * (n - 1) + 0.5 AS INTEGER) + 1" % (p / 100.0) for p in STATS_PERCENTILES])
+        db.execute("SELECT rn, n, value FROM (SELECT %s AS value, ROW_NUMBER() OVER (ORDER BY %s) AS rn, COUNT(*) OVER () AS n "
+                   "FROM TASK_ATTEMPTS WHERE %s) WHERE %s" % (value, value, condition, ranks), params)
+        rows = db.fetchall()
+        if len(rows) == 0:
+            return {}
+        n = rows[0][1]
+        by_rank = dict([(rn, v) for rn, n, v in rows])
+        return dict([(str(p), by_rank[int(p / 100.0 * (n - 1) + 0.5) + 1]) for p in STATS_PERCENTILES])
+
+    def get_run_stats(self, run_dir, now=None):
+        """ summarizes the attempts of a run's tasks.  Returns dict(queue_wait, run_time, nodes, throughput, remaining,
+            completion_rate, eta) where queue_wait and run_time map each percentile to seconds, nodes has (attempts,
+            completed, failed, mean run time) per node, and throughput has the completions in each THROUGHPUT_INTERVAL.
+            eta is the seconds left at the rate tasks completed over the last ETA_WINDOW, or None """
+        if now is None:
+            now = time.time()
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT run_id FROM RUNS WHERE run_dir = ?", [run_dir])
+            rows = db.fetchall()
+            if len(rows) != 1:
+                return None
+            run_id = rows[0][0]
+
+            queue_wait = self._attempt_percentiles(db, "started_time - submitted_time",
+                                                   "run_id = ? AND started_time IS NOT NULL AND submitted_time IS NOT NULL", [run_id])
+            run_time = self._attempt_percentiles(db, "ended_time - started_time",
+                                                 "run_id = ? AND ended_time IS NOT NULL AND started_time IS NOT NULL", [run_id])
+
+            db.execute("SELECT node_name, count(*), sum(status = ?), sum(status IN %s), avg(ended_time - started_time) FROM TASK_ATTEMPTS "
+                       "WHERE run_id = ? AND started_time IS NOT NULL GROUP BY node_name ORDER BY node_name" % FAILED_STATES, [COMPLETED, run_id])
+            nodes = [dict(node=node, attempts=attempts, completed=completed, failed=failed, mean_run_time=mean_run_time)
+                     for node, attempts, completed, failed, mean_run_time in db.fetchall()]
+
+            db.execute("SELECT bucket, completed, SUM(completed) OVER (ORDER BY bucket) FROM "
+                       "(SELECT CAST(ended_time / ? AS INTEGER) AS bucket, count(*) AS completed FROM TASK_ATTEMPTS "
+                       " WHERE run_id = ? AND status = ? GROUP BY bucket) ORDER BY bucket", [THROUGHPUT_INTERVAL, run_id, COMPLETED])
+            throughput = [dict(start=bucket * THROUGHPUT_INTERVAL, completed=completed, total_completed=total)
+                          for bucket, completed, total in db.fetchall()]
+
+            db.execute("SELECT count(*) FROM TASK_ATTEMPTS WHERE run_id = ? AND status = ? AND ended_time > ?", [run_id, COMPLETED, now - ETA_WINDOW])
+            completion_rate = db.fetchall()[0][0] / float(ETA_WINDOW)
+            db.execute("SELECT sum(count) FROM STATUS_COUNTS WHERE run_id = ? AND status NOT IN %s" % TERMINAL_STATES, [run_id])
+            remaining = db.fetchall()[0][0] or 0
+
+        eta = None
+        if remaining == 0:
+            eta = 0
+        elif completion_rate > 0:
+            eta = remaining / completion_rate
+        return dict(queue_wait=queue_wait, run_time=run_time, nodes=nodes, throughput=throughput, remaining=remaining,
+                    completion_rate=completion_rate, eta=eta)
+
     def get_version(self):
         return "1"
 
@@ -157,7 +615,7 @@ class TaskStore:
             assert c != "" # make sure no leading slash
 
     def _assert_run_valid(self, run_dir):
-        with self.transaction() as db:
+        with self.transaction(exclusive=False) as db:
             db.execute("SELECT count(1), min(run_id) FROM RUNS WHERE run_dir = ?", [run_dir])
             counts = db.fetchall()
             assert len(counts) == 1
@@ -167,25 +625,13 @@ class TaskStore:
     def get_run_files(self, run_dir, wildcard):
         self._assert_run_valid(run_dir)
         self._assert_path_sane(wildcard)
-        filenames = glob.glob(os.path.join(run_dir, wildcard))
-
-        result = []
-        for filename in filenames:
-            name = filename[len(run_dir)+1:]
-            s = os.stat(filename)
-            is_dir = os.path.isdir(filename)
-            result.append(dict(name=name, size=s.st_size, mtime=s.st_mtime, is_dir=is_dir))
-
-        return result
+        return self.storage.list_files(run_dir, wildcard)
 
     def get_file_content(self, run_dir, path, offset, length):
         self._assert_run_valid(run_dir)
         self._assert_path_sane(path)
         assert length < 1000000
-        fd = open(os.path.join(run_dir, path))
-        fd.seek(offset)
-        buffer = fd.read(length)
-        fd.close()
+        buffer = self.storage.read(os.path.join(run_dir, path), offset, length)
 
         return dict(data=base64.standard_b64encode(buffer), md5=hashlib.md5(buffer).hexdigest())
 
@@ -194,41 +640,75 @@ class TaskStore:
 
         notify_command = format_notify_command(self.flock_home, self.endpoint_url)
         config = flock_config.load_config([config_path], run_dir, {})
-        task_definition_path = flock.write_files_for_running(self.flock_home, notify_command, run_dir, config.invoke, None, config.environment_variables, config.language)
+        owner = config.user
+        if owner is None:
+            owner = config_owner(config_path)
+        self._set_run_schedule(run_dir, owner, int(config.priority), float(config.share), config.max_running)
+        task_definition_path = flock.write_files_for_running(self.flock_home, notify_command, run_dir, config.invoke, None, config.environment_variables, config.language, config.blob_store_dir)
         return self.taskset_created(run_dir, task_definition_path)
 
     def taskset_created(self, run_dir, task_definition_path):
         full_task_dir_paths = []
         task_dirs = []
-        with open(task_definition_path) as fd:
-            for line in fd.readlines():
-                line = line.strip()
-                if line == "":
-                    continue
-                group, task_dir = line.split(" ")
-                task_dirs.append((int(group), task_dir))
+        for line in self.storage.read(task_definition_path).split("\n"):
+            line = line.strip()
+            if line == "":
+                continue
+            group, task_dir = line.split(" ")
+            task_dirs.append((int(group), task_dir))
 
         with self.transaction() as db:
             db.execute("SELECT run_id FROM RUNS WHERE run_dir = ?", [run_dir])
             run_id = db.fetchall()[0][0]
 
             for group, task_dir in task_dirs:
-                if flock.finished_successfully(run_dir, task_dir):
+                if flock.finished_successfully(run_dir, task_dir, self.storage):
                     status = COMPLETED
                     external_id = None
                 else:
-                    external_id = flock.get_external_id(run_dir, task_dir)
+                    external_id = flock.get_external_id(run_dir, task_dir, self.storage)
                     if external_id != None:
                         status = SUBMITTED
                     else:
                         status = WAITING
-                full_task_dir_path = os.path.join(run_dir, task_dir)
-                db.execute("INSERT INTO TASKS (run_id, task_dir, status, try_count, group_number, external_id) values (?, ?, ?, 0, ?, ?)", [run_id, full_task_dir_path, status, group, external_id])
-                full_task_dir_paths.append(full_task_dir_path)
+                db.execute("INSERT INTO TASKS (run_id, path_id, status, try_count, group_number, external_id) values (?, ?, ?, 0, ?, ?)", [run_id, self._intern_path(db, task_dir), status, group, external_id])
+                full_task_dir_paths.append(os.path.join(run_dir, task_dir))
 
             self._cv_created.notify_all()
         return full_task_dir_paths
 
+    def _intern_path(self, db, path):
+        db.execute("INSERT OR IGNORE INTO PATHS (path) VALUES (?)", [path])
+        db.execute("SELECT path_id FROM PATHS WHERE path = ?", [path])
+        return db.fetchall()[0][0]
+
+    def _find_task_id(self, db, task):
+        """ task is the task_id that notifications carry, either as a number or a string of digits.  Tasks submitted
+            before task ids were introduced identify themselves by their full task directory instead, so those are
+            looked up by the run_dir that is a prefix of it.  Returns None if there is no such task """
+        if isinstance(task, (int, long)):
+            return task
+        if task.isdigit():
+            return int(task)
+
+        run_dir = os.path.dirname(task)
+        while run_dir not in ["", "/"]:
+            db.execute("SELECT TASKS.task_id FROM TASKS JOIN RUNS ON RUNS.run_id = TASKS.run_id JOIN PATHS ON PATHS.path_id = TASKS.path_id "
+                       "WHERE RUNS.run_dir = ? AND PATHS.path = ?", [run_dir, task[len(run_dir)+1:]])
+            rows = db.fetchall()
+            if len(rows) == 1:
+                return rows[0][0]
+            run_dir = os.path.dirname(run_dir)
+        return None
+
+    def _update_task(self, db, task, assignments, params):
+        " applies 'UPDATE TASKS SET [assignments]' to the given task.  Returns False if there is no such task "
+        task_id = self._find_task_id(db, task)
+        if task_id is None:
+            return False
+        db.execute("UPDATE TASKS SET %s WHERE task_id = ?" % assignments, params + [task_id])
+        return db.rowcount > 0
+
     def wait_for_created(self, timeout):
         self._lock.acquire()
         self._cv_created.wait(timeout)
@@ -242,54 +722,146 @@ class TaskStore:
                 run_id = rows[0][0]
 
                 db.execute("DELETE FROM TASKS WHERE run_id = ?", [run_id])
+                db.execute("DELETE FROM STATUS_COUNTS WHERE run_id = ?", [run_id])
+                db.execute("DELETE FROM ARCHIVED_RUNS WHERE run_id = ?", [run_id])
+                db.execute("DELETE FROM TASK_MEMORY WHERE run_id = ?", [run_id])
+                db.execute("DELETE FROM TASK_ATTEMPTS WHERE run_id = ?", [run_id])
                 db.execute("DELETE FROM RUNS WHERE run_id = ?", [run_id])
         return True
 
     def task_submitted(self, task_dir, external_id):
-        with self.transaction() as db:
-            db.execute("UPDATE TASKS SET status = ?, external_id = ? WHERE task_dir = ?", [SUBMITTED, external_id, task_dir])
-            if db.rowcount == 0:
+        def update(db):
+            if not self._update_task(db, task_dir, "status = ?, external_id = ?", [SUBMITTED, external_id]):
                 log.warn("task_submitted(%s, %s) called, but no record in db", task_dir, external_id)
+            else:
+                TASKS_SUBMITTED.inc()
+        self._updates.execute(update)
         return True
 
-    def task_started(self, task_dir, node_name):
+    def _task_started(self, db, task_dir, node_name):
+        if not self._update_task(db, task_dir, "try_count = try_count + 1, node_name = ?, status = ?", [node_name, STARTED]):
+            log.warn("task_started(%s, %s) called, but no record in db", task_dir, node_name)
+
+    def _task_failed(self, db, task_dir):
+        if not self._update_task(db, task_dir, "status = ?", [FAILED]):
+            log.warn("task_failed(%s) called, but no record in db", task_dir)
+        else:
+            TASKS_FINISHED.inc(1, "FAILED")
+        self._release_waiting_tasks(db)
+
+    def _task_completed(self, db, task_dir):
+        if not self._update_task(db, task_dir, "status = ?", [COMPLETED]):
+            log.warn("task_completed(%s) called, but no record in db", task_dir)
+        else:
+            TASKS_FINISHED.inc(1, "COMPLETED")
+        self._release_waiting_tasks(db)
+
+    def _release_waiting_tasks(self, db):
+        """ moves the waiting tasks of each group whose earlier groups have all finished to READY (or PREREQ_FAILED
+            if any of those failed), with one statement per group.  Returns the number of tasks moved """
+        db.execute("SELECT w.run_id, w.group_number, "
+                   "  EXISTS (SELECT 1 FROM STATUS_COUNTS p WHERE p.run_id = w.run_id AND p.group_number < w.group_number AND p.status IN %(failed)s AND p.count > 0) "
+                   "FROM STATUS_COUNTS w WHERE w.status = ? AND w.count > 0 "
+                   "AND NOT EXISTS (SELECT 1 FROM STATUS_COUNTS p WHERE p.run_id = w.run_id AND p.group_number < w.group_number AND p.status NOT IN %(terminal)s AND p.count > 0)"
+                   % dict(failed=FAILED_STATES, terminal=TERMINAL_STATES), [WAITING])
+        released = 0
+        for run_id, group_number, prereq_failed in db.fetchall():
+            if prereq_failed:
+                status = PREREQ_FAILED
+            else:
+                status = READY
+            db.execute("UPDATE TASKS SET status = ? WHERE run_id = ? AND group_number = ? AND status = ?", [status, run_id, group_number, WAITING])
+            released += db.rowcount
+        if released > 0:
+            # wake up the main loop to submit these
+            self._cv_created.notify_all()
+        return released
+
+    def release_waiting_tasks(self):
         with self.transaction() as db:
-            db.execute("UPDATE TASKS SET try_count = try_count + 1, node_name = ?, status = ? WHERE task_dir = ?", [node_name, STARTED, task_dir])
-            if db.rowcount == 0:
-                log.warn("task_started(%s, %s) called, but no record in db", task_dir, node_name)
+            return self._release_waiting_tasks(db)
+
+    def task_started(self, task_dir, node_name):
+        self._updates.execute(lambda db: self._task_started(db, task_dir, node_name))
         return True
 
     def task_failed(self, task_dir):
-        with self.transaction() as db:
-            db.execute("UPDATE TASKS SET status = ? WHERE task_dir = ?", [FAILED, task_dir])
-            if db.rowcount == 0:
-                log.warn("task_failed(%s) called, but no record in db", task_dir)
+        self._updates.execute(lambda db: self._task_failed(db, task_dir))
+        return True
+
+    def tasks_updated(self, events):
+        """ applies a batch of events, each a list of [event, task_id, node_name] where event is one of "started",
+            "completed" or "failed", in order and in a single transaction """
+        def update(db):
+            for event, task_dir, node_name in events:
+                if event == "started":
+                    self._task_started(db, task_dir, node_name)
+                elif event == "completed":
+                    self._task_completed(db, task_dir)
+                elif event == "failed":
+                    self._task_failed(db, task_dir)
+                else:
+                    log.warn("Ignoring unknown event %s for %s", event, task_dir)
+        self._updates.execute(update)
         return True
 
     def set_task_status(self, task_dir, status):
-        with self.transaction() as db:
-            db.execute("UPDATE TASKS SET status = ? WHERE task_dir = ?", [status, task_dir])
-            if db.rowcount == 0:
+        def update(db):
+            if not self._update_task(db, task_dir, "status = ?", [status]):
                 log.warn("set_task_status(%s, %s) called, but no record in db", task_dir, status)
+        self._updates.execute(update)
         return True
 
     def task_missing(self, task_dir):
-        with self.transaction() as db:
-            db.execute("UPDATE TASKS SET status = ? WHERE task_dir = ?", [MISSING, task_dir])
-            if db.rowcount == 0:
+        def update(db):
+            if not self._update_task(db, task_dir, "status = ?", [MISSING]):
                 log.warn("task_missing(%s) called, but no record in db", task_dir)
+        self._updates.execute(update)
         return True
 
     def task_completed(self, task_dir):
-        with self.transaction() as db:
-            db.execute("UPDATE TASKS SET status = ? WHERE task_dir = ?", [COMPLETED, task_dir])
-            if db.rowcount == 0:
-                log.warn("task_completed(%s) called, but no record in db", task_dir)
+        self._updates.execute(lambda db: self._task_completed(db, task_dir))
         return True
 
+    def find_started_tasks(self, tasks):
+        """ returns a list of (task_id, external_id, task_dir) for those of tasks (as notifications identify them) which
+            are STARTED """
+        result = []
+        with self.transaction(exclusive=False) as db:
+            for task in tasks:
+                task_id = self._find_task_id(db, task)
+                if task_id is None:
+                    continue
+                db.execute("SELECT TASKS.external_id, %s FROM %s WHERE TASKS.task_id = ? AND TASKS.status = ?" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS),
+                           [task_id, STARTED])
+                for external_id, task_dir in db.fetchall():
+                    result.append((task_id, external_id, task_dir))
+        return result
+
+    def tasks_stopped_beating(self, task_ids, resubmit):
+        """ called with the tasks which stopped sending heartbeats.  With resubmit (once their jobs have been killed),
+            those still STARTED are moved back to WAITING, or to MISSING once they have been tried MAX_HEARTBEAT_TRIES
+            times.  Otherwise they're moved to MISSING.  Returns the number moved """
+        moved = 0
+        with self.transaction() as db:
+            for task_id in task_ids:
+                if resubmit:
+                    db.execute("UPDATE TASKS SET status = CASE WHEN try_count >= ? THEN ? ELSE ? END WHERE task_id = ? AND status = ?",
+                               [MAX_HEARTBEAT_TRIES, MISSING, WAITING, task_id, STARTED])
+                else:
+                    db.execute("UPDATE TASKS SET status = ? WHERE task_id = ? AND status = ?", [MISSING, task_id, STARTED])
+                moved += db.rowcount
+        return moved
+
+    def get_task_heartbeats(self):
+        " returns dict(task, node_name, age, cpu, vsize, rss) for each task wingman has recently heard from "
+        if self.heartbeats is None:
+            return []
+        return self.heartbeats.get_state()
+
     def node_disappeared(self, node_name):
         with self.transaction() as db:
-            db.execute("UPDATE TASKS SET status = ? WHERE node_name = ? and status = ?", [WAITING, node_name, STARTED])
+            db.execute("UPDATE TASKS SET status = ? WHERE status = ? and node_name = ?", [WAITING, STARTED, node_name])
         return True
 
     def retry_run(self, run_dir):
@@ -298,6 +870,7 @@ class TaskStore:
             rows = db.fetchall()
             if len(rows) == 1:
                 run_id = rows[0][0]
+                self._restore_run(db, run_id)
                 # treating MISSING as the same as FAILED.  Perhaps there should be something that transforms MISSING tasks to FAILED after some timeout
                 db.execute("UPDATE TASKS SET status = ? WHERE run_id = ? and status in (?, ?, ?, ?)", [WAITING, run_id, FAILED, KILLED, MISSING, PREREQ_FAILED])
         return True
@@ -317,14 +890,84 @@ class TaskStore:
 
         return True
 
+    def archive_finished_runs(self, max_age, now=None):
+        """ archives the tasks of each run whose tasks have all been finished for at least max_age seconds.  Returns
+            the number of runs archived """
+        if now is None:
+            now = time.time()
+        unfinished_runs = "SELECT run_id FROM STATUS_COUNTS WHERE status NOT IN %s AND count > 0" % TERMINAL_STATES
+        with self.transaction() as db:
+            # note when each run finished, and forget it again if the run was retried since
+            db.execute("UPDATE RUNS SET finished_time = NULL WHERE finished_time IS NOT NULL AND run_id IN (%s)" % unfinished_runs)
+            db.execute("UPDATE RUNS SET finished_time = ? WHERE finished_time IS NULL AND run_id NOT IN (%s) "
+                       "AND run_id IN (SELECT run_id FROM STATUS_COUNTS WHERE count > 0)" % unfinished_runs, [now])
+
+            db.execute("SELECT run_id FROM RUNS WHERE finished_time <= ? AND run_id NOT IN (SELECT run_id FROM ARCHIVED_RUNS)", [now - max_age])
+            run_ids = [row[0] for row in db.fetchall()]
+            for run_id in run_ids:
+                self._archive_run(db, run_id)
+        if len(run_ids) > 0:
+            log.info("Archived %d finished runs", len(run_ids))
+        return len(run_ids)
+
+    def _archive_run(self, db, run_id):
+        db.execute("SELECT TASKS.task_id, PATHS.path, status, try_count, node_name, external_id, group_number FROM TASKS JOIN PATHS ON PATHS.path_id = TASKS.path_id "
+                   "WHERE run_id = ? ORDER BY TASKS.task_id", [run_id])
+        tasks = db.fetchall()
+        db.execute("INSERT INTO ARCHIVED_RUNS (run_id, tasks) VALUES (?, ?)", [run_id, sqlite3.Binary(zlib.compress(json.dumps(tasks)))])
+        db.execute("DELETE FROM TASKS WHERE run_id = ?", [run_id])
+
+    def _read_archived_tasks(self, db, run_id):
+        " returns the list of (task_id, path, status, try_count, node_name, external_id, group_number) for an archived run or None "
+        db.execute("SELECT tasks FROM ARCHIVED_RUNS WHERE run_id = ?", [run_id])
+        rows = db.fetchall()
+        if len(rows) == 0:
+            return None
+        return json.loads(zlib.decompress(rows[0][0]))
+
+    def _restore_run(self, db, run_id):
+        " moves the tasks of a run back into TASKS if it was archived "
+        tasks = self._read_archived_tasks(db, run_id)
+        if tasks is None:
+            return
+        for task_id, path, status, try_count, node_name, external_id, group_number in tasks:
+            db.execute("INSERT INTO TASKS (task_id, run_id, path_id, status, try_count, node_name, external_id, group_number) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       [task_id, run_id, self._intern_path(db, path), status, try_count, node_name, external_id, group_number])
+        db.execute("DELETE FROM ARCHIVED_RUNS WHERE run_id = ?", [run_id])
+        db.execute("UPDATE RUNS SET finished_time = NULL WHERE run_id = ?", [run_id])
+
+    def find_kill_pending_tasks(self):
+        " returns a dict of run_id -> [(task_id, external_id)] for all of the tasks waiting to be killed "
+        result = collections.defaultdict(list)
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT run_id, task_id, external_id FROM TASKS WHERE status = ?", [KILL_PENDING])
+            for run_id, task_id, external_id in db.fetchall():
+                result[run_id].append((task_id, external_id))
+        return result
+
+    def get_active_run_names(self):
+        " returns a dict of run_id -> name for each run which may have jobs in the queue "
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT DISTINCT RUNS.run_id, RUNS.name FROM RUNS JOIN STATUS_COUNTS ON STATUS_COUNTS.run_id = RUNS.run_id "
+                       "WHERE STATUS_COUNTS.status IN (?, ?, ?, ?, ?) AND STATUS_COUNTS.count > 0", [SUBMITTED, STARTED, MISSING, KILL_PENDING, KILL_SUBMITTED])
+            return dict(db.fetchall())
+
+    def tasks_kill_submitted(self, task_ids):
+        " moves the given KILL_PENDING tasks to KILL_SUBMITTED "
+        with self.transaction() as db:
+            # stay under sqlite's limit on the number of parameters
+            for batch in divide_into_batches(task_ids, 500):
+                db.execute("UPDATE TASKS SET status = ? WHERE status = ? AND task_id IN (%s)" % ",".join(["?"] * len(batch)), [KILL_SUBMITTED, KILL_PENDING] + list(batch))
+        return True
+
     def find_tasks_by_status(self, status, limit=None):
         if limit == 0:
             return []
 
-        query = "SELECT run_id, task_dir, group_number FROM tasks WHERE status = ?"
+        query = "SELECT TASKS.run_id, TASKS.task_id, %s, TASKS.group_number FROM %s WHERE TASKS.status = ?" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS)
         if limit != None:
             query += " limit %d" % limit
-        with self.transaction() as db:
+        with self.transaction(exclusive=False) as db:
             db.execute(query, [status])
             recs = db.fetchall()
         return recs
@@ -333,175 +976,624 @@ class TaskStore:
         if limit == 0:
             return []
 
-        query = "SELECT external_id, task_dir FROM tasks WHERE status = ?"
+        query = "SELECT TASKS.external_id, TASKS.task_id, %s FROM %s WHERE TASKS.status = ?" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS)
         if limit != None:
             query += " limit %d" % limit
-        with self.transaction() as db:
+        with self.transaction(exclusive=False) as db:
             db.execute(query, [status])
             recs = db.fetchall()
         return recs
 
     def find_external_ids_of_submitted(self):
-        with self.transaction() as db:
-            db.execute("SELECT task_dir, external_id FROM tasks WHERE status in (?, ?)", [STARTED, SUBMITTED])
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT TASKS.external_id, TASKS.task_id, %s FROM %s WHERE TASKS.status in (?, ?)" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS), [STARTED, SUBMITTED])
             recs = db.fetchall()
         return recs
 
+    def find_unfinished_tasks(self):
+        " returns a list of (task_id, task_dir, status, external_id) for each task which may still have a job in a queue "
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT TASKS.task_id, %s, TASKS.status, TASKS.external_id FROM %s WHERE TASKS.status IN (?, ?, ?, ?)" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS),
+                       [SUBMITTED, STARTED, MISSING, KILL_SUBMITTED])
+            return db.fetchall()
+
+    def tasks_reconciled(self, transitions):
+        """ applies a list of (task_id, expected status, new status) in one transaction, skipping any task whose status
+            has changed from the expected one since.  Returns the number of tasks updated """
+        by_change = collections.defaultdict(list)
+        for task_id, expected, status in transitions:
+            by_change[(expected, status)].append(task_id)
+        updated = 0
+        with self.transaction() as db:
+            for (expected, status), task_ids in by_change.items():
+                # stay under sqlite's limit on the number of parameters
+                for batch in divide_into_batches(task_ids, 500):
+                    db.execute("UPDATE TASKS SET status = ? WHERE status = ? AND task_id IN (%s)" % ",".join(["?"] * len(batch)), [status, expected] + list(batch))
+                    updated += db.rowcount
+                    if status in (COMPLETED, FAILED, KILLED):
+                        TASKS_FINISHED.inc(db.rowcount, status_code_to_name[status])
+            self._release_waiting_tasks(db)
+        return updated
+
+    def count_submitted_by_prefix(self, prefixes):
+        " returns a dict of prefix -> number of SUBMITTED tasks whose external id starts with it "
+        result = {}
+        with self.transaction(exclusive=False) as db:
+            for prefix in prefixes:
+                db.execute("SELECT count(*) FROM TASKS WHERE status = ? AND external_id LIKE ?", [SUBMITTED, prefix + "%"])
+                result[prefix] = db.fetchall()[0][0]
+        return result
+
+    def count_tasks_per_status(self):
+        " returns a list of (status name, number of live tasks with that status) "
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT status, sum(count) FROM STATUS_COUNTS GROUP BY status ORDER BY status")
+            return [(status_code_to_name.get(status, str(status)), count) for status, count in db.fetchall()]
+
+    def count_tasks_by_status(self, status):
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT sum(count) FROM STATUS_COUNTS WHERE status = ?", [status])
+            count = db.fetchall()[0][0]
+        if count is None:
+            return 0
+        return count
+
     def count_tasks_by_group_number(self, run_id):
         # record of the form (successfully_finished_count, terminated_count, in_flight_count, waiting_count)
         result = collections.defaultdict(lambda: [0,0,0,0])
-        with self.transaction() as db:
-            db.execute("SELECT group_number, status, count(*) FROM tasks WHERE run_id = ? group by group_number",
-                       [run_id])
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT group_number, status, count FROM STATUS_COUNTS WHERE run_id = ?", [run_id])
             for number, status, count in db.fetchall():
                 record = result[number]
                 if status in [COMPLETED]:
-                    record[0] += 1
+                    record[0] += count
                 elif status in [KILLED, FAILED, PREREQ_FAILED]:
-                    record[1] += 1
+                    record[1] += count
                 elif status in [WAITING]:
-                    record[2] += 1
+                    record[3] += count
                 else:
-                    record[3] += 1
+                    record[2] += count
 
         return result
 
     def get_config_path(self, run_id):
-        with self.transaction() as db:
+        with self.transaction(exclusive=False) as db:
             db.execute("SELECT run_dir, flock_config_path FROM RUNS WHERE run_id = ?", [run_id])
             return db.fetchall()[0]
 
-    def get_required_mem_override(self, run_id):
+    def _set_run_schedule(self, run_dir, owner, priority, share, max_running):
+        if max_running is not None:
+            max_running = int(max_running)
+        assert share > 0
         with self.transaction() as db:
-            db.execute("SELECT required_mem_override FROM RUNS WHERE run_id = ?", [run_id])
-            return db.fetchall()[0][0]
+            db.execute("UPDATE RUNS SET owner = ?, priority = ?, share = ?, max_running = ? WHERE run_dir = ?", [owner, priority, share, max_running, run_dir])
 
-    def set_required_mem_override(self, run_id, mem_override):
+    def set_run_schedule(self, run_dir, priority, share, max_running):
+        " changes how the scheduler treats a run.  max_running may be None for no limit beyond the global ones "
         with self.transaction() as db:
-            db.execute("UPDATE RUNS set required_mem_override = ? WHERE run_dir = ?", [mem_override, run_id])
+            db.execute("SELECT owner FROM RUNS WHERE run_dir = ?", [run_dir])
+            owner = db.fetchall()[0][0]
+            self._set_run_schedule(run_dir, owner, int(priority), float(share), max_running)
         return True
 
-def handle_kill_pending_tasks(store, queue, batch_size=10):
-    external_id_and_task_dirs = dict(store.find_tasks_external_id_by_status(KILL_PENDING, limit=batch_size))
-    log.info("handle_kill_pending_tasks: %s", repr(external_id_and_task_dirs))
-    if len(external_id_and_task_dirs) > 0:
-        # strip off the queue prefix
-        external_ids = [external_id.split(":")[1] for external_id in external_id_and_task_dirs.keys()]
+    def get_schedule(self):
+        " returns the inputs and outcome of the scheduler's last decision "
+        return self.scheduler.get_state()
+
+    def get_schedulable_runs(self):
+        """ returns a dict(run_id, run_dir, flock_config_path, required_mem_override, owner, priority, share, max_running,
+            ready, in_flight) for each run with tasks ready or in flight """
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT RUNS.run_id, RUNS.run_dir, RUNS.flock_config_path, RUNS.required_mem_override, "
+                       "  RUNS.owner, RUNS.priority, RUNS.share, RUNS.max_running, "
+                       "  sum(CASE WHEN STATUS_COUNTS.status = ? THEN STATUS_COUNTS.count ELSE 0 END) AS ready, "
+                       "  sum(CASE WHEN STATUS_COUNTS.status IN (?, ?) THEN STATUS_COUNTS.count ELSE 0 END) AS in_flight "
+                       "FROM RUNS JOIN STATUS_COUNTS ON STATUS_COUNTS.run_id = RUNS.run_id "
+                       "GROUP BY RUNS.run_id HAVING ready > 0 OR in_flight > 0", [READY, SUBMITTED, STARTED])
+            result = []
+            for run_id, run_dir, flock_config_path, required_mem_override, owner, priority, share, max_running, ready, in_flight in db.fetchall():
+                if priority is None:
+                    priority = 0
+                if share is None:
+                    share = 1.0
+                result.append(dict(run_id=run_id, run_dir=run_dir, flock_config_path=flock_config_path,
+                                   required_mem_override=required_mem_override, owner=owner, priority=priority,
+                                   share=share, max_running=max_running, ready=ready, in_flight=in_flight))
+            return result
+
+    def find_ready_tasks(self, run_id, limit):
+        " returns up to limit READY tasks of a run as (run_id, task_id, task_dir, group_number, mem_request), oldest first "
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT TASKS.run_id, TASKS.task_id, %s, TASKS.group_number, TASKS.mem_request FROM %s WHERE TASKS.run_id = ? AND TASKS.status = ? "
+                       "ORDER BY TASKS.task_id LIMIT ?" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS), [run_id, READY, limit])
+            return db.fetchall()
+
+    def sample_memory_usage(self, limit=1000):
+        """ reads the peak memory of tasks which have finished since the last call.  Completed tasks contribute to
+            their run's estimate, and tasks which failed close to their request have it raised.  Returns the number
+            of tasks read """
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT TASKS.task_id, TASKS.run_id, %s, TASKS.status, TASKS.mem_request FROM MEMORY_PENDING "
+                       "JOIN TASKS ON TASKS.task_id = MEMORY_PENDING.task_id JOIN RUNS ON RUNS.run_id = TASKS.run_id JOIN PATHS ON PATHS.path_id = TASKS.path_id "
+                       "LIMIT ?" % TASK_DIR_COLUMN, [limit])
+            tasks = db.fetchall()
+
+        # read the files before taking the lock
+        samples = []
+        for task_id, run_id, task_dir, status, mem_request in tasks:
+            peak = None
+            proc_stats_path = os.path.join(task_dir, "proc_stats.txt")
+            if "scatter" not in task_dir and self.storage.exists(proc_stats_path):
+                peak = read_peak_memory(self.storage.read(proc_stats_path))
+            samples.append((task_id, run_id, status, mem_request, peak))
 
-        log.info("Killing tasks with external_ids: %s", repr(external_ids))
-        tasks = [flock.Task(None, external_id, None, None) for external_id in external_ids]
-        queue.kill(tasks)
-        # just let the jobs transition to MISSING in next periodic check.  Should we explictly mark these as killed?
-        # seems like many ways for that to fall out of sync with the backend queue if we set it to killed without checking
+        with self.transaction() as db:
+            for task_id, run_id, status, mem_request, peak in samples:
+                if peak is not None:
+                    if status == COMPLETED:
+                        db.execute("INSERT OR REPLACE INTO TASK_MEMORY (task_id, run_id, peak_mem_mb) VALUES (?, ?, ?)", [task_id, run_id, peak])
+                    elif status == FAILED and mem_request is not None and peak >= MEM_NEAR_LIMIT * mem_request:
+                        log.info("Task %d failed using %.0fMB of %dMB, so will ask for more if retried", task_id, peak, mem_request)
+                        db.execute("UPDATE TASKS SET mem_request = ? WHERE task_id = ?", [int(mem_request * MEM_ESCALATION_FACTOR), task_id])
+                db.execute("DELETE FROM MEMORY_PENDING WHERE task_id = ?", [task_id])
+            # tasks which were deleted before being read
+            db.execute("DELETE FROM MEMORY_PENDING WHERE task_id NOT IN (SELECT task_id FROM TASKS)")
+        return len(samples)
+
+    def get_memory_estimate(self, run_id):
+        " returns the memory in MB to ask for the tasks of a run, or None if not enough of its tasks have completed to tell "
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT count(*) FROM TASK_MEMORY WHERE run_id = ?", [run_id])
+            count = db.fetchall()[0][0]
+            if count < MIN_MEM_SAMPLES:
+                return None
+            db.execute("SELECT peak_mem_mb FROM TASK_MEMORY WHERE run_id = ? ORDER BY peak_mem_mb LIMIT 1 OFFSET ?", [run_id, int(MEM_QUANTILE * (count - 1))])
+            peak = db.fetchall()[0][0]
+        return max(MIN_MEM_REQUEST, int(peak * (1 + MEM_MARGIN)))
+
+    def set_task_mem_request(self, task_id, mem_request):
+        self._updates.execute(lambda db: db.execute("UPDATE TASKS SET mem_request = ? WHERE task_id = ?", [mem_request, task_id]))
+
+    def get_accounting_offset(self, path):
+        " returns (offset, inode) of where reading the accounting file at path left off, or (None, None) "
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT offset, inode FROM ACCOUNTING_OFFSETS WHERE path = ?", [path])
+            rows = db.fetchall()
+        if len(rows) == 0:
+            return None, None
+        return rows[0]
+
+    def job_exits_recorded(self, path, offset, inode, job_exits, external_id_prefix):
+        """ records the exit status, failure reason, wall time and peak memory of each job in job_exits (a list of
+            accounting.JobExit) on its task, and saves how far into the accounting file at path has been read.  Tasks
+            which had not yet reported back are marked COMPLETED if they wrote their completion marker, otherwise
+            FAILED (or KILLED if they were being killed) """
+        in_flight_states = [SUBMITTED, STARTED, MISSING, KILL_PENDING, KILL_SUBMITTED]
+        exits_by_external_id = dict([(external_id_prefix + job_exit.job_id, job_exit) for job_exit in job_exits])
+
+        with self.transaction(exclusive=False) as db:
+            tasks = []
+            for external_id in exits_by_external_id.keys():
+                db.execute("SELECT TASKS.task_id, %s, TASKS.status, TASKS.external_id FROM %s WHERE TASKS.external_id = ?" % (TASK_DIR_COLUMN, TASKS_WITH_PATHS), [external_id])
+                tasks.extend(db.fetchall())
+
+        # check the markers before taking the lock
+        finished = {}
+        for task_id, task_dir, status, external_id in tasks:
+            if status in in_flight_states:
+                finished[task_id] = flock.finished_successfully(None, task_dir, self.storage)
 
-    for external_id, task_dir in external_id_and_task_dirs.items():
-        store.set_task_status(task_dir, KILL_SUBMITTED)
+        with self.transaction() as db:
+            for task_id, task_dir, status, external_id in tasks:
+                job_exit = exits_by_external_id[external_id]
+                db.execute("UPDATE TASKS SET exit_status = ?, failure_reason = ?, wall_time = ?, max_vmem_mb = ? WHERE task_id = ? AND external_id = ?",
+                           [job_exit.exit_status, job_exit.failure_reason, job_exit.wall_time, job_exit.max_vmem_mb, task_id, external_id])
+                if task_id in finished:
+                    # only move tasks which are still in flight, since a notification may have beaten us to it
+                    db.execute("SELECT status FROM TASKS WHERE task_id = ?", [task_id])
+                    if db.fetchall()[0][0] not in in_flight_states:
+                        continue
+                    if finished[task_id]:
+                        self._task_completed(db, task_id)
+                    elif status in [KILL_PENDING, KILL_SUBMITTED]:
+                        self._update_task(db, task_id, "status = ?", [KILLED])
+                        self._release_waiting_tasks(db)
+                    else:
+                        log.info("Task %d (job %s) exited with status %s (%s) without reporting back", task_id, external_id, job_exit.exit_status, job_exit.failure_reason)
+                        self._task_failed(db, task_id)
+            db.execute("INSERT OR REPLACE INTO ACCOUNTING_OFFSETS (path, offset, inode) VALUES (?, ?, ?)", [path, offset, inode])
+        return True
+
+    def get_required_mem_override(self, run_id):
+        with self.transaction(exclusive=False) as db:
+            db.execute("SELECT required_mem_override FROM RUNS WHERE run_id = ?", [run_id])
+            return db.fetchall()[0][0]
 
-    return False
+    def set_required_mem_override(self, run_id, mem_override):
+        with self.transaction() as db:
+            db.execute("UPDATE RUNS set required_mem_override = ? WHERE run_dir = ?", [mem_override, run_id])
+        return True
 
-def update_tasks_which_disappeared(store, external_ids_of_actually_in_queue, external_id_to_task_dir, state_to_use_if_missing):
-    external_ids_of_those_we_think_are_submitted = set(external_id_to_task_dir.keys())
+# the most jobs to pass to a single kill
+KILL_BATCH_SIZE = 500
+
+def job_name_is_unique(name, other_names):
+    " whether killing jobs by the name of a run (which matches all jobs named '*-name') can't hit the jobs of any other run "
+    safe_name = safe_job_name(name)
+    for other_name in other_names:
+        other_safe_name = safe_job_name(other_name)
+        if other_safe_name == safe_name or other_safe_name.endswith("-" + safe_name):
+            return False
+    return True
+
+def handle_kill_pending_tasks(store, queues, kill_by_name=False):
+    """ kills the jobs of all KILL_PENDING tasks in whichever of queues (one per backend) they were submitted to, in
+        large batches of ids.  With kill_by_name, a run's jobs are killed with one call where the queue supports
+        killing by name.  That matches any of the user's jobs with the same name, including those of other wingmen
+        or submitted by hand, so is only safe when this wingman is the only thing submitting as the user.  Returns
+        True if anything was killed """
+    kill_pending = store.find_kill_pending_tasks()
+    if len(kill_pending) == 0:
+        return False
+
+    run_names = store.get_active_run_names()
+    for run_id, tasks in kill_pending.items():
+        name = run_names.get(run_id)
+        other_names = [other_name for other_run_id, other_name in run_names.items() if other_run_id != run_id]
+        unknown = [task_id for task_id, external_id in tasks if external_id is None or
+                   not any([external_id.startswith(queue.external_id_prefix) for queue in queues])]
+        for queue in queues:
+            prefix = queue.external_id_prefix
+            # strip off the queue prefix
+            external_ids = [external_id[len(prefix):] for task_id, external_id in tasks if external_id is not None and external_id.startswith(prefix)]
+            if len(external_ids) == 0:
+                continue
+            if kill_by_name and name and job_name_is_unique(name, other_names) and queue.kill_by_name(name):
+                log.info("Killed the %d jobs of run %d by name", len(external_ids), run_id)
+            else:
+                log.info("Killing %d jobs of run %d", len(external_ids), run_id)
+                for batch in divide_into_batches(external_ids, KILL_BATCH_SIZE):
+                    queue.kill([flock.Task(None, external_id, None, None) for external_id in batch])
+        # just let the jobs transition to KILLED once they've left the queue.  Marking them as killed now could fall
+        # out of sync with the backend queue if a kill fails
+        store.tasks_kill_submitted([task_id for task_id, external_id in tasks if task_id not in unknown])
+        # nothing will ever see these leave a queue
+        for task_id in unknown:
+            store.set_task_status(task_id, KILLED)
+
+    return True
+
+def update_tasks_which_disappeared(store, external_ids_of_actually_in_queue, external_id_to_task, state_to_use_if_missing):
+    " external_id_to_task maps the external id of each task to (task_id, task_dir) "
+    external_ids_of_those_we_think_are_submitted = set(external_id_to_task.keys())
 
     # identify tasks which transitioned from running -> not running
     # and call these "missing" (assuming the db still claims these are running).  All other transitions
     # should already be performed through other means.
 
     disappeared_external_ids = external_ids_of_those_we_think_are_submitted - external_ids_of_actually_in_queue
-    log.info("external_ids_of_actually_in_queue = %s", external_ids_of_actually_in_queue)
-    log.info("disappeared_external_ids = %s", disappeared_external_ids)
+    log.debug("disappeared_external_ids = %s", disappeared_external_ids)
+    if len(disappeared_external_ids) > 0:
+        log.info("%d of %d tasks are no longer in the queue", len(disappeared_external_ids), len(external_ids_of_those_we_think_are_submitted))
     for external_id in disappeared_external_ids:
-        task_dir = external_id_to_task_dir[external_id]
+        task_id, task_dir = external_id_to_task[external_id]
 
         # check the filesystem to see if it really did succeed and we just missed the notification
-        if flock.finished_successfully(None, task_dir):
-            store.task_completed(task_dir)
+        if flock.finished_successfully(None, task_dir, store.storage):
+            store.task_completed(task_id)
         else:
-            store.set_task_status(task_dir, state_to_use_if_missing)
+            store.set_task_status(task_id, state_to_use_if_missing)
 
 def identify_tasks_which_disappeared(store, queue):
-    log.info("calling identify_tasks_which_disappeared")
-    external_ids_of_actually_in_queue = set([(queue.external_id_prefix + x) for x in queue.get_jobs_from_external_queue().keys()])
+    " checks the tasks submitted to queue (those with its external id prefix) against the jobs it has "
+    prefix = queue.external_id_prefix
+    with QUEUE_POLL_SECONDS.time():
+        jobs = queue.get_jobs_from_external_queue()
+    external_ids_of_actually_in_queue = set([(prefix + x) for x in jobs.keys()])
+    log.info("%d jobs in the %s queue", len(external_ids_of_actually_in_queue), prefix)
 
     # handle all the submitted jobs
-    external_id_to_task_dir = dict([(external_id, task_dir) for task_dir, external_id in store.find_external_ids_of_submitted()])
-    update_tasks_which_disappeared(store, external_ids_of_actually_in_queue, external_id_to_task_dir, MISSING)
+    external_id_to_task = dict([(external_id, (task_id, task_dir)) for external_id, task_id, task_dir in store.find_external_ids_of_submitted()
+                                if external_id is not None and external_id.startswith(prefix)])
+    update_tasks_which_disappeared(store, external_ids_of_actually_in_queue, external_id_to_task, MISSING)
 
     # handle all of the killed jobs
-    external_id_to_task_dir = dict(store.find_tasks_external_id_by_status(KILL_SUBMITTED))
-    update_tasks_which_disappeared(store, external_ids_of_actually_in_queue, external_id_to_task_dir, KILLED)
-
-def submit_created_tasks(listener, store, queue_factory, max_submitted):
-    submitted_count = len(store.find_tasks_by_status(SUBMITTED))
-
-    # process all the waiting to make sure they've met their requirements
-    count_cache = {}
-    waiting_tasks = store.find_tasks_by_status(WAITING)
-    log.info("Found %d WAITING tasks", len(waiting_tasks))
-    for run_id, task_dir, group in waiting_tasks:
-        if not (run_id in count_cache):
-            counts_per_run = store.count_tasks_by_group_number(run_id)
-            count_cache[run_id] = counts_per_run
-
-        counts_by_group = count_cache[run_id]
-
-        # check to make sure that we've completed everything in groups earlier then this one
-        prereq_finished = True
-        prereq_failed = False
-        for other_group, counts in counts_by_group.items():
-            finished_count, failed_count, running_count, waiting_count = counts
-            if other_group < group:
-                if failed_count > 0:
-                    prereq_failed = True
-                elif running_count > 0:
-                    prereq_finished = False
-
-        if prereq_failed:
-            store.set_task_status(task_dir, PREREQ_FAILED)
-        elif prereq_finished:
-            store.set_task_status(task_dir, READY)
+    external_id_to_task = dict([(external_id, (task_id, task_dir)) for external_id, task_id, task_dir in store.find_tasks_external_id_by_status(KILL_SUBMITTED)
+                                if external_id is not None and external_id.startswith(prefix)])
+    update_tasks_which_disappeared(store, external_ids_of_actually_in_queue, external_id_to_task, KILLED)
+
+def handle_tasks_of_unknown_backends(store, queues):
+    """ tasks whose external ids match none of queues were submitted to a backend wingman is no longer started with.
+        Nothing would ever see them leave a queue, so they're marked MISSING (or COMPLETED if they finished), and those
+        being killed are marked KILLED.  Returns the number found """
+    def is_unknown(external_id):
+        return external_id is not None and not any([external_id.startswith(queue.external_id_prefix) for queue in queues])
+    submitted = dict([(external_id, (task_id, task_dir)) for external_id, task_id, task_dir in store.find_external_ids_of_submitted() if is_unknown(external_id)])
+    killed = dict([(external_id, (task_id, task_dir)) for external_id, task_id, task_dir in store.find_tasks_external_id_by_status(KILL_SUBMITTED) if is_unknown(external_id)])
+    if len(submitted) + len(killed) > 0:
+        log.warn("%d tasks were submitted to backends which aren't configured (%s)", len(submitted) + len(killed),
+                 ", ".join(sorted(set([external_id.split(":")[0] for external_id in submitted.keys() + killed.keys()]))))
+    update_tasks_which_disappeared(store, set(), submitted, MISSING)
+    update_tasks_which_disappeared(store, set(), killed, KILLED)
+    return len(submitted) + len(killed)
+
+# the threads checking for the marker files of finished tasks at startup, which mostly wait on the filesystem
+RECONCILE_THREADS = 32
+RECONCILE_PROGRESS_INTERVAL = 10
+
+def find_finished_task_dirs(storage, task_dirs, threads=RECONCILE_THREADS):
+    " returns the set of task_dirs containing finished-time.txt, checking many at once and logging progress "
+    pool = ThreadPool(threads)
+    try:
+        finished = set()
+        last_report = time.time()
+        checks = pool.imap_unordered(lambda task_dir: (task_dir, flock.finished_successfully(None, task_dir, storage)), task_dirs, 100)
+        for i, (task_dir, is_finished) in enumerate(checks):
+            if is_finished:
+                finished.add(task_dir)
+            if time.time() - last_report > RECONCILE_PROGRESS_INTERVAL:
+                log.info("Checked %d of %d task directories, %d finished", i + 1, len(task_dirs), len(finished))
+                last_report = time.time()
+        return finished
+    finally:
+        pool.close()
+
+def reconcile_at_startup(store, queues, threads=RECONCILE_THREADS):
+    """ brings the tasks which were in flight when wingman stopped up to date, before any are submitted.  Takes one
+        snapshot of the jobs in each queue and checks the directories of all the unfinished tasks at once, instead of
+        waiting for identify_tasks_which_disappeared to find them one at a time.  Tasks in a queue which couldn't be
+        listed are left alone.  Returns the number of tasks updated """
+    started = time.time()
+    in_queue = set()
+    listed_prefixes = []
+    for queue in queues:
+        try:
+            with QUEUE_POLL_SECONDS.time():
+                jobs = queue.get_jobs_from_external_queue()
+        except:
+            log.exception("Could not list the jobs in the %s queue, not reconciling its tasks", queue.external_id_prefix)
+            continue
+        in_queue.update([queue.external_id_prefix + x for x in jobs.keys()])
+        listed_prefixes.append(queue.external_id_prefix)
+
+    tasks = [(task_id, task_dir, status, external_id) for task_id, task_dir, status, external_id in store.find_unfinished_tasks()
+             if external_id is not None and any([external_id.startswith(prefix) for prefix in listed_prefixes])]
+    log.info("Reconciling %d unfinished tasks against %d jobs in the queue", len(tasks), len(in_queue))
+    finished = find_finished_task_dirs(store.storage, [task_dir for task_id, task_dir, status, external_id in tasks], threads)
+
+    transitions = []
+    for task_id, task_dir, status, external_id in tasks:
+        if task_dir in finished:
+            transitions.append((task_id, status, COMPLETED))
+        elif external_id not in in_queue:
+            if status == KILL_SUBMITTED:
+                transitions.append((task_id, status, KILLED))
+            elif status != MISSING:
+                transitions.append((task_id, status, MISSING))
+    updated = store.tasks_reconciled(transitions)
+    log.info("Reconciled %d tasks (%d finished) in %.1f seconds", updated, len(finished), time.time() - started)
+    return updated
+
+def read_accounting_file(store, tail, external_id_prefix):
+    " records the exits of jobs written to the accounting file since the last call.  Returns the number read "
+    offset, inode = store.get_accounting_offset(tail.path)
+    job_exits, new_offset, new_inode = tail.read_new_records(offset, inode)
+    if (new_offset, new_inode) != (offset, inode):
+        store.job_exits_recorded(tail.path, new_offset, new_inode, job_exits, external_id_prefix)
+    return len(job_exits)
+
+class RunQueueCache(object):
+    """ keeps the parsed config of each run and the queues built from it from one pass of the main loop to the next.
+        A run's config is parsed again when its file's mtime changes, which is checked once per pass (see
+        start_pass), and its queues are rebuilt when that happens or when the memory to request changes (e.g. after
+        set_required_mem_override).  queue_factory(backend, listener, config, mem) creates a queue """
+    def __init__(self, listener, queue_factory):
+        self.listener = listener
+        self.queue_factory = queue_factory
+        # run_id -> (config_path, mtime, config)
+        self._configs = {}
+        # (backend name, run_id, mem) -> queue
+        self._queues = {}
+        # the runs whose config file has been checked this pass
+        self._checked = set()
+
+    def start_pass(self):
+        " called at the start of each pass of the main loop, so each run's config file is checked again "
+        self._checked = set()
+
+    def _forget_queues(self, run_id):
+        for key in self._queues.keys():
+            if key[1] == run_id:
+                del self._queues[key]
+
+    def get_config(self, run_id, run_dir, config_path):
+        cached = self._configs.get(run_id)
+        if cached is not None and cached[0] == config_path and run_id in self._checked:
+            return cached[2]
+        self._checked.add(run_id)
+        try:
+            mtime = os.path.getmtime(config_path)
+        except OSError:
+            mtime = None
+        if cached is not None and cached[0] == config_path and cached[1] == mtime:
+            return cached[2]
+        log.info("Loading config %s for run %s", config_path, run_id)
+        config = flock_config.load_config([config_path], run_dir, {})
+        self._configs[run_id] = (config_path, mtime, config)
+        self._forget_queues(run_id)
+        return config
+
+    def get_queue(self, backend, run_id, config, mem):
+        key = (backend.name, run_id, mem)
+        queue = self._queues.get(key)
+        if queue is None:
+            log.info("Creating %s queue missing from cache for %s with memory %s", backend.name, run_id, mem)
+            queue = self.queue_factory(backend, self.listener, config, mem)
+            queue.scratch_dir = config.scratch_dir
+            self._queues[key] = queue
+        return queue
+
+    def retain_runs(self, run_ids):
+        " drops everything cached for runs not in run_ids "
+        run_ids = set(run_ids)
+        for run_id in self._configs.keys():
+            if run_id not in run_ids:
+                del self._configs[run_id]
+        for key in self._queues.keys():
+            if key[1] not in run_ids:
+                del self._queues[key]
+
+def handle_silent_tasks(store, heartbeats, queues):
+    """ deals with the tasks which have stopped sending heartbeats.  A task which finished may just not have delivered
+        its notification yet, so those are marked COMPLETED.  The rest may only have lost their network, so their jobs
+        are killed in whichever of queues they were submitted to before they are resubmitted.  Tasks whose jobs
+        couldn't be killed are marked MISSING instead.  Returns the number which were still running """
+    silent = heartbeats.find_silent_tasks()
+    if len(silent) == 0:
+        return 0
+    started = []
+    for task_id, external_id, task_dir in store.find_started_tasks([task for task, node_name in silent]):
+        if flock.finished_successfully(None, task_dir, store.storage):
+            store.task_completed(task_id)
         else:
-            log.debug("Could not run %s because needs to wait for another job", task_dir)
-
-    # submit any ready tasks
-    submit_count = max(0, max_submitted-submitted_count)
-    tasks = store.find_tasks_by_status(READY, limit=submit_count)
-    log.info("Found %d READY tasks", len(tasks))
-    queue_cache = {}
-    for run_id, task_dir, group in tasks:
-        if not (run_id in queue_cache):
-            log.info("Creating queue missing from cache for %s", run_id)
-            run_dir, config_path = store.get_config_path(run_id)
-            required_mem_override = store.get_required_mem_override(run_id)
-
-            config = flock_config.load_config([config_path], run_dir, {})
-            queue = queue_factory(listener, config.qsub_options, config.scatter_qsub_options, config.name, config.workdir, required_mem_override)
-            queue_cache[run_id] = queue
-
-        queue = queue_cache[run_id]
-
-        queue.submit(run_id, os.path.join(run_dir, task_dir), "scatter" in task_dir)
-
-
-def main_loop(endpoint_url, flock_home, store, max_submitted, localQueue = False):
-
-    if localQueue:
-        queue_factory = lambda listener, qsub_options, scatter_qsub_options, name, workdir, required_mem_override: LocalBgQueue(listener, workdir)
-    else:
-        queue_factory = lambda listener, qsub_options, scatter_qsub_options, name, workdir, required_mem_override: SGEQueue(listener, qsub_options, scatter_qsub_options, name, workdir, required_mem_override)
-
-    listener = wingman_client.ConsolidatedMonitor(endpoint_url, flock_home)
-    t_queue = queue_factory(None, None, None, "", "./", None)
+            started.append((task_id, external_id))
+    killed = set()
+    for queue in queues:
+        prefix = queue.external_id_prefix
+        tasks = [(task_id, external_id[len(prefix):]) for task_id, external_id in started if external_id is not None and external_id.startswith(prefix)]
+        if len(tasks) == 0:
+            continue
+        try:
+            for batch in divide_into_batches(tasks, KILL_BATCH_SIZE):
+                if queue.kill([flock.Task(None, external_id, None, None) for task_id, external_id in batch]):
+                    killed.update([task_id for task_id, external_id in batch])
+                else:
+                    log.warn("Could not kill the jobs of %d silent tasks in the %s queue", len(batch), prefix)
+        except:
+            log.exception("Could not kill the jobs of silent tasks in the %s queue", prefix)
+    moved = store.tasks_stopped_beating(sorted(killed), resubmit=True)
+    moved += store.tasks_stopped_beating([task_id for task_id, external_id in started if task_id not in killed], resubmit=False)
+    if moved > 0:
+        nodes = sorted(set([node_name for task, node_name in silent]))
+        log.warn("%d running tasks stopped sending heartbeats (last seen on %s), %d were killed to be resubmitted", moved, ", ".join(nodes), len(killed))
+    return moved
+
+def submit_created_tasks(listener, store, queue_factory, router, queue_cache=None):
+    """ submits as many READY tasks as the backends of router have room for.  Each goes to the backend named in its
+        run's config, or the one for its memory request, or failing that, one taking overflow """
+    if queue_cache is None:
+        queue_cache = RunQueueCache(listener, queue_factory)
+    counts_by_prefix = store.count_submitted_by_prefix([backend.external_id_prefix for backend in router.backends])
+    submitted_counts = dict([(backend.name, counts_by_prefix[backend.external_id_prefix]) for backend in router.backends])
+
+    # tasks are released as the tasks they depend on finish, but also pick up newly created or retried tasks
+    released_count = store.release_waiting_tasks()
+    log.info("Released %d WAITING tasks", released_count)
+
+    # divide the free slots between the runs with ready tasks
+    submit_count = router.free_slots(submitted_counts)
+    runs = store.get_schedulable_runs()
+    queue_cache.start_pass()
+    queue_cache.retain_runs([run['run_id'] for run in runs])
+    allocation = store.scheduler.allocate(runs, submit_count)
+    tasks = []
+    for run_id, count in allocation.items():
+        tasks.extend(store.find_ready_tasks(run_id, count))
+    log.info("Submitting %d READY tasks from %d runs", len(tasks), len(allocation))
+    runs_by_id = dict([(run['run_id'], run) for run in runs])
+    estimates = {}
+    for run_id, task_id, task_dir, group, mem_request in tasks:
+        run = runs_by_id[run_id]
+        config = queue_cache.get_config(run_id, run['run_dir'], run['flock_config_path'])
+        if not (run_id in estimates):
+            estimates[run_id] = store.get_memory_estimate(run_id)
+        estimate = estimates[run_id]
+
+        is_scatter = "scatter" in task_dir
+        if is_scatter:
+            # the scatter doesn't resemble the tasks it creates
+            estimate = None
+        mem = choose_mem_request(run['required_mem_override'], estimate, mem_request)
+        backend = router.choose(config.backend, mem, submitted_counts)
+        if backend is None:
+            # stays READY until its backend has room
+            continue
+        submitted_counts[backend.name] = submitted_counts.get(backend.name, 0) + 1
+        if mem != mem_request:
+            store.set_task_mem_request(task_id, mem)
+
+        queue = queue_cache.get_queue(backend, run_id, config, mem)
+
+        # the task reports back to wingman using its task id
+        listener.task_ids[task_dir] = task_id
+        queue.submit(run_id, task_dir, is_scatter)
+
+
+def config_owner(config_path):
+    " the name of the user who owns the config file of a run "
+    uid = os.stat(config_path).st_uid
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+def main_loop(endpoint_url, flock_home, store, max_submitted, localQueue = False, spool_dir = None, archive_after = DEFAULT_ARCHIVE_AFTER, accounting_tail = None, heartbeats = None, backends = None,
+              reconcile_threads = RECONCILE_THREADS, kill_by_name = False):
+    """ backends is a list of backends.Backend, the first being the default.  If None, submits to sge (or local) only.
+        reconcile_threads is the number of threads checking task directories at startup, or 0 to skip that """
+    if backends is None:
+        queue_type = "local" if localQueue else "sge"
+        backends = [flock_backends.Backend(queue_type, queue_type, max_submitted, is_default=True)]
+    router = flock_backends.BackendRouter(backends)
+    queue_factory = lambda backend, listener, config, mem: backend.create_queue(listener, config, mem)
+
+    heartbeat_interval = None
+    if heartbeats is not None:
+        heartbeat_interval = heartbeats.interval
+    listener = wingman_client.ConsolidatedMonitor(endpoint_url, flock_home, spool_dir, heartbeat_interval)
+    # queues for listing and killing the jobs of each backend
+    t_queues = [backend.create_queue(None) for backend in backends]
+    queue_cache = RunQueueCache(listener, queue_factory)
 
     last_check_for_missing = None
+    try:
+        handle_tasks_of_unknown_backends(store, t_queues)
+    except:
+        log.exception("Could not check for tasks of unknown backends")
+    if reconcile_threads > 0:
+        try:
+            reconcile_at_startup(store, t_queues, reconcile_threads)
+            last_check_for_missing = time.time()
+        except:
+            log.exception("Could not reconcile tasks at startup")
 
     while True:
         try:
-            needed_to_kill_tasks = handle_kill_pending_tasks(store, t_queue)
-            submit_created_tasks(listener, store, queue_factory, max_submitted)
-
-            if last_check_for_missing == None or (time.time() - last_check_for_missing) > 60:
-                identify_tasks_which_disappeared(store, t_queue)
+            loop_started = time.time()
+            needed_to_kill_tasks = handle_kill_pending_tasks(store, t_queues, kill_by_name)
+            if accounting_tail is not None:
+                # the accounting file is the default backend's
+                read_accounting_file(store, accounting_tail, t_queues[0].external_id_prefix)
+            if heartbeats is not None:
+                handle_silent_tasks(store, heartbeats, t_queues)
+            store.sample_memory_usage()
+            submit_created_tasks(listener, store, queue_factory, router, queue_cache)
+
+            # check more often while waiting for killed jobs to leave the queue
+            check_interval = 60
+            if store.count_tasks_by_status(KILL_SUBMITTED) > 0:
+                check_interval = 10
+            if last_check_for_missing == None or (time.time() - last_check_for_missing) > check_interval:
+                for t_queue in t_queues:
+                    try:
+                        identify_tasks_which_disappeared(store, t_queue)
+                    except:
+                        # one backend being unreachable shouldn't hold up the others
+                        log.exception("Could not check the jobs in the %s queue", t_queue.external_id_prefix)
+                if archive_after > 0:
+                    store.archive_finished_runs(archive_after)
                 last_check_for_missing = time.time()
+            LOOP_SECONDS.observe(time.time() - loop_started)
 
             # only sleep if we didn't have to kill any tasks.  If we did have to kill tasks, then
             # don't sleep and immediately poll again in case there are more tasks to kill.
@@ -510,16 +1602,88 @@ def main_loop(endpoint_url, flock_home, store, max_submitted, localQueue = False
         except:
             traceback.print_exc()
 
-def make_function_wrapper(fn):
+# calls which may take a long time.  At most --heavythreads of these run at once so there are always threads left
+# to handle the task notifications coming from the cluster.  Rather than wait for a slot, which would tie up a thread,
+# further heavy calls fail with a BUSY_FAULT which the caller should retry.
+BUSY_FAULT = 503
+HEAVY_METHODS = ["run_submitted", "get_run_files", "get_file_content", "get_run_tasks", "get_run_stats", "get_run_tasks_page", "get_runs_page"]
+
+RPC_METHODS = ["get_run_files", "get_file_content", "delete_run", "retry_run", "kill_run", "run_created", "run_submitted", "taskset_created", "task_submitted", "task_started",
+               "task_failed", "task_completed", "tasks_updated", "node_disappeared", "get_version", "get_runs", "set_required_mem_override",
+               "get_run_tasks", "get_run", "get_schedule", "set_run_schedule", "get_run_stats", "get_task_heartbeats",
+               "get_run_tasks_page", "get_runs_page"]
+
+class PooledXMLRPCServer(SimpleXMLRPCServer):
+    " SimpleXMLRPCServer which handles each request on one of a fixed pool of threads instead of the thread accepting connections "
+    def __init__(self, addr, pool_size, **kwargs):
+        SimpleXMLRPCServer.__init__(self, addr, **kwargs)
+        self._requests = Queue.Queue()
+        for i in range(pool_size):
+            t = threading.Thread(target=self._process_requests)
+            t.daemon = True
+            t.start()
+
+    def _process_requests(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+# the fraction of RPC calls written to the access log.  Calls which fail are always logged.
+ACCESS_LOG_SAMPLE = 0.01
+# the longest args written to the access log for a call
+ACCESS_LOG_MAX_ARGS = 200
+
+access_log = logging.getLogger("access")
+
+def make_function_wrapper(fn, semaphore=None, sample=ACCESS_LOG_SAMPLE):
+    name = fn.__name__
     def wrapped(*args, **kwargs):
-        print "%s(%s, %s)" % (fn.__name__, args, kwargs)
+        outcome = "error"
+        start = time.time()
+        if semaphore is not None and not semaphore.acquire(False):
+            RPC_CALLS.inc(1, name, "busy")
+            raise xmlrpclib.Fault(BUSY_FAULT, "Too many slow calls in progress, try %s again later" % name)
         try:
-            return fn(*args, **kwargs)
+            result = fn(*args, **kwargs)
+            outcome = "ok"
+            return result
         except:
-            traceback.print_exc()
+            log.exception("%s failed", name)
             raise
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+            elapsed = time.time() - start
+            RPC_CALLS.inc(1, name, outcome)
+            RPC_SECONDS.observe(elapsed, name)
+            if outcome != "ok" or random.random() < sample:
+                call_args = repr(args)
+                if len(call_args) > ACCESS_LOG_MAX_ARGS:
+                    call_args = call_args[:ACCESS_LOG_MAX_ARGS] + "..."
+                access_log.info("%s%s %s %.3fs", name, call_args, outcome, elapsed)
     return wrapped
 
+def register_methods(server, store, heavy_threads, access_log_sample=ACCESS_LOG_SAMPLE):
+    heavy_semaphore = threading.Semaphore(heavy_threads)
+    for method in RPC_METHODS:
+        if method in HEAVY_METHODS:
+            semaphore = heavy_semaphore
+        else:
+            semaphore = None
+        server.register_function(make_function_wrapper(getattr(store, method), semaphore, access_log_sample), method)
+
+def register_store_metrics(store, registry=flock_metrics.REGISTRY):
+    registry.gauge_function("wingman_tasks", "Live (not archived) tasks in each status", ["status"],
+                            lambda: [((status,), count) for status, count in store.count_tasks_per_status()])
+
 import argparse
 
 def main():
@@ -527,10 +1691,31 @@ def main():
     logging.basicConfig(format=FORMAT, level=logging.INFO, datefmt="%Y%m%d-%H%M%S")
 
     parser = argparse.ArgumentParser(description='Wingman service for tracking state of jobs.')
-    parser.add_argument('queue', help='The queue to use.  Either "local" or "sge"')
+    parser.add_argument('queue', help='The default queue to use.  Either "local", "sge" or "lsf"')
     parser.add_argument('db_path', help="The path to the sqlite3 database to use for bookkeeping.  It will be created if it doesn't already exist")
     parser.add_argument("port", help="The port this service should listen on", type=int)
     parser.add_argument("--maxsubmitted", help="The maximum number non-running jobs allowed to sit in the backend queue at one time", type=int, default=100)
+    parser.add_argument("--backend", help="An additional queue to submit to, as NAME:TYPE[:max_submitted=N][:min_mem=MB][:max_mem=MB][:overflow=1].  May be repeated.  "
+                                          "Runs are sent to a backend by setting \"backend\" in their config, tasks needing at least min_mem go to the backend with the "
+                                          "largest such min_mem, and tasks whose backend is full spill over to backends with overflow=1", action="append", default=[])
+    parser.add_argument("--spooldir", help="If set, tasks record their events in this node-local directory and a per-node agent forwards them in batches")
+    parser.add_argument("--rpcthreads", help="The number of threads handling requests", type=int, default=16)
+    parser.add_argument("--maxperrun", help="The maximum number of tasks of any one run which may be submitted or running at once", type=int)
+    parser.add_argument("--maxperuser", help="The maximum number of tasks of any one user's runs which may be submitted or running at once", type=int)
+    parser.add_argument("--accountingfile", help="The batch system's accounting file (such as $SGE_ROOT/default/common/accounting).  If set, it is followed to learn how each job exited as soon as it finishes")
+    parser.add_argument("--accountingformat", help="The format of --accountingfile", choices=sorted(accounting.PARSERS.keys()), default="sge")
+    parser.add_argument("--archiveafter", help="The number of hours after all of a run's tasks have finished before they are archived out of the task table.  0 disables archiving", type=float, default=DEFAULT_ARCHIVE_AFTER/3600)
+    parser.add_argument("--metricsport", help="If set, metrics are served in the Prometheus text format at /metrics on this port", type=int)
+    parser.add_argument("--fileport", help="If set, run files are served over HTTP (with support for byte ranges and gzip) on this port", type=int)
+    parser.add_argument("--heartbeatinterval", help="The seconds between the heartbeats each running task sends (over UDP, to the same port number), "
+                                                    "such as %d.  Tasks which stop sending them are killed and resubmitted.  Defaults to 0, which disables heartbeats" % flock_heartbeat.HEARTBEAT_INTERVAL,
+                        type=int, default=0)
+    parser.add_argument("--missedbeats", help="The number of heartbeats a task may miss before it is resubmitted", type=int, default=flock_heartbeat.MISSED_BEATS)
+    parser.add_argument("--accesslogsample", help="The fraction of RPC calls to write to the access log.  Failed calls are always logged", type=float, default=ACCESS_LOG_SAMPLE)
+    parser.add_argument("--killbyname", help="Kill all of a run's jobs with one qdel of the run's job name pattern.  Only safe if nothing else (such as another wingman) "
+                                             "submits jobs as this user", action="store_true")
+    parser.add_argument("--reconcilethreads", help="The number of threads checking the directories of unfinished tasks when starting up.  0 skips the check", type=int, default=RECONCILE_THREADS)
+    parser.add_argument("--heavythreads", help="The maximum number of threads which may be handling slow requests (such as run submission or fetching files) at once", type=int, default=4)
 
     args = parser.parse_args()
 
@@ -542,19 +1727,40 @@ def main():
     endpoint_url = "http://%s:%d" % (socket.gethostname(), port)
 
     store = TaskStore(db, flock_home, endpoint_url=endpoint_url)
+    store.scheduler = flock_scheduler.FairShareScheduler(max_per_run=args.maxperrun, max_per_user=args.maxperuser)
+
+    assert queue in flock_backends.QUEUE_TYPES
+    backends = [flock_backends.Backend(queue, queue, args.maxsubmitted, is_default=True)]
+    backends.extend([flock_backends.parse_backend(spec, default_max_submitted=args.maxsubmitted) for spec in args.backend])
 
-    assert queue in ['local', 'sge']
+    accounting_tail = None
+    if args.accountingfile is not None:
+        accounting_tail = accounting.AccountingFileTail(args.accountingfile, accounting.PARSERS[args.accountingformat])
 
-    main_loop_thread = threading.Thread(target=lambda: main_loop(endpoint_url, flock_home, store, args.maxsubmitted, localQueue=(queue == 'local')))
+    if args.heartbeatinterval > 0:
+        store.heartbeats = flock_heartbeat.HeartbeatMonitor(args.heartbeatinterval, args.missedbeats)
+        flock_heartbeat.start_listener(store.heartbeats, port)
+
+    main_loop_thread = threading.Thread(target=lambda: main_loop(endpoint_url, flock_home, store, args.maxsubmitted, localQueue=(queue == 'local'), spool_dir=args.spooldir,
+                                                                 archive_after=args.archiveafter*3600, accounting_tail=accounting_tail, heartbeats=store.heartbeats,
+                                                                 backends=backends, reconcile_threads=args.reconcilethreads,
+                                                                 kill_by_name=args.killbyname))
     main_loop_thread.daemon = True
-    server = SimpleXMLRPCServer(("0.0.0.0", port), allow_none=True)
+    assert args.heavythreads < args.rpcthreads
+    server = PooledXMLRPCServer(("0.0.0.0", port), args.rpcthreads, allow_none=True)
     main_loop_thread.start()
 
     print "Listening on port %d..." % port
-    for method in ["get_run_files", "get_file_content", "delete_run", "retry_run", "kill_run", "run_created", "run_submitted", "taskset_created", "task_submitted", "task_started",
-                   "task_failed", "task_completed", "node_disappeared", "get_version", "get_runs", "set_required_mem_override",
-                   "get_run_tasks", "get_run"]:
-        server.register_function(make_function_wrapper(getattr(store, method)), method)
+    register_methods(server, store, args.heavythreads, args.accesslogsample)
+
+    if args.metricsport is not None:
+        register_store_metrics(store)
+        flock_metrics.start_http_server(args.metricsport)
+        print "Serving metrics on port %d..." % args.metricsport
+
+    if args.fileport is not None:
+        file_server.start_file_server(store, args.fileport)
+        print "Serving run files on port %d..." % args.fileport
 
     server.serve_forever()
 
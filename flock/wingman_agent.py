@@ -0,0 +1,122 @@
+__author__ = 'pmontgom'
+
+import os
+import sys
+import glob
+import time
+import fcntl
+import socket
+import httplib
+import xmlrpclib
+import logging
+
+log = logging.getLogger("monitor")
+
+# how long to wait for more events before sending a batch
+BATCH_DELAY = 0.5
+MAX_BATCH_SIZE = 1000
+# give up on waiting for more events after this many seconds.  The next event spooled will start a new agent.
+IDLE_TIMEOUT = 300
+MAX_RETRY_DELAY = 60
+# a batch wingman has rejected this many times in a row is moved to the rejected subdirectory of the spool
+MAX_FAULTS = 5
+REJECTED_DIR = "rejected"
+
+def read_spooled_events(spool_dir, limit):
+    " returns a list of (filename, [event, task_id, node_name]) for the oldest events in spool_dir "
+    filenames = glob.glob(os.path.join(spool_dir, "*.event"))
+    filenames.sort()
+    result = []
+    for filename in filenames[:limit]:
+        with open(filename) as fd:
+            fields = fd.read().strip().split("\t")
+        if len(fields) != 3:
+            log.warn("Ignoring malformed event in %s: %s", filename, repr(fields))
+            os.unlink(filename)
+            continue
+        result.append((filename, fields))
+    return result
+
+def forward_events(spool_dir, service):
+    """ sends everything currently in the spool to wingman, removing each event only after wingman has accepted it.
+        returns the number of events sent """
+    sent = 0
+    while True:
+        batch = read_spooled_events(spool_dir, MAX_BATCH_SIZE)
+        if len(batch) == 0:
+            return sent
+        service.tasks_updated([fields for filename, fields in batch])
+        for filename, fields in batch:
+            os.unlink(filename)
+        sent += len(batch)
+
+def set_aside_next_batch(spool_dir):
+    " moves the batch forward_events would send next into the rejected directory, so it stops blocking the rest "
+    rejected_dir = os.path.join(spool_dir, REJECTED_DIR)
+    if not os.path.exists(rejected_dir):
+        os.makedirs(rejected_dir)
+    batch = read_spooled_events(spool_dir, MAX_BATCH_SIZE)
+    for filename, fields in batch:
+        os.rename(filename, os.path.join(rejected_dir, os.path.basename(filename)))
+    return len(batch)
+
+def forward_until_idle(spool_dir, endpoint_url, idle_timeout):
+    " forwards events until none have been spooled for idle_timeout seconds "
+    # the transport keeps its HTTP connection open between calls
+    service = xmlrpclib.ServerProxy(endpoint_url)
+    last_activity = time.time()
+    retry_delay = 1
+    faults = 0
+    while time.time() - last_activity <= idle_timeout:
+        try:
+            if forward_events(spool_dir, service) > 0:
+                last_activity = time.time()
+            retry_delay = 1
+            faults = 0
+        except (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError, xmlrpclib.Fault) as ex:
+            if isinstance(ex, xmlrpclib.Fault):
+                faults += 1
+                if faults >= MAX_FAULTS:
+                    log.error("Wingman rejected the same events %d times, moved %d to %s", faults, set_aside_next_batch(spool_dir),
+                              os.path.join(spool_dir, REJECTED_DIR))
+                    faults = 0
+                    continue
+            # events stay in the spool until wingman is reachable again
+            log.exception("Could not send events to %s, retrying in %d seconds", endpoint_url, retry_delay)
+            time.sleep(retry_delay)
+            retry_delay = min(MAX_RETRY_DELAY, retry_delay * 2)
+            service = xmlrpclib.ServerProxy(endpoint_url)
+            continue
+
+        time.sleep(BATCH_DELAY)
+
+def run_agent(spool_dir, endpoint_url, idle_timeout=IDLE_TIMEOUT):
+    lock_fd = open(os.path.join(spool_dir, "agent.lock"), "w")
+    pid_file = os.path.join(spool_dir, "agent.pid")
+    while True:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # another agent is already running for this spool
+            break
+        with open(pid_file, "w") as fd:
+            fd.write(str(os.getpid()))
+
+        forward_until_idle(spool_dir, endpoint_url, idle_timeout)
+
+        # stop advertising ourselves and release the lock before the final check, so anything spooled after it
+        # starts a new agent.  An agent started before the lock was released will have given up, so if there are
+        # events, carry on unless another agent has taken over since.
+        os.unlink(pid_file)
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        if len(read_spooled_events(spool_dir, 1)) == 0:
+            break
+
+    lock_fd.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(format="[%(asctime)-15s] %(message)s", level=logging.INFO, datefmt="%Y%m%d-%H%M%S")
+    if len(sys.argv) != 3:
+        print "Usage: spool_dir endpoint_url"
+        sys.exit(-1)
+    run_agent(sys.argv[1], sys.argv[2])
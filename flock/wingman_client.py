@@ -1,4 +1,6 @@
 import xmlrpclib
+import urlparse
+import time
 import flock
 import logging
 import wingman
@@ -6,10 +8,18 @@ import wingman
 log = logging.getLogger("flock")
 
 class ConsolidatedMonitor(flock.JobListener):
-    def __init__(self, endpoint_url, flock_home):
+    def __init__(self, endpoint_url, flock_home, spool_dir=None, heartbeat_interval=None):
         self.endpoint_url = endpoint_url
         self.flock_home = flock_home
+        self.spool_dir = spool_dir
+        # tasks send heartbeats over UDP to the same host and port number as endpoint_url
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_address = None
+        if heartbeat_interval is not None:
+            self.heartbeat_address = urlparse.urlparse(endpoint_url).netloc
         self.service = xmlrpclib.ServerProxy(endpoint_url)
+        # task_dir -> task_id for tasks about to be submitted, so notifications can use the id
+        self.task_ids = {}
 
         # just make sure we can connect and its working
         version = self.service.get_version()
@@ -17,38 +27,54 @@ class ConsolidatedMonitor(flock.JobListener):
 
     def task_submitted(self, task_dir, external_id):
         flock.JobListener.task_submitted(self, task_dir, external_id)
-        self.service.task_submitted(task_dir, external_id)
+        self.service.task_submitted(self.task_ids.pop(task_dir, task_dir), external_id)
 
     def presubmit(self, run_id, task_full_path, task_script, stdout, stderr):
         d = task_full_path
+        task = self.task_ids.get(d, d)
         script_to_execute = "%s/wrapped_task.sh" % d
         with open(script_to_execute, "w") as fd:
             fd.write("set -e\n"
-                     "%(notify_command)s started %(run_id)s %(task_dir)s\n"
+                     "%(notify_command)s started %(run_id)s %(task)s\n"
                      "set +e\n"
                      "if %(watch_command)s bash %(task_script)s ; then\n"
                      "  set -e\n"
-                     "  %(notify_command)s completed %(run_id)s %(task_dir)s\n"
+                     "  %(notify_command)s completed %(run_id)s %(task)s\n"
                      "else\n"
                      "  set -e\n"
-                     "  %(notify_command)s failed %(run_id)s %(task_dir)s\n"
+                     "  %(notify_command)s failed %(run_id)s %(task)s\n"
                      "fi\n" % dict(run_id=run_id,
-                                   task_dir=d,
+                                   task=task,
                                    task_script=task_script,
-                                   watch_command=wingman.format_watch_command(self.flock_home, os.path.join(d, "proc_stats.txt")),
-                                   notify_command=wingman.format_notify_command(self.flock_home, self.endpoint_url)))
+                                   watch_command=wingman.format_watch_command(self.flock_home, os.path.join(d, "proc_stats.txt"),
+                                                                              self.heartbeat_address, task, self.heartbeat_interval),
+                                   notify_command=wingman.format_notify_command(self.flock_home, self.endpoint_url, self.spool_dir)))
 
         return (script_to_execute, stdout, stderr)
 
 import glob
 import os
 
+BUSY_RETRY_DELAY = 5
+BUSY_RETRIES = 60
+
+def call_when_not_busy(method, *args):
+    " calls method, retrying while wingman is too busy with other slow calls to accept it "
+    for attempt in range(BUSY_RETRIES):
+        try:
+            return method(*args)
+        except xmlrpclib.Fault as ex:
+            if ex.faultCode != wingman.BUSY_FAULT or attempt == BUSY_RETRIES - 1:
+                raise
+            log.info("Wingman is busy, retrying in %d seconds", BUSY_RETRY_DELAY)
+            time.sleep(BUSY_RETRY_DELAY)
+
 def submit(endpoint_url, run_dir, config_path, name, delete_before_submit):
     service = xmlrpclib.ServerProxy(endpoint_url)
 
     if delete_before_submit:
         service.delete_run(run_dir)
-    service.run_submitted(run_dir, name, config_path, "{}")
+    call_when_not_busy(service.run_submitted, run_dir, name, config_path, "{}")
 
 #    for dirname in glob.glob("%s/tasks*" % run_dir):
 #        fn = "%s/task_dirs.txt" % dirname
@@ -6,7 +6,7 @@ import socket
 
 def main(args):
     if len(args) == 0:
-        print "Usage: ENDPOINT started|completed|failed run_id task_dir"
+        print "Usage: ENDPOINT started|completed|failed run_id task_id | ENDPOINT taskset run_dir task_definition_path"
         sys.exit(-1)
 
     service = xmlrpclib.ServerProxy(args[0])
@@ -0,0 +1,27 @@
+# Usage: wingman_spool.sh SPOOL_DIR ENDPOINT started|completed|failed|taskset run_id task_id
+#
+# Records a task event in a node-local spool directory instead of calling wingman directly.  A single
+# wingman_agent.py per node forwards spooled events to wingman in batches, and is started here if it isn't running.
+set -e
+spool_dir=$1
+endpoint=$2
+event=$3
+run_id=$4
+task=$5
+flock_home=`dirname $0`
+
+# registering a task set needs to have completed before the scatter finishes, so don't defer it
+if [ "$event" = "taskset" ] ; then
+  exec python $flock_home/wingman_notify.py $endpoint $event $run_id $task
+fi
+
+mkdir -p $spool_dir
+node_name=`hostname`
+name=`date +%s%N`-$node_name-$$
+# write under a hidden name and rename so the agent never sees a partial event
+printf '%s\t%s\t%s\n' "$event" "$task" "$node_name" > $spool_dir/.$name
+mv $spool_dir/.$name $spool_dir/$name.event
+
+if ! kill -0 `cat $spool_dir/agent.pid 2>/dev/null || echo none` 2>/dev/null ; then
+  nohup python $flock_home/wingman_agent.py $spool_dir $endpoint > /dev/null 2>&1 < /dev/null &
+fi
@@ -14,5 +14,5 @@ setup(
         "phlock-wingman = flock.wingman:main",
 #        "phlock-wingman-notify = flock.wingman_notify:main"
         ]},
-    package_data={'flock': ['*.R']}
+    package_data={'flock': ['*.R', '*.sh']}
 )
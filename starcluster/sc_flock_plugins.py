@@ -135,7 +135,7 @@ class InstallWingmanService(ClusterSetup):
   def run(self, nodes, master, user, user_shell, volumes):
     wingman_script_template = Template("""#!/bin/bash
 source /etc/profile.d/sge.sh
-exec ${flock_home}/bin/phlock-wingman sge ${run_dir}/jobdb.sqlite3 3010 --maxsubmitted 10000
+exec ${flock_home}/bin/phlock-wingman sge ${run_dir}/jobdb.sqlite3 3010 --maxsubmitted 10000 --fileport 3011
 """)
     
     temp_wingman_script = tempfile.NamedTemporaryFile()
@@ -116,6 +116,21 @@ class SshXmlServiceProxy(object):
 
         return service, transport
 
+    def open_http(self, port, path, headers):
+        """ sends a GET for path to the http server listening on port on the remote host.  Returns (response,
+            transport).  Call transport.dispose() once the response has been read """
+        if self.client.get_transport() == None or not self.client.get_transport().is_active():
+            self._reconnect()
+
+        transport = SshTransport(self.client)
+        connection = SSHHTTPConnection("localhost", transport, port=port)
+        try:
+            connection.request("GET", path, headers=headers)
+            return connection.getresponse(), transport
+        except:
+            transport.dispose()
+            raise
+
     def __getattribute__(self, name):
         client_methods = object.__getattribute__(self, "client_methods")
         if name in client_methods:
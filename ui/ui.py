@@ -28,6 +28,8 @@ from instance_types import cpus_per_instance
 import batch_submit
 import json
 import base64
+import urllib
+from flock.columns import unpack_columns
 
 oid = OpenID(None, "/tmp/clusterui-openid")
 terminal_manager = term.TerminalManager()
@@ -381,8 +383,8 @@ def get_wingman_service_factory():
         # perhaps we should ask the wingman service for the names of all methods?  That would avoid hardcoding them here
         client_methods = set(["get_run_files", "get_file_content", "delete_run", "retry_run", "kill_run",
                               "run_created", "run_submitted", "taskset_created", "task_submitted", "task_started",
-                              "task_failed", "task_completed", "node_disappeared", "get_version", "get_runs",
-                              "set_required_mem_override", "get_run_tasks"])
+                              "task_failed", "task_completed", "node_disappeared", "get_version",
+                              "set_required_mem_override", "get_run_tasks_page", "get_runs_page"])
         return sshxmlrpc.SshXmlServiceProxy(master_dns_name, "ubuntu", key_location, 3010, client_methods)
 
     return factory
@@ -395,20 +397,44 @@ def get_wingman_service():
         per_thread_cache.wingman_service_factory = wingman_service_factory
     return wingman_service_factory()
 
+RUNS_PER_PAGE = 1000
+
 def get_jobs_from_remote():
-    return get_wingman_service().get_runs()
+    " fetches every run a page at a time, so no one response from wingman has to hold them all "
+    service = get_wingman_service()
+    runs = []
+    offset = 0
+    while True:
+        page = service.get_runs_page(offset, RUNS_PER_PAGE)
+        runs.extend(unpack_columns(page['runs']))
+        offset += RUNS_PER_PAGE
+        if offset >= page['total']:
+            return runs
+
+TASKS_PER_PAGE = 1000
 
 @app.route("/run/<run_name>")
 def show_run(run_name):
     run_dir = config['TARGET_ROOT'] + "/" + run_name + "/files"
-    tasks = get_wingman_service().get_run_tasks(run_dir)
-    def rewrite_task(t):
-        t = dict(t)
-        # drop run prefix
-        t['task_dir'] = t['task_dir'][len(config['TARGET_ROOT'])+3+len("files")+len(run_name):]
-        return t
-    tasks = [rewrite_task(t) for t in tasks]
-    return flask.render_template("show-run.html", run_name=run_name, tasks=tasks)
+    offset = int(request.args.get("offset", 0))
+    status = request.args.get("status")
+    service = get_wingman_service()
+    # only fetch the page of tasks being shown
+    page = service.get_run_tasks_page(run_dir, offset, TASKS_PER_PAGE, status)
+    tasks = unpack_columns(page['tasks'])
+    for t in tasks:
+        t['task_dir'] = t['path']
+    tasks.sort(lambda a, b: cmp(a["task_id"], b["task_id"]))
+    status_counts = page['status']
+    if status is not None:
+        status_counts = service.get_run_tasks_page(run_dir, 0, 0, None, None, None, True)['status']
+
+    pages = dict(first=min(offset + 1, page['total']), last=min(offset + TASKS_PER_PAGE, page['total']), total=page['total'], prev=None, next=None)
+    if offset > 0:
+        pages['prev'] = max(0, offset - TASKS_PER_PAGE)
+    if offset + TASKS_PER_PAGE < page['total']:
+        pages['next'] = offset + TASKS_PER_PAGE
+    return flask.render_template("show-run.html", run_name=run_name, tasks=tasks, status=status, status_counts=status_counts, pages=pages)
 
 
 @app.route("/list-run-files/<run_name>", defaults=dict(file_path=""))
@@ -432,24 +458,29 @@ def list_run_files(run_name, file_path):
     files.sort(lambda a, b: cmp(a["name"], b["name"]))
     return flask.render_template("list-run-files.html", files=files, file_path=file_path, run_name=run_name)
 
-@app.route("/view-run-file/<run_name>/<path:file_path>")
-def view_run_file(run_name, file_path):
-    run_dir = config['TARGET_ROOT'] + "/" + run_name + "/files"
+# headers passed between the browser and wingman's file server when viewing a run file
+PROXIED_REQUEST_HEADERS = ["Range", "Accept-Encoding"]
+PROXIED_RESPONSE_HEADERS = ["Content-Length", "Content-Range", "Content-Encoding", "Accept-Ranges"]
 
-    service = get_wingman_service()
+def stream_file_over_xmlrpc(service, run_dir, file_path):
+    """ yields the content of a run file fetched piece by piece with get_file_content, for when wingman's file server
+        can't be reached """
     files = service.get_run_files(run_dir, file_path)
     assert len(files) == 1
     length = files[0]['size']
-    def stream_file():
-        offset = 0
-        read_size = 50000
-        while offset < length:
-            payload = service.get_file_content(run_dir, file_path, offset, read_size)
-            content = base64.standard_b64decode(payload['data'])
-            offset += read_size
-            if offset < length:
-                assert len(content) == read_size
-            yield content
+    offset = 0
+    read_size = 50000
+    while offset < length:
+        payload = service.get_file_content(run_dir, file_path, offset, read_size)
+        content = base64.standard_b64decode(payload['data'])
+        offset += read_size
+        if offset < length:
+            assert len(content) == read_size
+        yield content
+
+@app.route("/view-run-file/<run_name>/<path:file_path>")
+def view_run_file(run_name, file_path):
+    run_dir = config['TARGET_ROOT'] + "/" + run_name + "/files"
 
     # hack: is there some place we can ask something more complete for a mimetype given an extension?
     mimetype="application/octet-stream"
@@ -458,7 +489,31 @@ def view_run_file(run_name, file_path):
     elif file_path.endswith(".txt"):
         mimetype="text/plain"
 
-    return flask.Response(stream_file(), mimetype=mimetype)
+    # fetch the file from wingman's file server as a single stream instead of piece by piece over xmlrpc
+    service = get_wingman_service()
+    headers = dict([(name, request.headers[name]) for name in PROXIED_REQUEST_HEADERS if name in request.headers])
+    try:
+        response, transport = service.open_http(config['WINGMAN_FILE_PORT'], "/files?" + urllib.urlencode(dict(run_dir=run_dir, path=file_path)), headers)
+    except Exception:
+        # an older wingman, or one started without --fileport
+        app.logger.warning("Could not connect to wingman's file server, fetching %s over xmlrpc", file_path, exc_info=True)
+        return flask.Response(stream_file_over_xmlrpc(service, run_dir, file_path), mimetype=mimetype)
+    if response.status not in (200, 206):
+        transport.dispose()
+        flask.abort(response.status)
+
+    def stream_file():
+        try:
+            while True:
+                content = response.read(64*1024)
+                if content == "":
+                    break
+                yield content
+        finally:
+            transport.dispose()
+
+    response_headers = [(name, response.getheader(name)) for name in PROXIED_RESPONSE_HEADERS if response.getheader(name) is not None]
+    return flask.Response(stream_file(), status=response.status, headers=response_headers, mimetype=mimetype, direct_passthrough=True)
 
 @app.route("/job-dashboard")
 def job_dashboard():
@@ -784,6 +839,7 @@ if __name__ == "__main__":
                       PORT=9935,
                       FLOCK_PATH="/xchip/flock/bin/phlock",
                       LOADBALANCE_PID_FILE="loadbalance.pid",
+                      WINGMAN_FILE_PORT=3011,
                       TARGET_ROOT = "/data2/runs")
     app.config.from_pyfile(args.config_path)
     load_starcluster_config(app.config)